@@ -31,13 +31,18 @@ from plone.app.contenttypes.testing import (
 import plone.app.testing as pa_testing
 import transaction
 
-from experimental.securityindexing import testing
+from experimental.securityindexing import coalescing, testing
+from experimental.securityindexing.adapters import ObjectSecurity
 
 
 N_SIBLINGS = int(os.environ.get(b'BENCHMARK_N_SIBLINGS', 2))
 
 N_LEVELS = int(os.environ.get(b'BENCHMARK_N_LEVELS', 2))
 
+STAT_KEYS = (b'n_nodes', b'n_fetched', b'n_subtree_reindexes',
+             b'n_groups_skipped', b'n_prefetched',
+             b'n_calculated', b'n_cache_hits')
+
 logger = logging.getLogger(testing.__package__)
 logger.setLevel(logging.DEBUG)
 console_handler = logging.StreamHandler()
@@ -51,6 +56,7 @@ class Timings(object):
         self._duration = None
         self._test_ident = None
         self._test_ident_lbl_mapping = None
+        self._stats = None
         self._results_path = os.environ.get(b'BENCHMARK_RESULTS_FILE',
                                             b'bench-results.json')
         assert os.access(os.path.dirname(self._results_path),
@@ -103,6 +109,19 @@ class Timings(object):
         classified = bm_results.setdefault(classifier, {})
         durations_by_action = classified.setdefault(b'action-duration', {})
         durations_by_action[self._test_ident] = self._duration
+        fetches_by_action = classified.setdefault(b'action-fetches', {})
+        if is_installed:
+            stats = dict.fromkeys(STAT_KEYS, 0)
+            stats.update(self._stats)
+        else:
+            # The original implementation fetches and re-indexes
+            # every object, every time.
+            stats = {
+                b'n_nodes': n_objects,
+                b'n_fetched': n_objects,
+                b'n_subtree_reindexes': 1
+            }
+        fetches_by_action[self._test_ident] = stats
         with open(self._results_path, b'w') as fp:
             json.dump(storage, fp)
 
@@ -119,6 +138,9 @@ class Timings(object):
         self.context = content_obj
         self._test_ident = test_identifier
 
+    def set_stats(self, stats):
+        self._stats = stats
+
 
 def profile(func):
     @functools.wraps(func)
@@ -138,6 +160,25 @@ def profile(func):
     return _do_profile
 
 
+@contextlib.contextmanager
+def reindex_stats_recorded():
+    """Accumulate the stats of each `ObjectSecurity.reindex_many` call."""
+    stats = collections.Counter()
+    reindex_many = ObjectSecurity.reindex_many
+
+    def _reindex_many(adapter, objs):
+        try:
+            return reindex_many(adapter, objs)
+        finally:
+            stats.update(adapter.stats)
+
+    ObjectSecurity.reindex_many = _reindex_many
+    try:
+        yield stats
+    finally:
+        ObjectSecurity.reindex_many = reindex_many
+
+
 @contextlib.contextmanager
 def catalog_disabled():
     catalog_tool = CMFCatalogAware._getCatalogTool
@@ -287,7 +328,13 @@ class BenchTestMixin(object):
 
     def _call_mut(self, obj, test_identifier, *args, **kw):
         portal = api.portal.get()
-        with Timings(obj.reindexObjectSecurity) as benchmark:
+
+        def reindex_object_security():
+            obj.reindexObjectSecurity()
+            # As upon committing the transaction.
+            coalescing.flush()
+
+        with Timings(reindex_object_security) as benchmark:
             benchmark.set_test_identifier_label_map([
                 (u'lrchange', u'Local role change'),
                 (u'lrchange_with_lrblock', u'Local role change with block'),
@@ -295,7 +342,9 @@ class BenchTestMixin(object):
                 (u'nochange', u'No change')
             ])
             benchmark.set_context(portal[b'bench-root'], test_identifier)
-            benchmark()
+            with reindex_stats_recorded() as stats:
+                benchmark()
+            benchmark.set_stats(stats)
 
     def _get_obj(self, path=b''):
         return api.content.get(b'/plone/bench-root' + path)
@@ -328,6 +377,7 @@ class BenchTestMixin(object):
         blocked = subject[b'a']
         blocked.__ac_local_roles_block__ = True
         blocked.reindexObjectSecurity()
+        coalescing.flush()
         self._call_mut(subject, 'lrchange_with_lrblock')
 
 
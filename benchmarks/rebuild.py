@@ -0,0 +1,116 @@
+"""Benchmark rebuilding the shadow tree with a pool of worker processes.
+
+Builds a site of dummy content in a FileStorage, served by a ZEO server,
+then rebuilds its shadow tree (see `experimental.securityindexing.rebuild`)
+with increasing numbers of worker processes, reporting the wall-clock time
+of each rebuild and the speed-up relative to a single worker.
+
+The speed-up should approach the number of workers, up to the number of
+cores (and of top-level partitions).
+
+Run with:
+
+.. code-block: bash
+
+   $ bin/zopepy benchmarks/rebuild.py
+
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+
+from ZEO.ClientStorage import ClientStorage
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+import transaction
+
+from experimental.securityindexing.rebuild import rebuild
+from experimental.securityindexing.shadowtree import Node
+from experimental.securityindexing.tests.utils import (
+    DummyContent,
+    build_dummy_site,
+    start_zeo_server,
+)
+
+
+PROCESSES = tuple(
+    int(n) for n in
+    os.environ.get(b'BENCHMARK_PROCESSES', b'1,2,4').split(b',')
+)
+
+N_PARTITIONS = int(os.environ.get(b'BENCHMARK_N_PARTITIONS', 8))
+
+N_SIBLINGS = int(os.environ.get(b'BENCHMARK_N_SIBLINGS', 10))
+
+N_LEVELS = int(os.environ.get(b'BENCHMARK_N_LEVELS', 3))
+
+
+def build_storage(path):
+    """Create a FileStorage at `path` containing a site of dummy content.
+
+    :returns: The number of cataloged items.
+    """
+    db = DB(FileStorage(path))
+    try:
+        conn = db.open()
+        app = conn.root()[b'Application'] = DummyContent()
+        (site, catalog) = build_dummy_site(app, N_PARTITIONS,
+                                           N_SIBLINGS, N_LEVELS)
+        transaction.commit()
+        n_items = len(catalog._catalog.uids)
+        conn.close()
+    finally:
+        db.close()
+    return n_items
+
+
+def time_rebuild(addr, processes):
+    """Rebuild the shadow tree of the site served at `addr`.
+
+    :returns: The wall-clock duration of the rebuild.
+    """
+    db = DB(ClientStorage(addr, wait=True))
+    try:
+        conn = db.open()
+        root = conn.root()
+        app = root[b'Application']
+        site = app.unrestrictedTraverse((b'', b'plone'))
+        catalog = site.unrestrictedTraverse(b'portal_catalog')
+        st_root = root[b'shadowtree'] = Node()
+        transaction.commit()
+        start = time.time()
+        rebuild(st_root, site, catalog, processes=processes)
+        duration = time.time() - start
+        conn.close()
+    finally:
+        db.close()
+    return duration
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, b'Data.fs')
+        n_items = build_storage(path)
+        print(b'{} items in {} partitions'.format(n_items, N_PARTITIONS))
+        print(b'{:>9} {:>12} {:>9}'.format(b'processes', b'seconds',
+                                           b'speed-up'))
+        (addr, stop) = start_zeo_server(path)
+        try:
+            baseline = None
+            for processes in PROCESSES:
+                duration = time_rebuild(addr, processes)
+                if baseline is None:
+                    baseline = duration
+                print(b'{:>9} {:>12.3f} {:>9.2f}'.format(
+                    processes, duration, baseline / duration))
+        finally:
+            stop()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == b'__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Benchmark the storage and cache footprint of the shadow tree.
+
+Builds a site of dummy content in a FileStorage, then rebuilds its shadow
+tree with containers of child nodes created only for nodes with children
+(as `Node` does), and with a container for every node (as previous
+versions did). For each, the number of persistent objects and bytes the
+shadow tree adds to the (packed) storage are reported, along with the
+number of objects in the cache of a connection after visiting every node.
+
+Most nodes are leaves, hence creating containers lazily should roughly
+halve the number of objects.
+
+Run with:
+
+.. code-block: bash
+
+   $ bin/zopepy benchmarks/storage.py
+
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+import transaction
+
+from experimental.securityindexing.rebuild import rebuild
+from experimental.securityindexing.shadowtree import Node
+from experimental.securityindexing.tests.utils import (
+    DummyContent,
+    build_dummy_site,
+)
+
+
+N_PARTITIONS = int(os.environ.get(b'BENCHMARK_N_PARTITIONS', 4))
+
+N_SIBLINGS = int(os.environ.get(b'BENCHMARK_N_SIBLINGS', 10))
+
+N_LEVELS = int(os.environ.get(b'BENCHMARK_N_LEVELS', 3))
+
+LAZY = b'lazy'
+
+EAGER = b'eager'
+
+
+def build_storage(path):
+    """Create a FileStorage at `path` containing a site of dummy content.
+
+    :returns: The number of cataloged items.
+    """
+    db = DB(FileStorage(path))
+    try:
+        conn = db.open()
+        app = conn.root()[b'Application'] = DummyContent()
+        (site, catalog) = build_dummy_site(app, N_PARTITIONS,
+                                           N_SIBLINGS, N_LEVELS)
+        transaction.commit()
+        n_items = len(catalog._catalog.uids)
+        conn.close()
+        db.pack(time.time() + 1)
+    finally:
+        db.close()
+    return n_items
+
+
+def footprint(path):
+    """Get the number of objects and bytes in the storage at `path`."""
+    storage = FileStorage(path, read_only=True)
+    try:
+        return (len(storage), os.path.getsize(path))
+    finally:
+        storage.close()
+
+
+def build_shadowtree(path, mode):
+    """Rebuild the shadow tree of the site stored at `path`, then pack.
+
+    :param mode: `LAZY`, or `EAGER` to create a container for every node.
+    """
+    db = DB(FileStorage(path))
+    try:
+        conn = db.open()
+        root = conn.root()
+        app = root[b'Application']
+        site = app.unrestrictedTraverse((b'', b'plone'))
+        catalog = site.unrestrictedTraverse(b'portal_catalog')
+        st_root = root[b'shadowtree'] = Node()
+        rebuild(st_root, site, catalog, processes=0)
+        if mode == EAGER:
+            for node in st_root.descendants(ignore_block=True):
+                node._children(create=True)
+        transaction.commit()
+        conn.close()
+        db.pack(time.time() + 1)
+    finally:
+        db.close()
+
+
+def count_cached(path):
+    """Count the objects cached after visiting every shadow tree node."""
+    db = DB(FileStorage(path, read_only=True))
+    try:
+        conn = db.open()
+        st_root = conn.root()[b'shadowtree']
+        for node in st_root.descendants(ignore_block=True):
+            node.token
+        n_cached = conn._cache.cache_non_ghost_count
+        conn.close()
+    finally:
+        db.close()
+    return n_cached
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        content_path = os.path.join(tmpdir, b'Content.fs')
+        n_items = build_storage(content_path)
+        (n_objects, n_bytes) = footprint(content_path)
+        print(b'{} items ({} objects, {} bytes of content)'.format(
+            n_items, n_objects, n_bytes))
+        print(b'{:>6} {:>9} {:>12} {:>9}'.format(b'mode', b'objects',
+                                                 b'bytes', b'cached'))
+        for mode in (EAGER, LAZY):
+            path = os.path.join(tmpdir, mode + b'.fs')
+            shutil.copy(content_path, path)
+            build_shadowtree(path, mode)
+            (mode_objects, mode_bytes) = footprint(path)
+            print(b'{:>6} {:>9} {:>12} {:>9}'.format(
+                mode,
+                mode_objects - n_objects,
+                mode_bytes - n_bytes,
+                count_cached(path)
+            ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == b'__main__':
+    main()
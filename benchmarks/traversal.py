@@ -0,0 +1,92 @@
+"""Micro-benchmarks for shadow tree descendant traversal.
+
+Builds shadow trees of increasing depth, each level having a number of
+leaf siblings, and reports the cost of yielding each node for the
+explicit-stack traversal of `Node.descendants` and for the recursive
+generator it replaced.
+
+The per-node cost of the recursive generator grows with the depth
+of the tree, whereas that of `Node.descendants` should stay constant.
+
+Run with:
+
+.. code-block: bash
+
+   $ bin/zopepy benchmarks/traversal.py
+
+"""
+from __future__ import print_function
+import os
+import timeit
+
+from experimental.securityindexing.shadowtree import (
+    BREADTH_FIRST,
+    PRE_ORDER,
+    Node,
+)
+
+
+DEPTHS = tuple(
+    int(depth) for depth in
+    os.environ.get(b'BENCHMARK_DEPTHS', b'20,40,80,160').split(b',')
+)
+
+N_LEAVES = int(os.environ.get(b'BENCHMARK_N_LEAVES', 50))
+
+N_REPEATS = int(os.environ.get(b'BENCHMARK_N_REPEATS', 5))
+
+
+def build_tree(depth, n_leaves):
+    """Build a chain of `depth` nodes, each with `n_leaves` leaf children.
+
+    :returns: The root node and the total number of descendants.
+    """
+    root = node = Node()
+    count = 0
+    for level in range(depth):
+        for i in range(n_leaves):
+            leaf_id = b'leaf-%d' % (i,)
+            node[leaf_id] = Node(id=leaf_id, parent=node)
+            count += 1
+        child = Node(id=b'level-%d' % (level,), parent=node)
+        node[child.id] = child
+        count += 1
+        node = child
+    return (root, count)
+
+
+def recursive_descendants(node):
+    """The recursive generator previously used by `Node.descendants`."""
+    for child in node.values():
+        yield child
+        for descendant in recursive_descendants(child):
+            yield descendant
+
+
+def per_node_cost(func, n_nodes):
+    """Return the best time taken, per node, to exhaust ``func()``."""
+    timer = timeit.Timer(lambda: sum(1 for _ in func()))
+    return min(timer.repeat(repeat=N_REPEATS, number=1)) / n_nodes
+
+
+def main():
+    columns = (b'depth', b'nodes', b'recursive',
+               PRE_ORDER, BREADTH_FIRST, b'batched')
+    print(b''.join(b'%15s' % (column,) for column in columns))
+    for depth in DEPTHS:
+        (root, n_nodes) = build_tree(depth, N_LEAVES)
+        costs = (
+            per_node_cost(lambda: recursive_descendants(root), n_nodes),
+            per_node_cost(lambda: root.descendants(order=PRE_ORDER),
+                          n_nodes),
+            per_node_cost(lambda: root.descendants(order=BREADTH_FIRST),
+                          n_nodes),
+            per_node_cost(lambda: root.descendants(batch_size=100),
+                          n_nodes),
+        )
+        print(b'%15d%15d' % (depth, n_nodes) +
+              b''.join(b'%13.2fus' % (cost * 1e6,) for cost in costs))
+
+
+if __name__ == '__main__':
+    main()
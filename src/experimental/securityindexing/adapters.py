@@ -23,8 +23,9 @@ This involves consideration of:
         If set to a 'truthy' value, then any node and it's descendants
         will be not be indexed.
 
-    * acl_users._getAllLocalRoles (
-        combined __ac__local_roles__ when inheriting of local roles is 'on'
+    * __ac_local_roles__ (
+        combined with those of the parent when inheriting of local roles
+        is 'on', as per acl_users._getAllLocalRoles
       ):
 
         Nodes which share the same local roles as the current context
@@ -32,6 +33,9 @@ This involves consideration of:
 
         Group descendant nodes by a shared token (hash) of their
         respective (location aware combination) local roles.
+        Each token is derived from the token of the parent node,
+        so the tokens of descendants are re-derived from the shadow tree
+        alone.
         We index a faux object representing the content object
         for each object in the group, having fetched only one from the ZODB,
         with the knowledge that the `allowedRolesAndUsers` value will be the
@@ -40,24 +44,57 @@ This involves consideration of:
 The algorithm implement here for `reindexObjectSecurity`
 is as follows:
 
- 1. Record the security token (hashed  value of all local roles)
-    before and after re-indexing the current context.
+ 1. Record the security token (derived from the hashed value of
+    the local roles of the context and its ancestors, and of the roles
+    granted the View permission on the context and those from which
+    it acquires the permission) before and after re-indexing the
+    current context.
 
  2. Re-index our context, as we need to do this regardless of changes
     as this might have been a workflow change, and hence
     allowedRolesAndUsers may have changed.
-
- 3. Re-index descendants as local roles may have changed,
-    implying the value of allowedRolesAndUsers has also changed.
+    Calls to `reindexObjectSecurity` within a transaction are queued,
+    such that all objects queued are re-indexed (parents first) with
+    one combined pass over their descendants (see `.coalescing`).
+
+ 3. Re-derive the tokens of descendants in a top-down pass over
+    the shadow tree, re-indexing those whose token changed, as their
+    local roles (or View roles) have changed, implying the value of
+    allowedRolesAndUsers has also changed.
     Note that we never fetch descendants 'lower' than the parent
     of a node that has '__ac_local_roles_block__' set to a 'Truthy'
-    value.
-
- 4. Process the nodes that have the same token, such that we
-    avoid retrieving each descendant from the ZODB.
-
- 5. Fetch only the first node from each group of descendants
-    which contain the same set of local roles.
+    value, since the token of such a node does not change.
+    Where more descendants than the configured threshold are to be
+    re-indexed, they are instead queued as a job for a background
+    worker (see `.deferred`).
+
+ 4. Group the nodes that have the same token across the whole
+    affected subtree (not just adjacent runs of nodes), such that we
+    avoid retrieving each descendant from the ZODB. Nodes sharing a
+    token share an `allowedRolesAndUsers` value, even where siblings
+    are in different workflow states.
+
+ 5. Calculate the `allowedRolesAndUsers` value of each group from the
+    View roles and local roles recorded in the shadow tree, where the
+    calculation is provably that of the indexer (see `.aru`).
+    Otherwise, look up the value of the group's token in a process-wide
+    cache of values previously obtained from the indexer.
+    Failing that, fetch only one node from each group of descendants
+    which contain the same set of local roles (none at all for the
+    group containing the current context, which is already loaded).
+    Nodes are loaded by their persistent OID rather than traversed to
+    from the site root.
+    Whilst each group is written, the objects for the following groups
+    are prefetched from storage.
+
+ 6. Skip groups for which the `allowedRolesAndUsers` value calculated
+    for the fetched node is that already indexed for a node of the group,
+    since a change in local roles does not necessarily imply a change in
+    `allowedRolesAndUsers` (e.g a role without the View permission).
+
+ 7. Write the `allowedRolesAndUsers` value for each remaining group
+    directly to the index, in bulk, applying only the keywords which
+    changed for each catalog entry.
 
 
 Considerations
@@ -99,13 +136,40 @@ Considerations
      by default.
 
 """
-from itertools import chain, groupby
-from operator import attrgetter
+from collections import Counter, OrderedDict
+from itertools import chain
+import logging
 
+from Acquisition import aq_base
 from Products.CMFCore.interfaces import IIndexableObject
+from Products.CMFCore.utils import getToolByName
+from plone import api
 from zope import component, interface
 
+from .aru import ShadowCalculator, can_calculate, generation
+from .aru import cache as aru_cache
+from .deferred import Job
 from .interfaces import IObjectSecurity, IShadowTreeTool
+from .prefetch import Prefetcher
+from .writers import BulkKeywordIndexWriter
+
+
+logger = logging.getLogger(__package__)
+
+
+def _count_children(obj):
+    u"""Count the items contained by ``obj``, cheaply.
+
+    :returns: The number of items, or None if ``obj`` is not a container.
+    """
+    base = aq_base(obj)
+    object_count = getattr(base, b'objectCount', None)
+    if object_count is not None:
+        return object_count()
+    object_ids = getattr(base, b'objectIds', None)
+    if object_ids is not None:
+        return len(object_ids())
+    return None
 
 
 class _IndexableContentishProxy(object):
@@ -133,12 +197,21 @@ class ObjectSecurity(object):
     """Manage reindexing security of the `allowedRolesAndUsers` index."""
 
     _index_ids = ('allowedRolesAndUsers',)
+    _jar = None
+    _generation = None
 
     def __init__(self, context, catalog_tool):
         self.context = context
         self.catalog_tool = catalog_tool
+        self.stats = Counter()
+        self._loaded = {}
         shadowtree = component.getUtility(IShadowTreeTool)
         self._st_root = shadowtree.root
+        self._prefetch_depth = shadowtree.prefetch_depth
+        self._calculate_aru = shadowtree.calculate_aru
+        self._defer_threshold = shadowtree.defer_threshold
+        self._self_heal = shadowtree.self_heal
+        aru_cache.resize(shadowtree.aru_cache_size)
 
     def reindex_object(self, obj):
         reindex = self.catalog_tool.reindexObject
@@ -147,10 +220,252 @@ class ObjectSecurity(object):
         uid = b'/'.join(obj.getPhysicalPath())
         reindex(obj, idxs=self._index_ids, update_metadata=0, uid=uid)
 
+    def _load_by_oid(self, node):
+        u"""Load the content object for ``node`` by its persistent OID.
+
+        The object is wrapped in the acquisition context of its parent,
+        which is in turn loaded by OID, up to the (already loaded) context.
+
+        :returns: The wrapped content object, or None if ``node`` has no
+                  OID recorded, or the recorded OID is stale.
+        """
+        loaded = self._loaded
+        if node in loaded:
+            return loaded[node]
+        parent = node.__parent__
+        if node.oid is None or parent is None or self._jar is None:
+            return None
+        try:
+            obj = self._jar.get(node.oid)
+        except KeyError:
+            return None
+        get_id = getattr(aq_base(obj), b'getId', None)
+        if get_id is None or get_id() != node.id:
+            return None
+        parent_obj = self._load_by_oid(parent)
+        if parent_obj is None:
+            return None
+        obj = obj.__of__(parent_obj)
+        loaded[node] = obj
+        return obj
+
+    def _load(self, node):
+        u"""Load the content object for ``node``.
+
+        Objects are loaded by OID, such that intermediate containers need
+        not be traversed (and un-ghosted) from the site root. Traversal is
+        the fallback when the OID recorded on the node is stale.
+
+        :returns: The content object, or None if there is none at the
+                  path of ``node``.
+        """
+        obj = self._load_by_oid(node)
+        if obj is None:
+            self.stats[b'n_traversed'] += 1
+            obj = self.context.unrestrictedTraverse(node.physical_path, None)
+            if obj is None:
+                return None
+            oid = getattr(aq_base(obj), b'_p_oid', None)
+            if oid is not None and oid != node.oid:
+                node.oid = oid
+        self.stats[b'n_fetched'] += 1
+        return obj
+
+    def _rid_for(self, node):
+        u"""Return the catalog record id of ``node``.
+
+        The record id is cached on the node, and validated against the
+        catalog's ``paths`` mapping, sparing a lookup of the path in
+        the catalog's ``uids`` mapping.
+
+        :returns: The record id, or None if ``node`` is not cataloged.
+        """
+        catalog = self.catalog_tool._catalog
+        path = b'/'.join(node.physical_path)
+        rid = node.rid
+        if rid is None or catalog.paths.get(rid) != path:
+            rid = catalog.uids.get(path)
+            if rid is not None:
+                node.rid = rid
+        return rid
+
+    def _prune(self, node):
+        u"""Remove the node of content which no longer exists."""
+        parent = node.__parent__
+        if parent is not None and parent.get(node.id) is node:
+            del parent[node.id]
+        self.stats[b'n_pruned'] += 1
+        logger.warning(b'Pruned the shadow tree node of %s, which no '
+                       b'longer exists.', b'/'.join(node.physical_path))
+
+    def _heal(self, node, obj):
+        u"""Reconcile the children of ``node`` with those of ``obj``.
+
+        The number of child nodes is compared with the number of items
+        ``obj`` contains, less those found to have no node (e.g which are
+        not cataloged) when they were last reconciled; only if they differ
+        are the ids compared. Nodes are created (and their content
+        re-indexed) for cataloged items which have none, along with the
+        cataloged items within them. Nodes of items which no longer exist
+        are pruned.
+
+        :param node: The shadow tree node.
+        :param obj: The content object of ``node``.
+        :returns: Pairs of each node created and its content object.
+        :rtype: list
+        """
+        n_children = _count_children(obj)
+        if (not self._self_heal or n_children is None or
+                n_children - node.n_unshadowed == len(node)):
+            return []
+        uids = self.catalog_tool._catalog.uids
+        path = b'/'.join(node.physical_path)
+        ids = set(obj.objectIds())
+        created = []
+        for child_id in ids.difference(node.keys()):
+            child_path = path + b'/' + child_id
+            if child_path not in uids:
+                continue
+            child_paths = chain([child_path],
+                                uids.keys(min=child_path + b'/',
+                                          max=child_path + b'0',
+                                          excludemax=True))
+            for descendant_path in child_paths:
+                descendant = self.context.unrestrictedTraverse(
+                    descendant_path,
+                    None
+                )
+                if descendant is None:
+                    continue
+                descendant_node = self._st_root.ensure_ancestry_to(descendant)
+                descendant_node.update_security_info(descendant)
+                self.reindex_object(descendant)
+                created.append((descendant_node, descendant))
+        for child_id in set(node.keys()).difference(ids):
+            self._prune(node[child_id])
+        n_unshadowed = len(ids) - len(node)
+        if node.n_unshadowed != n_unshadowed:
+            node.n_unshadowed = n_unshadowed
+        self.stats[b'n_reconciled'] += 1
+        if created:
+            self.stats[b'n_healed'] += len(created)
+            logger.warning(b'Created %d missing shadow tree nodes within %s.',
+                           len(created), path)
+        return created
+
+    def _get_index(self):
+        return self.catalog_tool._catalog.getIndex(self._index_ids[0])
+
+    def _indexed_value(self, node):
+        u"""Return the `allowedRolesAndUsers` value indexed for ``node``.
+
+        :returns: The indexed keywords, or None if ``node`` is not indexed.
+        """
+        rid = self._rid_for(node)
+        if rid is None:
+            return None
+        return self._get_index()._unindex.get(rid)
+
+    def _increment_catalog_counter(self, writer):
+        catalog = self.catalog_tool._catalog
+        increment_counter = getattr(catalog, b'_increment_counter', None)
+        if writer.stats[b'n_rids_written'] and increment_counter is not None:
+            increment_counter()
+
+    def _write_group(self, writer, aru, nodes):
+        u"""Index ``aru`` as the `allowedRolesAndUsers` value of ``nodes``.
+
+        Entries whose indexed value already equals ``aru`` are not
+        written. Each entry is compared, since nodes sharing a token need
+        not share the value indexed for them (e.g where it is stale).
+
+        :param writer: A bulk index writer, or None if the index is not
+                       supported by one, in which case each node is
+                       re-indexed in turn.
+        :returns: The number of entries written.
+        :rtype: int
+        """
+        if writer is None:
+            n_written = 0
+            for node in nodes:
+                indexed = self._indexed_value(node)
+                if indexed is not None and set(indexed) == set(aru):
+                    continue
+                self.reindex_object(_IndexableContentishProxy(aru, node))
+                n_written += 1
+            return n_written
+        rids = []
+        for node in nodes:
+            rid = self._rid_for(node)
+            if rid is None:
+                self.stats[b'n_uncataloged'] += 1
+            else:
+                rids.append(rid)
+        return writer.write(aru, rids)
+
     def _to_indexable(self, obj):
         return component.getMultiAdapter((obj, self.catalog_tool),
                                          IIndexableObject)
 
+    def _lookup(self, groups, reindexed):
+        u"""Look up the `allowedRolesAndUsers` value of each group.
+
+        Values are calculated from the shadow tree where provably equivalent
+        to those of the indexer, otherwise they are looked up in the cache
+        by security token.
+
+        :param groups: Lists of nodes sharing a token.
+        :param reindexed: The nodes whose objects are loaded and indexed.
+        :returns: The value for each group, or None for each group
+                  containing a node in ``reindexed`` and each group whose
+                  value must be obtained by loading its first node.
+        :rtype: list
+        """
+        stats = self.stats
+        acl_users = getToolByName(self.context, b'acl_users')
+        self._generation = generation(api.portal.get(), acl_users)
+        calculator = None
+        if self._calculate_aru and can_calculate(acl_users):
+            calculator = ShadowCalculator()
+        values = [None] * len(groups)
+        for (position, node_group) in enumerate(groups):
+            if any(node in reindexed for node in node_group):
+                continue
+            node = node_group[0]
+            value = None
+            if calculator is not None:
+                value = calculator.allowed_roles_and_users(node)
+            if value is not None:
+                stats[b'n_calculated'] += 1
+            else:
+                value = aru_cache.get((self._generation, node.token))
+                if value is None:
+                    stats[b'n_cache_misses'] += 1
+                else:
+                    stats[b'n_cache_hits'] += 1
+                    value = list(value)
+            values[position] = value
+        return values
+
+    def _remember(self, node, value):
+        aru_cache.set((self._generation, node.token), tuple(value))
+
+    @staticmethod
+    def _group_by_token(nodes):
+        u"""Group ``nodes`` by security token.
+
+        Unlike ``itertools.groupby``, nodes sharing a token are grouped
+        together regardless of where they occur in the subtree.
+
+        :param nodes: The shadow tree nodes to group.
+        :returns: A mapping of token to nodes, in order of first occurrence.
+        :rtype: collections.OrderedDict
+        """
+        groups = OrderedDict()
+        for node in nodes:
+            groups.setdefault(node.token, []).append(node)
+        return groups
+
     def reindex(self):
         """Reindex the contents of `allowedRolesAndUsers` index.
 
@@ -161,22 +476,131 @@ class ObjectSecurity(object):
         this method can make descisions regarding which descendants need
         to be re-indexed.
         """
-        obj = self.context
-        reindex_object = self.reindex_object
-        to_indexable = self._to_indexable
+        self.reindex_many([self.context])
+
+    def reindex_many(self, objs):
+        u"""Reindex the `allowedRolesAndUsers` index for each of ``objs``.
+
+        Each object is re-indexed, parents before children. The descendants
+        of those whose token changed are then re-indexed in one combined
+        pass, such that each affected subtree is visited once, even where
+        ``objs`` are nested or duplicated.
+
+        :param objs: The content objects.
+        """
+        stats = self.stats
         root = self._st_root
-        traverse = obj.unrestrictedTraverse
-        node = root.ensure_ancestry_to(obj)
-        old_token = node.token
-        reindex_object(obj)
-        node.update_security_info(obj)
-        new_token = node.token
-        if old_token != new_token:
-            nodes = chain(iter([node]), node.descendants(ignore_block=False))
-            for (token, node_group) in groupby(nodes, attrgetter('token')):
-                first_node = next(node_group)
-                first_obj = traverse(first_node.physical_path)
-                aru = to_indexable(first_obj).allowedRolesAndUsers
-                for node in chain(iter([first_node]), node_group):
-                    content_proxy = _IndexableContentishProxy(aru, node)
-                    reindex_object(content_proxy)
+        objs_by_path = OrderedDict(
+            (obj.getPhysicalPath(), obj) for obj in objs
+        )
+        reindexed = OrderedDict()
+        changed = set()
+        for path in sorted(objs_by_path, key=len):
+            obj = objs_by_path[path]
+            node = root.ensure_ancestry_to(obj)
+            old_token = node.token
+            self.reindex_object(obj)
+            node.update_security_info(obj)
+            stats[b'n_nodes'] += 1
+            reindexed[node] = obj
+            for (healed, healed_obj) in self._heal(node, obj):
+                reindexed.setdefault(healed, healed_obj)
+            if node.token != old_token:
+                changed.add(node)
+        if not changed:
+            return
+        nodes = []
+        visited = set()
+        for node in reindexed:
+            if node not in changed or node in visited:
+                continue
+            # Nested nodes which changed are re-derived by the pass of the
+            # top-most, unless pruned by an unchanged node in between.
+            stats[b'n_subtree_reindexes'] += 1
+            for descendant in chain([node], node.retoken(force=changed)):
+                visited.add(descendant)
+                nodes.append(descendant)
+        n_descendants = sum(1 for node in nodes if node not in reindexed)
+        if 0 < self._defer_threshold < n_descendants:
+            self._defer([node for node in nodes if node not in reindexed])
+            return
+        self._jar = getattr(aq_base(self.context), b'_p_jar', None)
+        self._loaded = dict(reindexed)
+        groups = list(self._group_by_token(nodes).values())
+        self._reindex_groups(groups, reindexed)
+
+    def _defer(self, nodes):
+        u"""Queue a job re-indexing ``nodes`` in the background."""
+        shadowtree = component.getUtility(IShadowTreeTool)
+        job = Job(self.catalog_tool.getPhysicalPath(),
+                  (node.physical_path for node in nodes))
+        shadowtree.jobs.add(job)
+        self.stats[b'n_deferred'] += len(nodes)
+
+    def reindex_nodes(self, nodes):
+        u"""Reindex the `allowedRolesAndUsers` index for ``nodes``.
+
+        The tokens of ``nodes`` are taken to be current, as when resuming
+        work deferred by `reindex_many` (see `.deferred`).
+
+        :param nodes: Shadow tree nodes of descendants of the context.
+        """
+        context_node = self._st_root.ensure_ancestry_to(self.context)
+        self._jar = getattr(aq_base(self.context), b'_p_jar', None)
+        self._loaded = {context_node: self.context}
+        groups = list(self._group_by_token(nodes).values())
+        self._reindex_groups(groups, {})
+
+    def _reindex_groups(self, groups, reindexed):
+        u"""Reindex each group of nodes sharing a token.
+
+        :param groups: Lists of nodes sharing a token.
+        :param reindexed: A mapping of the nodes whose objects are already
+                          loaded and indexed, to those objects.
+        """
+        stats = self.stats
+        to_indexable = self._to_indexable
+        known = self._lookup(groups, reindexed)
+        index = self._get_index()
+        writer = None
+        if BulkKeywordIndexWriter.supports(index):
+            writer = BulkKeywordIndexWriter(index)
+        oids = [node_group[0].oid
+                if value is None and node_group[0] not in reindexed else None
+                for (node_group, value) in zip(groups, known)]
+        prefetcher = Prefetcher(self._jar, oids, self._prefetch_depth)
+        try:
+            for (position, node_group) in enumerate(groups):
+                prefetcher.advance(position)
+                value = known[position]
+                done = [node for node in node_group if node in reindexed]
+                if done:
+                    # Already loaded and indexed.
+                    obj = reindexed[done[0]]
+                    value = to_indexable(obj).allowedRolesAndUsers
+                    self._remember(done[0], value)
+                    node_group = [node for node in node_group
+                                  if node not in reindexed]
+                    if not node_group:
+                        continue
+                elif value is None:
+                    first_obj = self._load(node_group[0])
+                    while first_obj is None:
+                        self._prune(node_group.pop(0))
+                        if not node_group:
+                            break
+                        first_obj = self._load(node_group[0])
+                    if first_obj is None:
+                        continue
+                    self._heal(node_group[0], first_obj)
+                    value = to_indexable(first_obj).allowedRolesAndUsers
+                    self._remember(node_group[0], value)
+                stats[b'n_nodes'] += len(node_group)
+                if not self._write_group(writer, value, node_group):
+                    stats[b'n_groups_skipped'] += 1
+        finally:
+            prefetcher.close()
+        stats.update(prefetcher.stats)
+        if writer is not None:
+            stats.update(writer.stats)
+            self._increment_catalog_counter(writer)
@@ -0,0 +1,280 @@
+u"""Calculate `allowedRolesAndUsers` values from shadow tree data alone.
+
+The stock `allowedRolesAndUsers` indexer (`Products.CMFPlone.CatalogTool`)
+combines the roles granted the View permission on an object
+(`rolesForPermissionOn`) with the local roles of the object and its
+ancestors (`acl_users._getAllLocalRoles`). Each shadow tree node records
+both the View roles and the local roles of its content item, so the same
+value can be calculated without loading the content item.
+
+The calculation is only equivalent to the indexer's when the site uses
+the stock indexer, and local roles are provided solely by
+`__ac_local_roles__` (via the stock `borg.localrole` plugin and adapter);
+see `can_calculate`.
+
+Otherwise, values obtained from the indexer are cached (across
+transactions) by security token, such that content need only be loaded
+for tokens not seen before. The cache key includes a generation, which
+changes with the role definitions of the site and its PAS plugins;
+see `generation`.
+"""
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+import threading
+
+from Acquisition import aq_base
+from borg.localrole.default_adapter import DefaultLocalRoleAdapter
+from borg.localrole.interfaces import ILocalRoleProvider
+from borg.localrole.workspace import WorkspaceLocalRoleManager
+from plone.indexer.interfaces import IIndexer
+from plone.indexer.wrapper import IndexableObjectWrapper
+from Products.CMFCore.interfaces import IIndexableObject
+from Products.CMFPlone.CatalogTool import (
+    allowedRolesAndUsers as stock_indexer,
+)
+from Products.PluggableAuthService.interfaces.plugins import (
+    IGroupsPlugin,
+    ILocalRolesPlugin,
+    IRolesPlugin,
+)
+from zope import component
+
+from .shadowtree import digest
+
+
+_marker = object()
+
+DEFAULT_CACHE_SIZE = 10000
+u"The default maximum number of entries in the cache."
+
+
+_stock_factories = WeakKeyDictionary()
+
+_FACTORY_CHECKS = (
+    (IIndexableObject, u'', IndexableObjectWrapper),
+    (IIndexer, u'allowedRolesAndUsers', stock_indexer),
+    # borg.localrole consults all (named) local role providers.
+    (ILocalRoleProvider, None, DefaultLocalRoleAdapter),
+)
+
+
+def _registered_factories(registry, provided, name=None):
+    for registration in registry.registeredAdapters():
+        if (registration.provided.isOrExtends(provided) and
+                name in (None, registration.name)):
+            yield registration.factory
+
+
+def _uses_stock_factories(registry):
+    u"""Determine if the adapters registered are those of a stock site.
+
+    Walking the registrations is costly, so the result is cached for
+    each registry, until its registrations change (which is when the
+    generation of its adapter registry does).
+
+    :param registry: A component registry (site manager).
+    :rtype: bool
+    """
+    registry_generation = getattr(getattr(registry, b'adapters', None),
+                                  b'_generation', None)
+    cached = _stock_factories.get(registry)
+    if (cached is not None and registry_generation is not None and
+            cached[0] == registry_generation):
+        return cached[1]
+    result = all(factory is expected
+                 for (provided, name, expected) in _FACTORY_CHECKS
+                 for factory in _registered_factories(registry, provided,
+                                                      name))
+    _stock_factories[registry] = (registry_generation, result)
+    return result
+
+
+def can_calculate(acl_users):
+    u"""Determine if `allowedRolesAndUsers` can be calculated from shadow data.
+
+    :param acl_users: The user folder of the site.
+    :returns: True if the value calculated by `ShadowCalculator` is
+              provably that which would be indexed for a content item.
+    :rtype: bool
+    """
+    if getattr(acl_users, b'_getAllLocalRoles', None) is None:
+        return False
+    plugins = acl_users.plugins.listPlugins(ILocalRolesPlugin)
+    if not all(isinstance(plugin, WorkspaceLocalRoleManager)
+               for (plugin_id, plugin) in plugins):
+        return False
+    registries = [component.getGlobalSiteManager()]
+    site_manager = component.getSiteManager()
+    if site_manager not in registries:
+        registries.append(site_manager)
+    return all(_uses_stock_factories(registry) for registry in registries)
+
+
+def generation(portal, acl_users):
+    u"""Create a digest of the definitions that values are cached under.
+
+    The digest changes when the portal (including its role and permission
+    definitions) or the PAS plugin registry are modified, or any of the
+    active roles, groups or local roles plugins are.
+
+    :param portal: The Plone site.
+    :param acl_users: The user folder of the site.
+    :rtype: int
+    """
+    parts = [b'/'.join(portal.getPhysicalPath())]
+    parts.extend(sorted(portal.valid_roles()))
+    plugins = acl_users.plugins
+    persistents = [portal, acl_users, plugins]
+    for plugin_type in (IRolesPlugin, IGroupsPlugin, ILocalRolesPlugin):
+        for (plugin_id, plugin) in plugins.listPlugins(plugin_type):
+            parts.append(plugin_id)
+            persistents.append(plugin)
+    parts.extend(getattr(aq_base(obj), b'_p_mtime', None)
+                 for obj in persistents)
+    return digest(*parts)
+
+
+class LRUCache(object):
+    u"""A thread-safe mapping of bounded size.
+
+    When full, the least recently used entry is evicted.
+
+    :param size: The maximum number of entries. Zero disables the cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        u"""Get the value for ``key``, marking it as the most recently used.
+
+        :returns: The value, or ``default`` if ``key`` is not cached.
+        """
+        with self._lock:
+            value = self._data.pop(key, _marker)
+            if value is _marker:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        u"""Cache ``value`` for ``key``, evicting entries as needed."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def resize(self, size):
+        u"""Change the maximum number of entries, evicting as needed."""
+        with self._lock:
+            self.size = size
+            self._evict()
+
+    def clear(self):
+        u"""Remove all entries, and reset the hit and miss counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+cache = LRUCache(DEFAULT_CACHE_SIZE)
+u"The process-wide cache of `allowedRolesAndUsers` values."
+
+
+class ShadowCalculator(object):
+    u"""Calculates `allowedRolesAndUsers` values for shadow tree nodes.
+
+    The View roles calculated for each node are memoised, hence
+    an instance should not outlive the changes made to a shadow tree in
+    one re-index.
+    """
+
+    def __init__(self):
+        self._view_roles = {}
+
+    def view_roles(self, node):
+        u"""Get the roles granted the View permission on the item of ``node``.
+
+        :returns: The roles, including those acquired, or None if these
+                  are not recorded in the shadow tree.
+        :rtype: frozenset
+        """
+        roles = self._view_roles.get(node, _marker)
+        if roles is not _marker:
+            return roles
+        roles = node.view_roles
+        if roles is not None:
+            roles = frozenset(roles)
+            if node.view_acquired:
+                parent = node.__parent__
+                parent_roles = None
+                if parent is not None:
+                    parent_roles = self.view_roles(parent)
+                if parent_roles is None:
+                    roles = None
+                else:
+                    roles |= parent_roles
+        self._view_roles[node] = roles
+        return roles
+
+    @staticmethod
+    def local_roles(node):
+        u"""Get the local roles of the item of ``node``.
+
+        As per `borg.localrole`, the local roles of ancestors are included,
+        up to and including the first node which blocks their inheritance.
+
+        :returns: A mapping of principal id to roles, or None if these
+                  are not recorded in the shadow tree.
+        :rtype: dict
+        """
+        local_roles = {}
+        while node is not None:
+            if node.local_roles is None:
+                return None
+            for (principal, roles) in node.local_roles:
+                local_roles.setdefault(principal, set()).update(roles)
+            if node.block_inherit_roles:
+                break
+            node = node.__parent__
+        return local_roles
+
+    def allowed_roles_and_users(self, node):
+        u"""Calculate the `allowedRolesAndUsers` value for ``node``.
+
+        :returns: The value, as the stock indexer would compute it for the
+                  content item of ``node``, or None if it cannot be
+                  calculated from the shadow tree.
+        :rtype: list
+        """
+        view_roles = self.view_roles(node)
+        if view_roles is None:
+            return None
+        # As per the indexer, only the most basic role is indexed if
+        # the item is viewable by all (or all authenticated) users.
+        if b'Anonymous' in view_roles:
+            return [b'Anonymous']
+        if b'Authenticated' in view_roles:
+            return [b'Authenticated']
+        local_roles = self.local_roles(node)
+        if local_roles is None:
+            return None
+        allowed = set(view_roles)
+        for (principal, roles) in local_roles.items():
+            if not view_roles.isdisjoint(roles):
+                allowed.add(b'user:' + principal)
+        allowed.discard(b'Owner')
+        return sorted(allowed)
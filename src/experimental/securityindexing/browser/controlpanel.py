@@ -1,64 +1,176 @@
+from datetime import datetime
+from itertools import islice
+
 from Products.CMFPlone.PloneBatch import Batch
 from Products.Five import BrowserView
 from plone import api
 from zope import component
 
+from ..aru import cache as aru_cache
 from ..interfaces import IShadowTreeTool
 from .. import _
 
 
+_visual_truth = {True: u'\u2714', False: u'\u2717'}
+
+
+class _Rows(object):
+    u"""A sequence of table rows, generated a window at a time.
+
+    Only the rows of the window containing the item requested are held,
+    such that a batch can be rendered without generating every row.
+    """
+
+    def __init__(self, generate, length, window_size):
+        self._generate = generate
+        self._length = length
+        self._window_size = window_size
+        self._start = 0
+        self._rows = []
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        offset = index - self._start
+        if not 0 <= offset < len(self._rows):
+            stop = index + self._window_size
+            self._rows = list(islice(self._generate(), index, stop))
+            self._start = index
+            offset = 0
+        return self._rows[offset]
+
+
 class ControlPanel(BrowserView):
 
     _tool = None
     info = None
+    integral = None
+    batch_size = 10
     label = _(u'Experimental Security Indexing')
     description = _(u'Shows the synchronisation status of the '
                     u'internal shadow tree')
 
     def __call__(self):
         if self.request.method == 'POST':
+            if self.request.form.get(b'repair'):
+                return self.handle_repair()
+            if (self.request.form.get(b'requeue') or
+                    self.request.form.get(b'discard')):
+                return self.handle_parked_job()
             return self.handle_sync()
         form = self.request.form
         b_start = int(form.get(b'b_start', '0'))
         self.update()
-        self.rows = []
         info = self.info
-        if info.catalog_paths.symmetric_difference(info.shadowtree_paths):
-            all_paths = info.catalog_paths.union(info.shadowtree_paths)
-            paths = filter(bool, all_paths)
-            visual_truth = {True: u'\u2714', False: u'\u2717'}
-            for path in sorted(paths, key=len):
-                in_catalog = path in info.catalog_paths
-                in_shadowtree = path in info.shadowtree_paths
-                if in_catalog and in_shadowtree:  # pragma: no cover
-                    continue
-                self.rows.append({
-                    b'path': path,
-                    b'allowedRolesAndUsers index': visual_truth[in_catalog],
-                    b'shadowtree': visual_truth[in_shadowtree]
-                })
-        self.rows = Batch(self.rows, 10, b_start, orphan=1)
+        if info is None:
+            rows = []
+        else:
+            rows = _Rows(self._rows,
+                         info.n_missing + info.n_orphaned,
+                         self.batch_size + 1)
+        self.rows = Batch(rows, self.batch_size, b_start, orphan=1)
         return self.index()
 
+    def _rows(self):
+        st = component.getUtility(IShadowTreeTool)
+        for entry in st.discrepancies():
+            yield {
+                b'path': entry.path,
+                b'allowedRolesAndUsers index': _visual_truth[
+                    entry.in_catalog],
+                b'shadowtree': _visual_truth[entry.in_shadowtree]
+            }
+
     @property
     def action(self):
         return self.request.getURL()
 
     def available(self):
-        return not self.info.is_integral()
+        return not self.integral
 
     def getContent(self):
         return dict(rows=self.rows, info=self.info)
 
+    def cache_info(self):
+        return {
+            b'entries': len(aru_cache),
+            b'size': aru_cache.size,
+            b'hits': aru_cache.hits,
+            b'misses': aru_cache.misses
+        }
+
     def update(self):
         st = component.getUtility(IShadowTreeTool)
-        self.info = st.integrity_info()
+        self.integral = st.probably_integral()
+        if not self.integral or self.request.form.get(b'verify'):
+            # Viewing the control panel does not write to the database.
+            self.info = st.integrity_info(cached=True, store=False)
+            self.integral = self.info.is_integral()
 
-    def handle_sync(self):
+    def parked_jobs(self):
+        jobs = component.getUtility(IShadowTreeTool).jobs
+        return [{
+            b'key': key,
+            b'created': datetime.fromtimestamp(int(job.created)).isoformat(),
+            b'position': job.position,
+            b'n_paths': job.n_paths,
+            b'failures': job.failures
+        } for (key, job) in jobs.parked()]
+
+    def sync_cursor(self):
+        return component.getUtility(IShadowTreeTool).sync_cursor
+
+    def handle_sync(self, commit=True):
         catalog = api.portal.get_tool(name=b'portal_catalog')
         shadowtree = component.getUtility(IShadowTreeTool)
-        shadowtree.sync(catalog)
+        shadow_only = bool(self.request.form.get(b'shadow_only'))
+        shadowtree.sync(catalog, shadow_only=shadow_only, commit=commit)
         api.portal.show_message(message=u'Synchronisation complete',
                                 type=b'info',
                                 request=self.request)
         return self.request.response.redirect(self.action)
+
+    def handle_repair(self):
+        catalog = api.portal.get_tool(name=b'portal_catalog')
+        shadowtree = component.getUtility(IShadowTreeTool)
+        shadow_only = bool(self.request.form.get(b'shadow_only'))
+        stats = shadowtree.repair(catalog, shadow_only=shadow_only)
+        message = _(u'Repair complete: ${created} created, '
+                    u'${updated} updated, ${pruned} pruned, '
+                    u'${retokened} re-tokened.',
+                    mapping={
+                        u'created': stats[b'n_created'],
+                        u'updated': stats[b'n_updated'],
+                        u'pruned': stats[b'n_pruned'],
+                        u'retokened': stats[b'n_retokened'],
+                    })
+        api.portal.show_message(message=message,
+                                type=b'info',
+                                request=self.request)
+        return self.request.response.redirect(self.action)
+
+    def handle_parked_job(self):
+        form = self.request.form
+        jobs = component.getUtility(IShadowTreeTool).jobs
+        try:
+            key = int(form.get(b'job'))
+            if form.get(b'requeue'):
+                jobs.requeue(key)
+                message = _(u'The job was queued again.')
+            else:
+                jobs.discard(key)
+                message = _(u'The job was discarded.')
+        except (KeyError, TypeError, ValueError):
+            api.portal.show_message(message=_(u'No such parked job.'),
+                                    type=b'warning',
+                                    request=self.request)
+        else:
+            api.portal.show_message(message=message,
+                                    type=b'info',
+                                    request=self.request)
+        return self.request.response.redirect(self.action)
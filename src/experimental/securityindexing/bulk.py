@@ -0,0 +1,113 @@
+u"""Suspend the maintenance of the shadow tree during bulk operations.
+
+Whilst content is imported, pasted or migrated in bulk, the event
+subscribers which maintain the shadow tree (see `.subscribers`) only record
+the paths of the items added, moved or removed. Upon leaving the bulk
+operation, the subtree of each path recorded (disregarding those within
+another) is rebuilt from the catalog in one streaming pass, in path
+order, merging nodes in batches between transaction savepoints (see
+`.rebuild.rebuild_subtree`):
+
+.. code-block: python
+
+   from experimental.securityindexing import bulk
+
+   with bulk.suspended():
+       import_content(site)
+
+Content must be cataloged by the time the bulk operation ends.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+
+from plone import api
+from zope import component
+
+from .interfaces import IShadowTreeTool
+from .rebuild import rebuild_subtree
+
+
+logger = logging.getLogger(__package__)
+
+_local = threading.local()
+
+
+def active():
+    u"""Return whether a bulk operation is in progress (in this thread).
+
+    :rtype: bool
+    """
+    return getattr(_local, b'paths', None) is not None
+
+
+def touch(physical_path):
+    u"""Record that the item at ``physical_path`` was added, moved or removed.
+
+    :param physical_path: The physical path of the item.
+    :returns: True if a bulk operation is in progress, in which case the
+              shadow tree is synchronised upon its end, otherwise False.
+    :rtype: bool
+    """
+    paths = getattr(_local, b'paths', None)
+    if paths is None:
+        return False
+    paths.add(tuple(physical_path))
+    return True
+
+
+def outermost(paths):
+    u"""Get the paths which are not within another of ``paths``, in order.
+
+    :param paths: Physical paths.
+    :rtype: list
+    """
+    kept = []
+    for path in sorted(paths):
+        if kept and path[:len(kept[-1])] == kept[-1]:
+            continue
+        kept.append(path)
+    return kept
+
+
+def synchronise(paths):
+    u"""Rebuild the shadow tree subtrees of the items at ``paths``.
+
+    :param paths: The physical paths of the items added, moved or removed.
+    :returns: The number of nodes recorded.
+    :rtype: int
+    """
+    site = api.portal.get()
+    root = component.getUtility(IShadowTreeTool).root
+    catalog = api.portal.get_tool(b'portal_catalog')
+    subtrees = outermost(paths)
+    n_nodes = 0
+    for path in subtrees:
+        n_nodes += rebuild_subtree(root, site, catalog, path)
+    logger.info(b'Rebuilt %d shadow tree subtrees (%d nodes) after a bulk '
+                b'operation.', len(subtrees), n_nodes)
+    return n_nodes
+
+
+@contextmanager
+def suspended():
+    u"""Suspend the maintenance of the shadow tree by event subscribers.
+
+    The subtrees of the items added, moved or removed within the block are
+    rebuilt upon leaving it, unless an exception is raised (in which case
+    the transaction is expected to be aborted). Nested blocks are part of
+    the outermost one.
+
+    The shadow tree is only synchronised upon leaving the block, hence it
+    is stale for other threads (and processes) across any transactions
+    committed within the block.
+    """
+    if active():
+        yield
+        return
+    _local.paths = paths = set()
+    try:
+        yield
+    finally:
+        _local.paths = None
+    synchronise(paths)
@@ -0,0 +1,90 @@
+u"""Coalesce calls of `reindexObjectSecurity` within a transaction.
+
+Rather than re-indexing object security upon each call, objects are
+queued (per catalog) and re-indexed together by a before-commit hook of
+the transaction. Hence e.g changing the sharing of a folder, transitioning
+it and granting a role upon it within one request walks its descendants
+once (see `IObjectSecurity.reindex_many`).
+
+The queue is also flushed before each catalog search, and before content
+is moved or removed, such that searches see the re-indexed values and the
+queued paths remain valid.
+"""
+from collections import OrderedDict
+import logging
+import threading
+
+from Acquisition import aq_base
+from zope import component
+import transaction
+
+from .interfaces import IObjectSecurity
+
+
+logger = logging.getLogger(__package__)
+
+_local = threading.local()
+
+
+def _get_queue():
+    txn = transaction.get()
+    if getattr(_local, b'transaction', None) is not txn:
+        _local.transaction = txn
+        _local.queue = OrderedDict()
+        txn.addBeforeCommitHook(flush)
+    return _local.queue
+
+
+def queue(obj, catalog):
+    u"""Queue re-indexing the object security of ``obj`` in ``catalog``.
+
+    :param obj: The content object.
+    :param catalog: The catalog tool.
+    """
+    objs_by_catalog = _get_queue()
+    key = catalog.getPhysicalPath()
+    if key not in objs_by_catalog:
+        objs_by_catalog[key] = (catalog, OrderedDict())
+    objs_by_path = objs_by_catalog[key][1]
+    objs_by_path[obj.getPhysicalPath()] = obj
+
+
+def pending():
+    u"""Return the number of objects queued in the current transaction.
+
+    :rtype: int
+    """
+    if getattr(_local, b'transaction', None) is not transaction.get():
+        return 0
+    return sum(len(objs_by_path)
+               for (catalog, objs_by_path) in _local.queue.values())
+
+
+def _current(path, obj):
+    current = obj.unrestrictedTraverse(path, None)
+    if current is None or aq_base(current) is not aq_base(obj):
+        return None
+    return current
+
+
+def flush():
+    u"""Re-index the object security of the objects queued.
+
+    Objects which were moved or removed since being queued are skipped.
+    """
+    while pending():
+        objs_by_catalog = _local.queue
+        _local.queue = OrderedDict()
+        for (catalog, objs_by_path) in objs_by_catalog.values():
+            objs = []
+            for (path, obj) in objs_by_path.items():
+                current = _current(path, obj)
+                if current is None:
+                    logger.debug(b'Not re-indexing %s, moved or removed.',
+                                 b'/'.join(path))
+                else:
+                    objs.append(current)
+            if objs:
+                adapter = component.getMultiAdapter((objs[0], catalog),
+                                                    IObjectSecurity)
+                adapter.reindex_many(objs)
@@ -0,0 +1,413 @@
+u"""Re-index the descendants of large subtrees in the background.
+
+When the number of descendant nodes to be re-indexed by
+`IObjectSecurity.reindex_many` exceeds the ``defer_threshold`` of the
+shadow tree tool, the objects themselves are re-indexed synchronously,
+whilst the paths of the descendants are recorded in a persistent `Job`,
+queued in a `JobQueue` stored alongside the shadow tree.
+
+A `Worker` drains the queue with its own ZODB connection, re-indexing each
+job in chunks, each committed in a separate transaction. A chunk ends once
+it contains ``chunk_size`` nodes, or its time budget is spent. A chunk
+which fails to commit due to a conflict is retried. A chunk which fails
+otherwise is aborted and counted against its job; a job which fails
+``max_failures`` times is parked, such that the jobs queued behind it are
+processed. The position reached in each job is persisted with each chunk,
+hence a worker which is stopped resumes where it left off.
+
+A worker may be run in a thread of a Zope instance, e.g::
+
+    worker = Worker(app._p_jar.db(), (b'', b'plone'))
+    worker.start()
+
+or to drain the queue once, from a script (``bin/instance run``)::
+
+    Worker(app._p_jar.db(), (b'', b'plone')).process()
+
+Until a job is processed, the `allowedRolesAndUsers` values of the
+descendants it records remain those indexed before the change.
+"""
+import logging
+import threading
+import time
+
+from BTrees.IOBTree import IOBTree
+from BTrees.LOBTree import LOBTree
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from persistent import Persistent
+from zope import component
+from zope.component.hooks import setSite
+import transaction
+
+from .interfaces import IObjectSecurity, IShadowTreeTool
+
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_CHUNK_SIZE = 1000
+u"The default maximum number of nodes re-indexed per transaction."
+
+DEFAULT_TIME_BUDGET = 10.0
+u"The default number of seconds to spend re-indexing per transaction."
+
+_STEP = 100
+
+
+class Job(Persistent):
+    u"""Descendant nodes of a subtree, whose re-indexing was deferred.
+
+    The paths are stored once, in a BTree keyed by position (whose
+    buckets are persistent objects of their own), such that advancing the
+    position of the job with each chunk only writes the job itself.
+
+    :param catalog_path: The physical path of the catalog tool.
+    :param paths: The physical paths of the nodes to re-index.
+    """
+
+    _paths = None
+    _n_paths = None
+    failures = 0
+
+    def __init__(self, catalog_path, paths):
+        self.catalog_path = tuple(catalog_path)
+        self._paths = IOBTree()
+        self._paths.update(list(enumerate(tuple(path) for path in paths)))
+        self._n_paths = len(self._paths)
+        self.position = 0
+        self.created = time.time()
+
+    def __repr__(self):
+        return b'<%s %d/%d>' % (type(self).__name__,
+                                self.position,
+                                self.n_paths)
+
+    @property
+    def paths(self):
+        u"""The physical paths of the nodes to re-index."""
+        if self._paths is None:
+            # Recorded on the job itself by previous versions.
+            return self.__dict__.get(b'paths', ())
+        return tuple(self._paths.values())
+
+    @property
+    def n_paths(self):
+        if self._n_paths is None:
+            return len(self.paths)
+        return self._n_paths
+
+    def slice(self, start, stop):
+        u"""Get the paths from position ``start`` up to ``stop``.
+
+        :rtype: tuple
+        """
+        if self._paths is None:
+            return self.paths[start:stop]
+        return tuple(self._paths.values(start, stop, excludemax=True))
+
+    @property
+    def done(self):
+        return self.position >= self.n_paths
+
+
+class JobQueue(Persistent):
+    u"""A persistent queue of jobs, in order of creation.
+
+    Jobs are keyed by the time of their creation, such that jobs added
+    and removed concurrently do not (usually) conflict.
+    """
+
+    _parked = None
+
+    def __init__(self):
+        self._jobs = LOBTree()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __iter__(self):
+        return iter(self._jobs.values())
+
+    def add(self, job):
+        u"""Append ``job`` to the queue.
+
+        :returns: The key of the job.
+        :rtype: int
+        """
+        key = int(job.created * 1e6)
+        while key in self._jobs:
+            key += 1
+        self._jobs[key] = job
+        return key
+
+    def first(self):
+        u"""Get the oldest job.
+
+        :returns: A pair of the key and the job, or None if the queue
+                  is empty.
+        :rtype: tuple
+        """
+        if not self._jobs:
+            return None
+        key = self._jobs.minKey()
+        return (key, self._jobs[key])
+
+    def remove(self, key):
+        del self._jobs[key]
+
+    def park(self, key):
+        u"""Set aside the job of ``key``, which repeatedly failed.
+
+        Until the job is re-queued, the descendants it records keep the
+        `allowedRolesAndUsers` values indexed before the change, although
+        their nodes have the tokens derived since.
+        """
+        if self._parked is None:
+            self._parked = LOBTree()
+        self._parked[key] = self._jobs.pop(key)
+
+    def parked(self):
+        u"""Get the jobs set aside, in order of creation.
+
+        :returns: Pairs of the key and the job.
+        :rtype: list
+        """
+        if self._parked is None:
+            return []
+        return list(self._parked.items())
+
+    def requeue(self, key):
+        u"""Queue the parked job of ``key`` again, from its position.
+
+        The job keeps its place in the queue, ahead of the jobs created
+        after it, and its failures are forgotten.
+
+        :raises: KeyError
+        """
+        if self._parked is None:
+            raise KeyError(key)
+        job = self._parked.pop(key)
+        job.failures = 0
+        self._jobs[key] = job
+
+    def discard(self, key):
+        u"""Forget the parked job of ``key``.
+
+        The descendants it records are left to be re-indexed otherwise,
+        e.g by `ShadowTreeTool.sync`.
+
+        :raises: KeyError
+        """
+        if self._parked is None:
+            raise KeyError(key)
+        del self._parked[key]
+
+    def progress(self):
+        u"""Get the number of nodes re-indexed, and in total, for all jobs.
+
+        :rtype: tuple
+        """
+        done = total = 0
+        for job in self:
+            done += job.position
+            total += job.n_paths
+        return (done, total)
+
+
+def run_chunk(job, reindex_paths, chunk_size, time_budget, clock=time.time):
+    u"""Re-index the next chunk of the nodes of ``job``.
+
+    Nodes are re-indexed in steps, until ``chunk_size`` nodes are
+    re-indexed, or ``time_budget`` is spent (at least one step is taken).
+    The position of ``job`` is advanced accordingly.
+
+    :param job: The job.
+    :param reindex_paths: A callable re-indexing the nodes of the
+                          physical paths it is passed.
+    :param chunk_size: The maximum number of nodes to re-index.
+    :param time_budget: The number of seconds to spend.
+    :returns: The number of nodes re-indexed.
+    :rtype: int
+    """
+    deadline = clock() + time_budget
+    n_done = 0
+    while not job.done and n_done < chunk_size:
+        step = min(_STEP, chunk_size - n_done)
+        paths = job.slice(job.position, job.position + step)
+        reindex_paths(paths)
+        job.position += len(paths)
+        n_done += len(paths)
+        if clock() >= deadline:
+            break
+    return n_done
+
+
+class Worker(threading.Thread):
+    u"""Processes queued jobs with a dedicated ZODB connection.
+
+    :param db: The ZODB database.
+    :param site_path: The physical path of the Plone site.
+    :param chunk_size: The maximum number of nodes per transaction, or
+                       None for that of the shadow tree tool.
+    :param time_budget: The number of seconds to spend per transaction,
+                        or None for that of the shadow tree tool.
+    :param interval: The number of seconds between polls of the queue,
+                     when run as a thread.
+    :param max_retries: The number of times a chunk is retried upon
+                        a conflict.
+    :param max_failures: The number of times a job may fail (other than
+                         by conflicting) before it is parked.
+    """
+
+    def __init__(self, db, site_path, chunk_size=None, time_budget=None,
+                 interval=10.0, max_retries=3, max_failures=3):
+        super(Worker, self).__init__(name=b'%s.worker' % (__package__,))
+        self.daemon = True
+        self.db = db
+        self.site_path = tuple(site_path)
+        self.chunk_size = chunk_size
+        self.time_budget = time_budget
+        self.interval = interval
+        self.max_retries = max_retries
+        self.max_failures = max_failures
+        self.stats = {b'n_nodes': 0, b'n_chunks': 0, b'n_conflicts': 0,
+                      b'n_failures': 0}
+        self._stopped = threading.Event()
+
+    def stop(self):
+        u"""Stop the thread, after the chunk in progress."""
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.process()
+            except Exception:
+                logger.exception(b'Failed to process deferred jobs.')
+            self._stopped.wait(self.interval)
+
+    def _open_site(self, conn):
+        app = makerequest(conn.root()[b'Application'])
+        site = app.unrestrictedTraverse(self.site_path)
+        setSite(site)
+        return site
+
+    def _close_site(self, site):
+        setSite(None)
+
+    def _get_queue(self, site):
+        return component.getUtility(IShadowTreeTool).jobs
+
+    def _get_settings(self, site):
+        chunk_size = self.chunk_size
+        time_budget = self.time_budget
+        if chunk_size is None or time_budget is None:
+            tool = component.getUtility(IShadowTreeTool)
+            if chunk_size is None:
+                chunk_size = tool.deferred_chunk_size
+            if time_budget is None:
+                time_budget = tool.deferred_time_budget
+        return (max(chunk_size, 1), time_budget)
+
+    def _reindexer(self, site, job):
+        catalog = site.unrestrictedTraverse(job.catalog_path)
+        adapter = component.getMultiAdapter((site, catalog), IObjectSecurity)
+        root = adapter._st_root
+
+        def reindex_paths(paths):
+            nodes = []
+            for path in paths:
+                try:
+                    nodes.append(root.traverse(path))
+                except LookupError:
+                    # Removed since the job was queued.
+                    continue
+            adapter.reindex_nodes(nodes)
+
+        return reindex_paths
+
+    def _process_chunk(self, site, chunk_size, time_budget):
+        u"""Process and commit one chunk, retrying upon conflicts.
+
+        :returns: The number of nodes re-indexed, or None if the queue
+                  is empty or the chunk repeatedly conflicted.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                entry = self._get_queue(site).first()
+                if entry is None:
+                    transaction.abort()
+                    return None
+                (key, job) = entry
+                reindex_paths = self._reindexer(site, job)
+                n_done = run_chunk(job, reindex_paths, chunk_size,
+                                   time_budget)
+                if job.done:
+                    self._get_queue(site).remove(key)
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                self.stats[b'n_conflicts'] += 1
+                logger.info(b'Conflict re-indexing deferred nodes, '
+                            b'attempt %d of %d.',
+                            attempt + 1, self.max_retries + 1)
+                continue
+            except Exception:
+                transaction.abort()
+                logger.exception(b'Failed to re-index deferred nodes.')
+                return self._record_failure(site)
+            logger.info(b'Re-indexed %d deferred nodes of %r.', n_done, job)
+            return n_done
+        logger.warning(b'Giving up re-indexing deferred nodes after %d '
+                       b'conflicts; will retry later.', self.max_retries + 1)
+        return None
+
+    def _record_failure(self, site):
+        u"""Count a failure of the oldest job, parking it if need be.
+
+        :returns: Zero, or None if the failure could not be recorded.
+        """
+        self.stats[b'n_failures'] += 1
+        try:
+            queue = self._get_queue(site)
+            entry = queue.first()
+            if entry is None:
+                transaction.abort()
+                return None
+            (key, job) = entry
+            job.failures += 1
+            if job.failures >= self.max_failures:
+                queue.park(key)
+                logger.error(b'Parked %r after %d failures.',
+                             job, job.failures)
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            return None
+        return 0
+
+    def process(self):
+        u"""Process queued jobs until the queue is empty (or stopped).
+
+        :returns: The number of nodes re-indexed.
+        :rtype: int
+        """
+        conn = self.db.open()
+        site = None
+        total = 0
+        try:
+            site = self._open_site(conn)
+            (chunk_size, time_budget) = self._get_settings(site)
+            while not self._stopped.is_set():
+                n_done = self._process_chunk(site, chunk_size, time_budget)
+                if n_done is None:
+                    break
+                self.stats[b'n_chunks'] += 1
+                self.stats[b'n_nodes'] += n_done
+                total += n_done
+        finally:
+            transaction.abort()
+            if site is not None:
+                self._close_site(site)
+            conn.close()
+        return total
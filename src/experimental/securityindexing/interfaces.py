@@ -9,9 +9,31 @@ class IObjectSecurity(interface.Interface):
 
     catalog_tool = interface.Attribute(u'A plone catalog tool.')
 
+    stats = interface.Attribute(
+        u'A collections.Counter of work done whilst reindexing, '
+        u'e.g the number of nodes processed and objects fetched.'
+    )
+
     def reindex():
         u"""Reindex object security."""
 
+    def reindex_many(objs):
+        u"""Reindex object security of each of `objs` in one combined pass.
+
+        Descendants shared by (nested or duplicate) objects are visited
+        once.
+
+        :param objs: Content items.
+        """
+
+    def reindex_nodes(nodes):
+        u"""Reindex object security of the content items of `nodes`.
+
+        Resumes work deferred by `reindex_many`.
+
+        :param nodes: Shadow tree nodes of descendants of the context.
+        """
+
 
 class IShadowTreeNode(interface.Interface):
     u"""A shadow tree node."""
@@ -24,9 +46,56 @@ class IShadowTreeNode(interface.Interface):
         u'Recorded value of __ac_local_roles_block__'
     )
 
-    token = interface.Attribute(u'A hash of the local roles of a content item')
+    token = interface.Attribute(
+        u'A digest of the local roles token and the View token; '
+        u'nodes sharing a token share an allowedRolesAndUsers value'
+    )
+
+    local_roles_token = interface.Attribute(
+        u'A token derived from the local roles token of the parent node '
+        u'and the local roles of a content item'
+    )
+
+    view_token = interface.Attribute(
+        u'A token derived from the View token of the parent node '
+        u'and the roles granted the View permission on a content item'
+    )
+
+    local_roles_digest = interface.Attribute(
+        u'A stable digest of the local roles assigned directly '
+        u'to a content item'
+    )
+
+    local_roles = interface.Attribute(
+        u'The local roles assigned directly to a content item'
+    )
+
+    view_roles = interface.Attribute(
+        u'The roles granted the View permission on a content item'
+    )
+
+    view_acquired = interface.Attribute(
+        u'Whether the View permission roles of the parent are acquired'
+    )
+
+    view_digest = interface.Attribute(
+        u'A stable digest of the roles granted the View permission '
+        u'on a content item'
+    )
+
+    physical_path = interface.Attribute(
+        u'The value of getPhysicalPath() of a content item, derived from '
+        u'the ids of the node and its ancestors'
+    )
+
+    oid = interface.Attribute(u'Persistent object id of a content item')
 
-    physical_path = interface.Attribute(u'Recorded value of getPhysicalPath()')
+    rid = interface.Attribute(u'Cached catalog record id of a content item')
+
+    n_unshadowed = interface.Attribute(
+        u'The number of items within a content item which have no node '
+        u'(e.g are not cataloged), as last reconciled'
+    )
 
     @interface.invariant
     def contained(node):
@@ -35,32 +104,56 @@ class IShadowTreeNode(interface.Interface):
         if node.__parent__ is None or not node.id:
             raise Invalid(b'A node must be contained within the shadowtree.')
 
-    def create_security_token(obj):
-        u"""Create a security token for `obj`.
+    def create_local_roles_digest(obj):
+        u"""Create a digest of the local roles assigned directly to `obj`.
+
+        :param obj: The content item.
+        :type obj: IContentish
+        :returns: A stable digest of the local roles of `obj`, or None if
+                  `obj` has no local roles of its own.
+        :rtype: int
+        """
 
-        We use the return value of `acl_users._getAllLocalRoles`
-        as for hashing, since its desired to use all parent local roles.
+    def create_view_digest(view_roles, physical_path):
+        u"""Create a digest of the roles granted the View permission.
 
-        `allowedRolesUsers` is not used, as  sometimes the sequence does
-        not contain the full set of local roles, since shortcuts are utilised
-        for certain cases, e.g:
+        :param view_roles: The View roles set upon a content item.
+        :param physical_path: The physical path of the content item.
+        :returns: A stable digest of `view_roles`, or None if there are none.
+        :rtype: int
+        """
 
-          * Anonymous
-          * Authenticated
+    def derive_security_token(parent_token, local_roles_digest, block):
+        u"""Derive a security token from that of the parent node.
 
-        :param obj: The content item.
-        :type obj: IContentish
-        :returns: The hash of the local role information contained by `obj`.
+        :param parent_token: The token of the parent node.
+        :param local_roles_digest: The digest of the node's own local roles.
+        :param block: Whether the node blocks local role inheritance.
+        :returns: The security token.
         :rtype: int
         """
 
-    def descendants(ignore_block=False):
+    def derive_tokens(parent_tokens, local_roles_digest, block,
+                      view_digest, view_acquired):
+        u"""Derive the tokens of a node from those of its parent node.
+
+        :param parent_tokens: The local roles and View tokens of the parent.
+        :returns: The local roles token, View token and security token.
+        :rtype: tuple
+        """
+
+    def descendants(ignore_block=False, order=b'pre-order', batch_size=None):
         u"""Generate descendant nodes.
 
         Optionally yields nodes that have local roles blocked.
 
-        :param ignore_block: If False and a node has block_local_roles setpl
-                             to True, do not descend to any of its children.
+        :param ignore_block: If False and a node has block_local_roles set
+                             to True, neither that node nor any of its
+                             descendants are yielded; its siblings are.
+        :param order: The traversal order (pre-order, breadth-first or
+                      path order).
+        :param batch_size: If given, yield lists of up to ``batch_size``
+                           nodes rather than individual nodes.
         """
 
     def ensure_ancestry_to(obj):
@@ -76,6 +169,22 @@ class IShadowTreeNode(interface.Interface):
         :rtype: experimental.localrolesindex.shadowtree.Node
         """
 
+    def get_local_roles(obj):
+        u"""Get the local roles assigned directly to `obj`.
+
+        :returns: Pairs of principal id and sorted roles.
+        :rtype: tuple
+        """
+
+    def get_view_roles(obj, effective=False):
+        u"""Get the roles granted the View permission on `obj`.
+
+        :param effective: If True, include roles acquired from parents.
+        :returns: A pair of the sorted roles, and whether the roles of
+                  the parent of `obj` are acquired.
+        :rtype: tuple
+        """
+
     def get_local_roles_block(obj):
         u"""Get the value of __ac_local_roles_block__ for the node.
 
@@ -83,6 +192,30 @@ class IShadowTreeNode(interface.Interface):
         :rtype: bool
         """
 
+    def inherit_security_info(obj):
+        u"""Record the security information of a newly added object.
+
+        Objects without security settings of their own share the tokens
+        of the parent node.
+
+        :param obj: The content object.
+        """
+
+    def relocate(parent, id):
+        u"""Re-parent the node, and with it its subtree.
+
+        :param parent: The new parent node.
+        :param id: The new id of the node.
+        """
+
+    def retoken(force=frozenset()):
+        u"""Re-derive the security tokens of descendant nodes.
+
+        :param force: Nodes to treat as changed, whose token was updated
+                      beforehand.
+        :returns: A generator of the descendant nodes whose token changed.
+        """
+
     def traverse(traversable):
         u"""Traverse to a node for the given traversable object.
 
@@ -104,6 +237,19 @@ class IShadowTreeNode(interface.Interface):
 class IShadowTreeRoot(IShadowTreeNode):
     u"""Marker."""
 
+    generation = interface.Attribute(
+        u'The counts of nodes inserted into and deleted from the tree, and '
+        u'of nodes modified; or None if the tree has no counters'
+    )
+
+    n_nodes = interface.Attribute(
+        u'The number of nodes in the tree which have a physical path, '
+        u'counted once per generation, or None'
+    )
+
+    def reset_counters():
+        u"""(Re-)create the counters of the tree from its descendants."""
+
     @interface.invariant
     def no_parent(node):
         if node.__parent__ is not None:
@@ -124,5 +270,144 @@ class IShadowTreeTool(interface.Interface):
 
     root = interface.Attribute(u'The root node of the shadow tree')
 
+    prefetch_depth = interface.Attribute(
+        u'The number of objects to prefetch ahead of their use when '
+        u're-indexing descendants (zero disables prefetching)'
+    )
+
+    calculate_aru = interface.Attribute(
+        u'Whether to calculate the allowedRolesAndUsers values of '
+        u'descendants from the shadow tree, where provably equivalent '
+        u'to those of the indexer'
+    )
+
+    coalesce = interface.Attribute(
+        u'Whether reindexObjectSecurity is deferred until the end of the '
+        u'transaction (or the next catalog search), re-indexing all objects '
+        u'queued in one pass'
+    )
+
+    aru_cache_size = interface.Attribute(
+        u'The maximum number of allowedRolesAndUsers values cached by '
+        u'security token, per process (zero disables the cache)'
+    )
+
+    jobs = interface.Attribute(
+        u'The persistent queue of descendants to be re-indexed by a '
+        u'background worker'
+    )
+
+    self_heal = interface.Attribute(
+        u'Whether nodes missing from the children of the nodes of content '
+        u'loaded whilst re-indexing are created (and stale nodes pruned)'
+    )
+
+    defer_threshold = interface.Attribute(
+        u'The number of descendant nodes above which re-indexing them is '
+        u'deferred to a background worker (zero disables deferral)'
+    )
+
+    deferred_chunk_size = interface.Attribute(
+        u'The maximum number of nodes re-indexed by a background worker '
+        u'per transaction'
+    )
+
+    deferred_time_budget = interface.Attribute(
+        u'The number of seconds a background worker spends re-indexing '
+        u'per transaction'
+    )
+
+    verify_cursor = interface.Attribute(
+        u'The path of the last item verified by an incomplete verification, '
+        u'or None'
+    )
+
+    sync_cursor = interface.Attribute(
+        u'The path of the last item synchronised by an incomplete sync, '
+        u'or None'
+    )
+
     def delete_from_storage(portal):
         u"""Delete the shadowtree root and all it's data from the portal."""
+
+    def rebuild(catalog, processes=None, commit=True):
+        u"""Rebuild the shadow tree, with a pool of worker processes.
+
+        :param catalog: The catalog to obtain content from.
+        :param processes: The number of worker processes.
+        :param commit: If True, commit the transaction after each partition.
+        :returns: The number of nodes recorded.
+        """
+
+    def discrepancies(catalog=None):
+        u"""Generate the paths which are either cataloged or shadowed.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :returns: The path of each, and whether it is cataloged and
+                  whether it is shadowed, in order of path.
+        """
+
+    def generation(catalog=None):
+        u"""Get the generation of the catalog and the shadow tree.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :returns: A tuple which changes whenever either changes, or None.
+        """
+
+    def integrity_info(catalog=None, cached=False, store=True):
+        u"""Count the cataloged and shadowed paths, and those which differ.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :param cached: If True, return the result obtained previously if
+                       the generation has not changed since.
+        :param store: If False, the result is not stored in the database.
+        """
+
+    def probably_integral(catalog=None):
+        u"""Tell whether the shadow tree is probably integral.
+
+        Compares the number of nodes with a path, counted once per
+        generation, with the number of cataloged items. Nothing is stored.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        """
+
+    def repair(catalog, shadow_only=False):
+        u"""Repair the differences between the shadow tree and the catalog.
+
+        Only the paths which differ, and the nodes along or beneath them
+        which lack security info, are loaded from content; orphaned nodes
+        are pruned.
+
+        :param catalog: The catalog to obtain content from.
+        :param shadow_only: If True, catalog entries are not re-indexed.
+        :returns: The number of nodes created, updated, pruned and
+                  re-tokened.
+        """
+
+    def verify(catalog, sample_size=None, batch_size=1000, limit=None,
+               resume=True, commit=True, rng=None):
+        u"""Verify shadow tree nodes and indexed security against content.
+
+        :param catalog: The catalog to obtain content from.
+        :param sample_size: The number of paths to sample, or None to
+                            verify every path, in resumable batches.
+        :param batch_size: The number of paths verified per batch.
+        :param limit: The maximum number of paths to verify, or None.
+        :param resume: If True, resume an incomplete verification.
+        :param commit: If True, commit the transaction after each batch.
+        :param rng: The source of randomness for sampling, or None.
+        :returns: A report of the paths checked and the drift found.
+        """
+
+    def sync(catalog, batch_size=1000, shadow_only=False, resume=True,
+             commit=True):
+        u"""Synchronise security info of site content into the shadow tree.
+
+        :param catalog: The catalog to obtain content from.
+        :param batch_size: The number of items to synchronise per batch.
+        :param shadow_only: If True, catalog entries are not re-indexed.
+        :param resume: If True, resume an incomplete sync.
+        :param commit: If True, commit the transaction after each batch.
+        :returns: The number of items synchronised.
+        """
@@ -4,10 +4,14 @@ from Products.CMFCore.interfaces import ICatalogTool
 from Products.CMFCore.utils import getToolByName
 from zope import component
 
-from .interfaces import IObjectSecurity
+from . import coalescing
+from .interfaces import IObjectSecurity, IShadowTreeTool
 
 
 def _reindex(obj, catalog):
+    if component.getUtility(IShadowTreeTool).coalesce:
+        coalescing.queue(obj, catalog)
+        return
     adapter = component.getMultiAdapter((obj, catalog), IObjectSecurity)
     adapter.reindex()
 
@@ -29,3 +33,8 @@ def dx_reindexObjectSecurity(self):
     if catalog_tool is None:  # pragma: no cover
         return
     _reindex(self, catalog_tool)
+
+
+def searchResults(self, REQUEST=None, **kw):
+    coalescing.flush()
+    return self._old_searchResults(REQUEST, **kw)
@@ -0,0 +1,97 @@
+u"""Prefetch content objects from the ZODB ahead of their use.
+
+Whilst the catalog entries of one group of nodes are being written,
+the object for the next group(s) can be loaded from storage, such that
+the latency of (e.g ZEO) storage round trips overlaps with indexing.
+
+Where the connection supports it (ZODB >= 5), ``Connection.prefetch``
+is used. Otherwise, a background thread loads the records from storage,
+warming the storage cache (e.g the ZEO client cache) from which the
+connection will subsequently load them.
+"""
+from collections import Counter
+import logging
+import threading
+import Queue
+
+
+logger = logging.getLogger(__package__)
+
+_stop = object()
+
+
+class _BackgroundLoader(threading.Thread):
+    u"""Loads object records from storage in a daemon thread."""
+
+    daemon = True
+
+    def __init__(self, storage):
+        super(_BackgroundLoader, self).__init__(name=__name__)
+        self._storage = storage
+        self.queue = Queue.Queue()
+
+    def run(self):
+        load = self._storage.load
+        while True:
+            oid = self.queue.get()
+            if oid is _stop:
+                break
+            try:
+                load(oid, b'')
+            except Exception:
+                # The connection will report any real problem when it
+                # loads the object itself.
+                logger.debug(b'Failed to prefetch %r', oid, exc_info=True)
+
+
+class Prefetcher(object):
+    u"""Looks ahead over a sequence of OIDs, prefetching each.
+
+    :param jar: The ZODB connection from which objects will be loaded.
+    :param oids: The OIDs that will be loaded, in order of loading.
+                 None may be given for positions without an OID.
+    :param depth: The number of OIDs to look ahead by. Zero disables
+                  prefetching.
+    """
+
+    def __init__(self, jar, oids, depth):
+        self._jar = jar
+        self._oids = list(oids)
+        self._requested = 0
+        self._loader = None
+        self.depth = depth
+        self.stats = Counter()
+
+    def _request(self, oids):
+        prefetch = getattr(self._jar, b'prefetch', None)
+        if prefetch is not None:
+            prefetch(oids)
+        else:
+            if self._loader is None:
+                self._loader = _BackgroundLoader(self._jar._storage)
+                self._loader.start()
+            for oid in oids:
+                self._loader.queue.put(oid)
+        self.stats[b'n_prefetched'] += len(oids)
+
+    def advance(self, position):
+        u"""Request the OIDs up to ``depth`` positions after ``position``.
+
+        :param position: The position of the OID about to be loaded.
+        """
+        if not self.depth or self._jar is None:
+            return
+        start = max(self._requested, position + 1)
+        end = min(position + 1 + self.depth, len(self._oids))
+        if start >= end:
+            return
+        self._requested = end
+        oids = [oid for oid in self._oids[start:end] if oid is not None]
+        if oids:
+            self._request(oids)
+
+    def close(self):
+        u"""Stop the background loader, if one was started."""
+        if self._loader is not None:
+            self._loader.queue.put(_stop)
+            self._loader = None
@@ -0,0 +1,477 @@
+u"""Rebuild the shadow tree with a pool of worker processes.
+
+Creating the shadow tree for a large site is CPU-bound on computing the
+security information (digests and tokens) of each content item. A rebuild
+partitions the site by its top-level items. The tokens of a partition
+depend only upon the tokens of the site, which the coordinator computes
+first.
+
+For each partition, the coordinator commits a new, detached node, which
+a worker process fills: it opens its own connection to the database,
+creates a `shadowtree.Node` for each cataloged item of the partition, and
+commits the subtree itself. Workers only write the nodes of their own
+partition, hence do not conflict with each other (other than on the
+counters of the root node, whose conflicts are resolved). Once a worker
+is done, the coordinator links the root node of its partition into the
+shadow tree, replacing that of the previous build, and commits.
+
+Worker processes are new interpreters (run with the ``sys.path`` of the
+coordinator), rather than forks of it: forking a multi-threaded process,
+such as a Zope instance serving requests, copies locks held by other
+threads, which may then never be released in the child. Nonetheless, a
+rebuild is best run out of the instance serving requests, e.g from a
+script run with ``bin/instance run``. Workers must be able to import the
+classes of content (as installed eggs, say).
+
+Workers open the database from a storage specification: the address of
+a ZEO server (see `storage_spec`). Where the storage cannot be opened by
+another process (e.g a FileStorage opened by the coordinator, or a
+DemoStorage), partitions are built in the coordinator's process, with a
+transaction savepoint every ``savepoint_interval`` records, such that the
+nodes created need not all be held in memory.
+"""
+from collections import namedtuple
+from contextlib import closing
+from itertools import chain
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
+import logging
+import os
+import subprocess
+import sys
+
+from Acquisition import aq_base
+from ZODB.DB import DB
+import transaction
+
+from .shadowtree import Node
+
+
+logger = logging.getLogger(__package__)
+
+ZEO_STORAGE = b'zeo'
+u"The kind of storage specification for a ZEO ClientStorage."
+
+_CACHE_GC_INTERVAL = 1000
+
+SAVEPOINT_INTERVAL = 1000
+u"The number of records merged between transaction savepoints."
+
+
+NodeRecord = namedtuple(b'NodeRecord', (
+    b'physical_path',
+    b'oid',
+    b'block_inherit_roles',
+    b'local_roles',
+    b'local_roles_digest',
+    b'view_roles',
+    b'view_acquired',
+    b'view_digest',
+    b'local_roles_token',
+    b'view_token',
+    b'token',
+))
+
+
+_Partition = namedtuple(b'_Partition', (
+    b'spec',
+    b'catalog_path',
+    b'site_path',
+    b'id',
+    b'site_tokens',
+    b'oid',
+))
+
+_WORKER_SCRIPT = b'from %s import main; main()' % (__name__,)
+
+
+def storage_spec(db):
+    u"""Get the specification of a storage which other processes may open.
+
+    :param db: The database.
+    :returns: A pair of the kind of storage, and its address, or None if
+              the storage cannot be opened by another process.
+    :rtype: tuple
+    """
+    try:
+        from ZEO.ClientStorage import ClientStorage
+    except ImportError:  # pragma: no cover
+        return None
+    storage = db.storage
+    if isinstance(storage, ClientStorage):
+        return (ZEO_STORAGE, storage._addr)
+    return None
+
+
+def open_database(spec):
+    u"""Open a database from a storage specification.
+
+    :param spec: A storage specification, as per `storage_spec`.
+    :rtype: ZODB.DB.DB
+    """
+    (kind, location) = spec
+    if kind != ZEO_STORAGE:
+        raise ValueError(b'Unknown kind of storage: %r' % (kind,))
+    from ZEO.ClientStorage import ClientStorage
+    return DB(ClientStorage(location, wait=True))
+
+
+def _partition_paths(uids, path):
+    u"""Generate the cataloged paths of the item at ``path``, and within it.
+
+    The paths are generated in order, hence parents before children.
+    """
+    if path in uids:
+        yield path
+    for key in uids.keys(min=path + b'/', max=path + b'/\xff'):
+        yield key
+
+
+def _any_cataloged(uids, path):
+    return next(_partition_paths(uids, path), None) is not None
+
+
+def _records(app, partition):
+    u"""Generate the records of the cataloged items of ``partition``.
+
+    Records are generated in order, parents first, as they are computed.
+
+    :param app: The root application object.
+    :param partition: The partition.
+    """
+    catalog = app.unrestrictedTraverse(partition.catalog_path)
+    uids = catalog._catalog.uids
+    site_path = tuple(partition.site_path)
+    tokens = {site_path: partition.site_tokens}
+
+    def record(physical_path):
+        obj = app.unrestrictedTraverse(physical_path, None)
+        if obj is None:
+            return
+        parent_path = physical_path[:-1]
+        if parent_path not in tokens and len(parent_path) > len(site_path):
+            # An item which is not cataloged itself, as an ancestor of
+            # one which is, gets its security info as per
+            # `Node.update_security_info`.
+            for parent_record in record(parent_path):
+                yield parent_record
+        block = Node.get_local_roles_block(obj)
+        local_roles = Node.get_local_roles(obj)
+        local_roles_digest = Node.create_local_roles_digest(obj)
+        (view_roles, view_acquired) = Node.get_view_roles(obj)
+        view_digest = Node.create_view_digest(view_roles, physical_path)
+        node_tokens = Node.derive_tokens(
+            tokens.get(parent_path, (None, None)),
+            local_roles_digest,
+            block,
+            view_digest,
+            view_acquired
+        )
+        tokens[physical_path] = node_tokens[:2]
+        yield NodeRecord(physical_path,
+                         getattr(aq_base(obj), b'_p_oid', None),
+                         block,
+                         local_roles,
+                         local_roles_digest,
+                         view_roles,
+                         view_acquired,
+                         view_digest,
+                         *node_tokens)
+
+    path = b'/'.join(site_path + (partition.id,))
+    jar = getattr(aq_base(app), b'_p_jar', None)
+    for (n, key) in enumerate(_partition_paths(uids, path), 1):
+        physical_path = tuple(key.split(b'/'))
+        if physical_path not in tokens:
+            for item_record in record(physical_path):
+                yield item_record
+        if jar is not None and n % _CACHE_GC_INTERVAL == 0:
+            jar.cacheGC()
+
+
+def _merge(top, n_site, records, savepoint_interval):
+    u"""Create a node for each of ``records`` within ``top``.
+
+    :param top: The node of the top-level item of the partition.
+    :param n_site: The number of components of the path of the site,
+                   plus one.
+    :returns: The number of records merged.
+    :rtype: int
+    """
+    n_records = 0
+    for record in records:
+        node = top
+        for comp in record.physical_path[n_site:]:
+            if comp not in node:
+                node[comp] = Node(id=comp, parent=node)
+            node = node[comp]
+        node.physical_path = record.physical_path
+        node.oid = record.oid
+        node.block_inherit_roles = record.block_inherit_roles
+        node.local_roles = record.local_roles
+        node.local_roles_digest = record.local_roles_digest
+        node.view_roles = record.view_roles
+        node.view_acquired = record.view_acquired
+        node.view_digest = record.view_digest
+        node._set_tokens((record.local_roles_token,
+                          record.view_token,
+                          record.token))
+        n_records += 1
+        if savepoint_interval and n_records % savepoint_interval == 0:
+            transaction.savepoint(optimistic=True)
+    return n_records
+
+
+def build_partition(partition, savepoint_interval=SAVEPOINT_INTERVAL):
+    u"""Build the subtree of ``partition``, and commit it.
+
+    The database is opened with its own connection, from the storage
+    specification of the partition. The nodes are created within the
+    (detached) node of the partition's top-level item, committed by the
+    coordinator beforehand.
+
+    :param partition: The partition.
+    :param savepoint_interval: The number of records to merge between
+                               transaction savepoints, or None.
+    :returns: The number of nodes recorded.
+    :rtype: int
+    """
+    db = open_database(partition.spec)
+    try:
+        with closing(db.open()) as conn:
+            app = conn.root()[b'Application']
+            top = conn.get(partition.oid)
+            try:
+                n_records = _merge(top,
+                                   len(partition.site_path) + 1,
+                                   _records(app, partition),
+                                   savepoint_interval)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                raise
+            return n_records
+    finally:
+        db.close()
+
+
+def main():
+    u"""Build the partition read from the standard input.
+
+    This is the entry point of worker processes; the number of nodes
+    recorded is written to the standard output.
+    """
+    logging.basicConfig()
+    partition = pickle.load(sys.stdin)
+    n_records = build_partition(partition)
+    sys.stdout.write(b'%d\n' % (n_records,))
+
+
+def _run_worker(partition):
+    u"""Build ``partition`` in a new worker process, and wait for it.
+
+    :returns: A pair of the partition id and the number of nodes recorded.
+    :rtype: tuple
+    """
+    env = dict(os.environ)
+    env[b'PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    process = subprocess.Popen([sys.executable, b'-c', _WORKER_SCRIPT],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               env=env)
+    (output, _) = process.communicate(pickle.dumps(partition, 2))
+    if process.returncode:
+        raise RuntimeError(b'Building partition %s failed (exit status %d)'
+                           % (partition.id, process.returncode))
+    # Anything written before by the worker is disregarded.
+    return (partition.id, int(output.split()[-1]))
+
+
+def merge_partition(root, site_path, partition_id, records,
+                    savepoint_interval=SAVEPOINT_INTERVAL):
+    u"""Create the subtree of nodes for a partition from its records.
+
+    The subtree replaces that of ``partition_id`` in ``root``, unless
+    there are no records. Records are consumed as they are merged.
+
+    :param root: The root node of the shadow tree.
+    :param site_path: The physical path of the site.
+    :param partition_id: The id of the top-level item of the partition.
+    :param records: The records of the partition, parents first.
+    :param savepoint_interval: The number of records to merge between
+                               transaction savepoints, or None.
+    :returns: The number of records merged.
+    :rtype: int
+    """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return 0
+    top = Node(id=partition_id, parent=root)
+    # Inserted first, such that savepoints store (and the cache may
+    # evict) the nodes merged so far.
+    root[partition_id] = top
+    return _merge(top, len(site_path) + 1, chain([first], records),
+                  savepoint_interval)
+
+
+def rebuild_subtree(root, site, catalog, physical_path,
+                    savepoint_interval=SAVEPOINT_INTERVAL):
+    u"""Rebuild the subtree of the item at ``physical_path``, in process.
+
+    The cataloged paths within the item are streamed from the catalog in
+    order, and the records computed for them replace the subtree of its
+    node as they are computed. The node is removed if the item no longer
+    exists (or neither it nor anything within it is cataloged).
+
+    :param root: The root node of the shadow tree.
+    :param site: The Plone site.
+    :param catalog: The catalog tool.
+    :param physical_path: The physical path of the item.
+    :param savepoint_interval: The number of records to merge between
+                               transaction savepoints, or None.
+    :returns: The number of nodes recorded.
+    :rtype: int
+    """
+    physical_path = tuple(physical_path)
+    if physical_path == site.getPhysicalPath():
+        return rebuild(root, site, catalog, processes=0, commit=False,
+                       savepoint_interval=savepoint_interval)
+    (parent_path, item_id) = (physical_path[:-1], physical_path[-1])
+    app = site.getPhysicalRoot()
+    parent_obj = app.unrestrictedTraverse(parent_path, None)
+    if parent_obj is None:
+        try:
+            parent = root.traverse(parent_path)
+        except LookupError:
+            return 0
+        n_records = 0
+    else:
+        parent = root.ensure_ancestry_to(parent_obj)
+        if parent.token is None:
+            parent.update_security_info(parent_obj)
+        records = _records(app, _Partition(
+            None,
+            catalog.getPhysicalPath(),
+            parent_path,
+            item_id,
+            (parent.local_roles_token, parent.view_token),
+            None
+        ))
+        n_records = merge_partition(parent, parent_path, item_id, records,
+                                    savepoint_interval)
+    if not n_records and item_id in parent:
+        del parent[item_id]
+    return n_records
+
+
+def _save(commit):
+    if commit:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+
+
+def _build_in_workers(root, partitions, processes):
+    u"""Build ``partitions`` in worker processes, linking each when done.
+
+    :returns: The ids of the partitions linked, and the number of nodes
+              recorded.
+    :rtype: tuple
+    """
+    jar = root._p_jar
+    tops = {}
+    for partition in partitions:
+        top = tops[partition.id] = Node(id=partition.id, parent=root)
+        # Stored, although not (yet) reachable, upon commit.
+        jar.add(top)
+    transaction.commit()
+    partitions = [partition._replace(oid=tops[partition.id]._p_oid)
+                  for partition in partitions]
+    linked_ids = set()
+    n_nodes = 0
+    pool = ThreadPool(processes or cpu_count())
+    try:
+        for (partition_id, n_records) in pool.imap_unordered(_run_worker,
+                                                             partitions):
+            # Starts a new transaction, which sees the worker's commit.
+            transaction.begin()
+            if not n_records:
+                continue
+            root[partition_id] = tops[partition_id]
+            transaction.commit()
+            linked_ids.add(partition_id)
+            n_nodes += n_records
+            logger.info(b'Rebuilt the shadow tree of %s (%d nodes).',
+                        partition_id, n_records)
+    finally:
+        pool.terminate()
+        pool.join()
+    return (linked_ids, n_nodes)
+
+
+def rebuild(root, site, catalog, processes=None, spec=None, commit=True,
+            savepoint_interval=SAVEPOINT_INTERVAL):
+    u"""Rebuild the shadow tree, building partitions in parallel.
+
+    :param root: The root node of the shadow tree.
+    :param site: The Plone site.
+    :param catalog: The catalog tool, from which content is obtained.
+    :param processes: The number of worker processes, or None for the
+                      number of CPUs. Zero builds partitions in this
+                      process.
+    :param spec: The storage specification, or None for that of the
+                 database of ``site``.
+    :param commit: If True, commit the transaction after each partition,
+                   otherwise create a savepoint (in which case partitions
+                   are built in this process, since other processes only
+                   see committed state).
+    :param savepoint_interval: The number of records to merge between
+                               transaction savepoints, or None.
+    :returns: The number of nodes recorded.
+    :rtype: int
+    """
+    site_path = site.getPhysicalPath()
+    root.update_security_info(site)
+    site_tokens = (root.local_roles_token, root.view_token)
+    if spec is None:
+        jar = getattr(aq_base(site), b'_p_jar', None)
+        if jar is not None:
+            spec = storage_spec(jar.db())
+    if spec is None or not commit or root._p_jar is None:
+        processes = 0
+    uids = catalog._catalog.uids
+    prefix = b'/'.join(site_path) + b'/'
+    # Items within which nothing is cataloged (e.g tools) are not worth
+    # starting a worker for.
+    partitions = [_Partition(spec,
+                             catalog.getPhysicalPath(),
+                             site_path,
+                             partition_id,
+                             site_tokens,
+                             None)
+                  for partition_id in site.objectIds()
+                  if _any_cataloged(uids, prefix + partition_id)]
+    if processes != 0 and partitions:
+        (linked_ids, n_nodes) = _build_in_workers(root, partitions,
+                                                  processes)
+    else:
+        app = site.getPhysicalRoot()
+        linked_ids = set()
+        n_nodes = 0
+        for partition in partitions:
+            n_records = merge_partition(root, site_path, partition.id,
+                                        _records(app, partition),
+                                        savepoint_interval)
+            if not n_records:
+                continue
+            linked_ids.add(partition.id)
+            n_nodes += n_records
+            _save(commit)
+            logger.info(b'Rebuilt the shadow tree of %s (%d nodes).',
+                        partition.id, n_records)
+    for stale_id in set(root.keys()) - linked_ids:
+        del root[stale_id]
+    _save(commit)
+    return n_nodes
@@ -3,8 +3,44 @@ u"""Manage a shadow tree of nodes maintaining security information.
 A shadow tree mirrors the Portal content tree in a Zope/Plone site,
 each node storing security identifiers in order to enablable
 an index to make decisions when indexing.
+
+Each node records a digest of the local roles assigned directly to its
+content item (``__ac_local_roles__``). The local roles token of a node is
+derived from the local roles token of its parent and its own digest,
+starting afresh at nodes which block the inheritance of local roles.
+Likewise, the View token of a node is derived from the View token of its
+parent and a digest of the roles granted the View permission on its item,
+starting afresh at nodes which do not acquire the permission. The security
+token of a node is a digest of both, hence nodes sharing a security token
+share an `allowedRolesAndUsers` value.
+
+The tokens of a subtree can be re-derived from shadow data alone, in a
+single top-down pass, without loading any content (or consulting
+``acl_users``).
+
+Each node also records its local roles and the roles granted the View
+permission on its content item, such that the `allowedRolesAndUsers`
+value of a node can be calculated from shadow data (see `.aru`).
+
+The root node counts the nodes inserted into the tree, the subtrees
+deleted from it, and the modifications of the security information (or
+location) of nodes, with persistent (conflict resolving) counters.
+Together they form a generation, which changes whenever the tree does.
+Removing (or replacing) a subtree changes only the root's counters, hence
+does not visit the subtree; the number of nodes is counted upon request,
+once per generation (see `Node.n_nodes`).
 """
+from collections import deque
+from itertools import chain
+from operator import attrgetter
+import hashlib
+import struct
+
 import BTrees
+from BTrees.Length import Length
+from AccessControl.Permission import pname
+from AccessControl.PermissionRole import rolesForPermissionOn
+from Acquisition import aq_base, aq_inner, aq_parent
 from persistent import Persistent
 from plone import api
 from zope import interface
@@ -14,6 +50,135 @@ from .interfaces import IShadowTreeNode
 
 _marker = object()
 
+VIEW_PERMISSION = b'View'
+
+_view_permission_id = pname(VIEW_PERMISSION)
+
+PRE_ORDER = b'pre-order'
+u"Visit each node before its children, children in key order."
+
+BREADTH_FIRST = b'breadth-first'
+u"Visit all nodes at one depth before those at the next depth."
+
+PATH_ORDER = b'path-order'
+u"Visit nodes in the (string) order of their paths, as the catalog does."
+
+INSERTS = b'inserts'
+u"The counter of nodes inserted into a shadow tree."
+
+DELETES = b'deletes'
+u"The counter of subtrees deleted from a shadow tree."
+
+MODIFIES = b'modifies'
+u"The counter of modifications of the security info (or paths) of nodes."
+
+_COUNTERS = (INSERTS, DELETES, MODIFIES)
+
+_NO_CHILDREN = BTrees.family64.OO.BTree()
+
+
+def _never(node):
+    return False
+
+
+def _pre_order(node, prune):
+    stack = [iter(node.values())]
+    while stack:
+        child = next(stack[-1], _marker)
+        if child is _marker:
+            stack.pop()
+        elif not prune(child):
+            yield child
+            stack.append(iter(child.values()))
+
+
+def _breadth_first(node, prune):
+    queue = deque([node])
+    while queue:
+        for child in queue.popleft().values():
+            if not prune(child):
+                yield child
+                queue.append(child)
+
+
+def _path_frame(node):
+    items = iter(node.items())
+    return [items, next(items, _marker), []]
+
+
+def _path_order(node, prune):
+    # The subtree of a child sorts after siblings whose ids extend the
+    # child's id with a character preceding '/' (e.g 'a-1' for 'a'), hence
+    # is pending until the next sibling's id exceeds the child's id + '/'.
+    # Subtrees pending at one level form a stack, in order.
+    stack = [_path_frame(node)]
+    while stack:
+        frame = stack[-1]
+        (items, item, pending) = frame
+        if pending and (item is _marker or pending[-1][0] < item[0]):
+            stack.append(_path_frame(pending.pop()[1]))
+        elif item is _marker:
+            stack.pop()
+        else:
+            frame[1] = next(items, _marker)
+            (key, child) = item
+            if not prune(child):
+                yield child
+                pending.append((key + b'/', child))
+
+
+def _batched(nodes, size):
+    batch = []
+    for node in nodes:
+        batch.append(node)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_traversals = {
+    PRE_ORDER: _pre_order,
+    BREADTH_FIRST: _breadth_first,
+    PATH_ORDER: _path_order
+}
+
+
+def _new_counters():
+    return {name: Length() for name in _COUNTERS}
+
+
+def _count_nodes(node):
+    return 1 + sum(1 for _ in _pre_order(node, _never))
+
+
+def _count_located(node):
+    return sum(1 for descendant in _pre_order(node, _never)
+               if descendant.physical_path is not None)
+
+
+def _encode(value):
+    if value is None:
+        return b''
+    if isinstance(value, unicode):
+        return value.encode(b'utf-8')
+    return bytes(value)
+
+
+def digest(*parts):
+    u"""Create a stable 64 bit digest of ``parts``.
+
+    Unlike the builtin ``hash``, the digest is the same in every process
+    (irrespective of hash randomisation) and on every platform.
+
+    :param parts: Strings, integers or None.
+    :returns: A signed 64 bit integer.
+    :rtype: int
+    """
+    encoded = b'\x1e'.join(_encode(part) for part in parts)
+    return struct.unpack(b'>q', hashlib.sha1(encoded).digest()[:8])[0]
+
 
 @interface.implementer(IShadowTreeNode)
 class Node(Persistent):
@@ -25,20 +190,54 @@ class Node(Persistent):
     id = None
     block_inherit_roles = False
     token = None
-    physical_path = None
+    local_roles_token = None
+    view_token = None
+    local_roles_digest = None
+    view_digest = None
+    local_roles = None
+    view_roles = None
+    view_acquired = None
+    oid = None
+    rid = None
+    n_unshadowed = 0
+    _counters = None
+    _data = None
+    _family = BTrees.family64
+    _located = False
+    _root_path = None
+    _paths_derived = False
+    _v_n_nodes = None
 
     def __init__(self, id=b'', parent=None, family=BTrees.family64):
         super(Node, self).__init__()
-        self._data = family.OO.BTree()
+        if family is not self._family:
+            self._family = family
         self.id = id
         self.__parent__ = parent
+        if parent is None:
+            self._counters = _new_counters()
+            self._paths_derived = True
         interface.alsoProvides(self, BTrees.Interfaces.IBTree)
 
     def __repr__(self):  # pragma: no cover
         return b'%s("%s")' % (type(self).__name__, self.id)
 
+    def _children(self, create=False):
+        u"""Get the container of child nodes.
+
+        Most nodes are leaves, hence the container is only created (as
+        another persistent object) when the first child is added.
+        Until then, an empty container shared by all nodes is returned.
+        """
+        data = self._data
+        if data is None:
+            if not create:
+                return _NO_CHILDREN
+            data = self._data = self._family.OO.BTree()
+        return data
+
     def __getattr__(self, name):
-        value = getattr(self._data, name, _marker)
+        value = getattr(self._children(), name, _marker)
         if value is _marker:
             raise AttributeError(
                 b'%r object has no attribute %r' % (
@@ -49,22 +248,58 @@ class Node(Persistent):
         return value
 
     def __contains__(self, key):
-        return key in self._data
+        return key in self._children()
 
     def __setitem__(self, name, value):
-        self._data[name] = value
+        data = self._children(create=True)
+        replaced = data.get(name)
+        if replaced is value:
+            return
+        if replaced is not None:
+            self._count(DELETES)
+        data[name] = value
+        self._count(INSERTS)
+
+    def insert(self, name, value):
+        u"""Add ``value`` as the child ``name``, unless there is one.
+
+        :returns: 1 if added, otherwise 0 (as ``BTree.insert``).
+        """
+        if name in self:
+            return 0
+        self[name] = value
+        return 1
+
+    def setdefault(self, name, default):
+        u"""Get the child ``name``, adding ``default`` if there is none."""
+        child = self._children().get(name)
+        if child is None:
+            self[name] = child = default
+        return child
+
+    def update(self, children):
+        u"""Add (or replace) children, from a mapping or pairs."""
+        items = getattr(children, b'items', None)
+        for (name, value) in (children if items is None else items()):
+            self[name] = value
 
     def __getitem__(self, name):
-        return self._data[name]
+        return self._children()[name]
 
     def __delitem__(self, name):
-        del self._data[name]
+        del self._children()[name]
+        self._count(DELETES)
+
+    def clear(self):
+        if self._data is not None and len(self._data):
+            self._count(DELETES, len(self._data))
+            self._data.clear()
 
     def __len__(self):
-        return len(self._data)
+        return len(self._children())
 
     def __iter__(self):
-        return iter(self._data)
+        return iter(self._children())
 
     def __bool__(self):
         return True
@@ -84,30 +319,319 @@ class Node(Persistent):
         portal_path_idx += 1
         return tuple(path_components[portal_path_idx:])
 
+    @staticmethod
+    def get_local_roles(obj):
+        u"""Get the local roles assigned directly to ``obj``.
+
+        Unlike `acl_users._getAllLocalRoles`, local roles acquired from
+        the parents of ``obj`` are not included.
+
+        :param obj: The content item.
+        :type obj: IContentish
+        :returns: Pairs of principal id and sorted roles, sorted by
+                  principal id. Principals without any roles are omitted.
+        :rtype: tuple
+        """
+        local_roles = getattr(aq_base(obj), b'__ac_local_roles__', None)
+        if callable(local_roles):
+            local_roles = local_roles()
+        return tuple(sorted(
+            (principal, tuple(sorted(roles)))
+            for (principal, roles) in (local_roles or {}).items()
+            if roles
+        ))
+
     @classmethod
-    def create_security_token(cls, obj):
-        u"""Create a security token for ``obj``.
+    def create_local_roles_digest(cls, obj):
+        u"""Create a digest of the local roles assigned directly to ``obj``.
 
-        We use the return value of `acl_users._getAllLocalRoles`
-        as for hashing, since its desired to use all parent local roles.
+        :param obj: The content item.
+        :type obj: IContentish
+        :returns: A stable digest of the local roles of ``obj``, which does
+                  not depend upon the order in which they were assigned, or
+                  None if ``obj`` has no local roles of its own.
+        :rtype: int
+        """
+        local_roles = cls.get_local_roles(obj)
+        if not local_roles:
+            return None
+        return digest(*(
+            b'\x1f'.join(map(_encode, (principal,) + roles))
+            for (principal, roles) in local_roles
+        ))
 
-        ``allowedRolesUsers`` is not used, as  sometimes the sequence does
-        not contain the full set of local roles, since shortcuts are utilised
-        for certain cases, e.g:
+    @staticmethod
+    def get_view_roles(obj, effective=False):
+        u"""Get the roles granted the View permission on ``obj``.
 
-          * Anonymous
-          * Authenticated
+        Unlike `rolesForPermissionOn`, only the roles set upon ``obj``
+        itself are included, unless ``effective`` is True.
 
         :param obj: The content item.
         :type obj: IContentish
-        :returns: The hash of the local role information contained by ``obj``.
+        :param effective: If True, get the roles as per
+                          `rolesForPermissionOn` (i.e including those
+                          acquired), as is done for the root node.
+        :returns: A pair of the sorted roles, and whether the roles of
+                  the parent of ``obj`` are acquired. The roles are None
+                  if they cannot be determined (the permission is mapped
+                  to another).
+        :rtype: tuple
+        """
+        if effective:
+            roles = rolesForPermissionOn(VIEW_PERMISSION, obj)
+            return (tuple(sorted(roles)), False)
+        roles = getattr(aq_base(obj), _view_permission_id, _marker)
+        if roles is _marker:
+            return ((), True)
+        if roles is None:
+            return ((b'Anonymous',), False)
+        if isinstance(roles, basestring):
+            return (None, False)
+        return (tuple(sorted(roles)), not isinstance(roles, tuple))
+
+    @staticmethod
+    def create_view_digest(view_roles, physical_path):
+        u"""Create a digest of the roles granted the View permission.
+
+        :param view_roles: The View roles set upon a content item, as
+                           returned by `get_view_roles`.
+        :param physical_path: The physical path of the content item.
+        :returns: A stable digest of ``view_roles``, or None if there are
+                  none. Where the roles cannot be determined, the digest is
+                  that of ``physical_path``, such that the node never shares
+                  a token with another.
         :rtype: int
         """
-        acl_users = api.portal.get_tool(name=b'acl_users')
-        ac_local_roles = acl_users._getAllLocalRoles(obj)
-        local_roles = tuple((k, frozenset(v))
-                            for (k, v) in ac_local_roles.items())
-        return hash(local_roles)
+        if view_roles is None:
+            return digest(b'/'.join(physical_path))
+        if not view_roles:
+            return None
+        return digest(*view_roles)
+
+    @staticmethod
+    def derive_security_token(parent_token, local_roles_digest, block):
+        u"""Derive a token from that of the parent node.
+
+        A node without local roles of its own shares the token of its
+        parent, unless it blocks the inheritance of local roles, in which
+        case the parent token is disregarded.
+
+        View tokens are derived in the same way, from the View digest, where
+        a node which does not acquire the View permission "blocks".
+
+        :param parent_token: The token of the parent node.
+        :param local_roles_digest: The digest of the node's own local roles.
+        :param block: Whether the node blocks local role inheritance.
+        :returns: The security token.
+        :rtype: int
+        """
+        if block:
+            parent_token = None
+        elif local_roles_digest is None and parent_token is not None:
+            return parent_token
+        return digest(parent_token, local_roles_digest)
+
+    @classmethod
+    def derive_tokens(cls, parent_tokens, local_roles_digest, block,
+                      view_digest, view_acquired):
+        u"""Derive the tokens of a node from those of its parent.
+
+        :param parent_tokens: The local roles token and View token of the
+                              parent node.
+        :param local_roles_digest: The digest of the node's own local roles.
+        :param block: Whether the node blocks local role inheritance.
+        :param view_digest: The digest of the node's own View roles.
+        :param view_acquired: Whether the node acquires the View roles of
+                              its parent.
+        :returns: The local roles token, View token and security token.
+        :rtype: tuple
+        """
+        derive = cls.derive_security_token
+        local_roles_token = derive(parent_tokens[0], local_roles_digest,
+                                   block)
+        # Nodes recorded before View roles were are treated as acquiring.
+        view_token = derive(parent_tokens[1], view_digest,
+                            view_acquired is False)
+        token = digest(local_roles_token, view_token)
+        return (local_roles_token, view_token, token)
+
+    def _derive_tokens(self):
+        parent = self.__parent__
+        if parent is None:
+            parent_tokens = (None, None)
+        else:
+            parent_tokens = (parent.local_roles_token, parent.view_token)
+        return self.derive_tokens(parent_tokens,
+                                  self.local_roles_digest,
+                                  self.block_inherit_roles,
+                                  self.view_digest,
+                                  self.view_acquired)
+
+    def _set_tokens(self, tokens):
+        (self.local_roles_token, self.view_token, self.token) = tokens
+
+    def _get_root(self):
+        node = self
+        while node.__parent__ is not None:
+            node = node.__parent__
+        return node
+
+    def _path_ids(self):
+        ids = []
+        node = self
+        while node.__parent__ is not None:
+            ids.append(node.id)
+            node = node.__parent__
+        ids.reverse()
+        return (node, tuple(ids))
+
+    def _derived_path(self):
+        (root, ids) = self._path_ids()
+        root_path = root._root_path
+        if root_path is None:
+            # Recorded on the root by previous versions.
+            root_path = root.__dict__.get(b'physical_path')
+        if root_path is None:
+            return None
+        return tuple(root_path) + ids
+
+    @property
+    def physical_path(self):
+        u"""The physical path of the content item of this node.
+
+        Only the root node records a path (that of the site); the paths of
+        other nodes are derived from the ids of their ancestors, hence
+        re-parenting a node relocates its whole subtree. A path which
+        cannot be derived (e.g the root node has none) is recorded on the
+        node, as previous versions did for every node.
+
+        None until the security information of an item is recorded.
+        """
+        if not self._located:
+            return self.__dict__.get(b'physical_path')
+        (root, ids) = self._path_ids()
+        return root._root_path + ids
+
+    @physical_path.setter
+    def physical_path(self, physical_path):
+        self._p_activate()
+        located = (self._located or
+                   self.__dict__.get(b'physical_path') is not None)
+        self._set_physical_path(physical_path)
+        if located != (physical_path is not None):
+            # The number of nodes with a path changes.
+            self._count(MODIFIES)
+
+    def _set_physical_path(self, physical_path):
+        recorded = self.__dict__.pop(b'physical_path', None)
+        if physical_path is None:
+            if recorded is not None:
+                self._p_changed = True
+            if self._located:
+                self._located = False
+            return
+        physical_path = tuple(physical_path)
+        if self.__parent__ is None:
+            if self._root_path != physical_path:
+                self._root_path = physical_path
+        elif (self._get_root()._root_path is None or
+              self._derived_path() != physical_path):
+            self.__dict__[b'physical_path'] = physical_path
+            self._p_changed = True
+            if self._located:
+                self._located = False
+            return
+        if recorded is not None:
+            self._p_changed = True
+        if not self._located:
+            self._located = True
+
+    def _rewrite_recorded_paths(self):
+        u"""Re-derive the paths recorded on the nodes of this subtree."""
+        for node in chain([self], self.descendants(ignore_block=True)):
+            if node._located:
+                continue
+            if node.__dict__.get(b'physical_path') is None:
+                continue
+            physical_path = node._derived_path()
+            if physical_path is not None:
+                node.physical_path = physical_path
+
+    def relocate(self, parent, id):
+        u"""Re-parent this node, and with it its subtree.
+
+        Since the paths of descendants are derived, only this node, its old
+        parent and its new parent are modified, whatever the size of the
+        subtree. The paths recorded on the nodes of trees created by
+        previous versions (until upgraded) are rewritten, visiting the
+        subtree. The tokens of the subtree are not re-derived (see
+        `retoken`).
+
+        :param parent: The new parent node.
+        :param id: The new id of this node.
+        """
+        old_parent = self.__parent__
+        if (old_parent is not None and
+                old_parent._children().get(self.id) is self):
+            del old_parent._data[self.id]
+        data = parent._children(create=True)
+        replaced = data.get(id)
+        if replaced is not None and replaced is not self:
+            self._count(DELETES)
+        data[id] = self
+        self.__parent__ = parent
+        self.id = id
+        if not self._get_root()._paths_derived:
+            self._rewrite_recorded_paths()
+        # The generation changes, though no node is inserted.
+        self._count(MODIFIES)
+
+    def _count(self, name, n=1):
+        counters = self._get_root()._counters
+        if counters is not None:
+            counters[name].change(n)
+
+    def reset_counters(self):
+        u"""(Re-)create the counters of this root node.
+
+        The count of nodes inserted is that of the current descendants.
+        Shadow trees created by previous versions have no counters.
+        """
+        counters = _new_counters()
+        counters[INSERTS].set(_count_nodes(self) - 1)
+        self._counters = counters
+
+    @property
+    def generation(self):
+        u"""The counts of nodes inserted, subtrees deleted and modifications.
+
+        None if the tree has no counters.
+        """
+        counters = self._get_root()._counters
+        if counters is None:
+            return None
+        return tuple(counters[name]() for name in _COUNTERS)
+
+    @property
+    def n_nodes(self):
+        u"""The number of nodes in the tree which have a physical path.
+
+        Intermediate nodes, whose items' security information has not been
+        recorded, are not counted (as their items are not cataloged). The
+        nodes are counted by visiting the tree, at most once per generation
+        in each process.
+
+        None if the tree has no counters.
+        """
+        root = self._get_root()
+        generation = root.generation
+        if generation is None:
+            return None
+        cached = root._v_n_nodes
+        if cached is None or cached[0] != generation:
+            cached = root._v_n_nodes = (generation, _count_located(root))
+        return cached[1]
 
     @staticmethod
     def get_local_roles_block(obj):
@@ -125,6 +649,8 @@ class Node(Persistent):
                   component of ``obj.getPhysicalPath()``.
         :rtype: experimental.localrolesindex.shadowtree.Node
         """
+        if self.__parent__ is None and self._root_path is None:
+            self._root_path = tuple(api.portal.get().getPhysicalPath())
         node = self
         cls = type(self)
         for comp in self._get_path_components(obj):
@@ -140,27 +666,125 @@ class Node(Persistent):
     def update_security_info(self, obj):
         u"""Update the security information for an object.
 
+        Ancestor nodes lacking security information are updated first,
+        from the acquisition parents of ``obj``.
+
         :param obj: The portal content object.
         :type obj: Products.CMFCore.PortalContent
         """
-        self.physical_path = obj.getPhysicalPath()
+        physical_path = obj.getPhysicalPath()
+        parent = self.__parent__
+        # Nodes created before View roles were recorded have a token,
+        # but no value for view_acquired.
+        if parent is not None and (parent.token is None or
+                                   parent.view_acquired is None):
+            parent_obj = aq_parent(aq_inner(obj))
+            if (parent_obj is not None and
+                    parent_obj.getPhysicalPath() == physical_path[:-1]):
+                parent.update_security_info(parent_obj)
+        self.physical_path = physical_path
+        self.oid = getattr(aq_base(obj), b'_p_oid', None)
         self.block_inherit_roles = self.get_local_roles_block(obj)
-        self.token = self.create_security_token(obj)
+        self.local_roles_digest = self.create_local_roles_digest(obj)
+        self.local_roles = self.get_local_roles(obj)
+        (self.view_roles, self.view_acquired) = self.get_view_roles(
+            obj,
+            effective=parent is None
+        )
+        self.view_digest = self.create_view_digest(self.view_roles,
+                                                   physical_path)
+        self._set_tokens(self._derive_tokens())
+        self._count(MODIFIES)
+
+    def inherit_security_info(self, obj):
+        u"""Record the security information of a newly added object.
+
+        An object without local roles of its own, which neither blocks the
+        inheritance of local roles nor sets the View permission, shares
+        the tokens of its parent node, which are copied rather than
+        derived. Otherwise, as per `update_security_info`.
 
-    def descendants(self, ignore_block=False):
+        :param obj: The portal content object.
+        :type obj: Products.CMFCore.PortalContent
+        """
+        parent = self.__parent__
+        local_roles = self.get_local_roles(obj)
+        view = self.get_view_roles(obj)
+        if (parent is None or parent.token is None or
+                parent.view_acquired is None or local_roles or
+                view != ((), True) or self.get_local_roles_block(obj)):
+            self.update_security_info(obj)
+            return
+        self.physical_path = obj.getPhysicalPath()
+        self.oid = getattr(aq_base(obj), b'_p_oid', None)
+        self.block_inherit_roles = False
+        self.local_roles_digest = None
+        self.local_roles = local_roles
+        (self.view_roles, self.view_acquired) = view
+        self.view_digest = None
+        self._set_tokens((parent.local_roles_token,
+                          parent.view_token,
+                          parent.token))
+        self._count(MODIFIES)
+
+    def retoken(self, force=frozenset()):
+        u"""Re-derive the security tokens of descendant nodes.
+
+        This is done in a single top-down pass, from shadow data alone.
+        Subtrees whose root token is unchanged are not visited, since
+        the tokens within them cannot have changed either.
+
+        :param force: Nodes whose token was updated beforehand, hence which
+                      are yielded, and whose subtrees are visited, even
+                      if their token is unchanged.
+        :returns: A generator of the descendant nodes whose token changed.
+        """
+        counters = self._get_root()._counters
+        stack = [iter(self.values())]
+        while stack:
+            node = next(stack[-1], _marker)
+            if node is _marker:
+                stack.pop()
+                continue
+            tokens = node._derive_tokens()
+            if tokens[-1] == node.token and node not in force:
+                continue
+            node._set_tokens(tokens)
+            if counters is not None:
+                counters[MODIFIES].change(1)
+            if node.physical_path is not None:
+                yield node
+            stack.append(iter(node.values()))
+
+    def descendants(self, ignore_block=False, order=PRE_ORDER,
+                    batch_size=None):
         u"""Generates descendant nodes.
 
         Optionally yields nodes that have local roles blocked.
 
-        :param ignore_block: If False and a node has block_local_roles setpl
-                             to True, do not descend to any of its children.
+        Traversal uses an explicit stack (or queue), such that the cost
+        of yielding each node does not depend upon its depth.
+
+        :param ignore_block: If False and a node has block_local_roles set
+                             to True, neither that node nor any of its
+                             descendants are yielded; its siblings are.
+        :param order: One of ``PRE_ORDER``, ``BREADTH_FIRST`` or
+                      ``PATH_ORDER``.
+        :param batch_size: If given, yield lists of up to ``batch_size``
+                           nodes rather than individual nodes.
+        :raises: ValueError if ``order`` is not a known traversal order.
         """
-        for node in self.values():
-            if node.block_inherit_roles and not ignore_block:
-                break
-            yield node
-            for descendant in node.descendants(ignore_block=ignore_block):
-                yield descendant
+        traversal = _traversals.get(order)
+        if traversal is None:
+            raise ValueError(b'Unknown traversal order: %r' % (order,))
+        if ignore_block:
+            prune = _never
+        else:
+            prune = attrgetter(b'block_inherit_roles')
+        nodes = traversal(self, prune)
+        if batch_size is not None:
+            return _batched(nodes, batch_size)
+        return nodes
 
     def traverse(self, traversable):
         """Traverse to a node for the given traversable object.
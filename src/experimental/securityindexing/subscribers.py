@@ -1,13 +1,60 @@
+from Products.Archetypes.utils import isFactoryContained
 from plone import api
 
+from . import bulk, coalescing
 from .interfaces import IShadowTreeTool
 
 
-def _shadowtree_node_for_content(obj):
+def _shadowtree_root():
     portal = api.portal.get()
     site = portal.getSiteManager()
-    root = site.getUtility(IShadowTreeTool).root
-    return root.ensure_ancestry_to(obj)
+    return site.getUtility(IShadowTreeTool).root
+
+
+def _relocate(root, old_path, event):
+    u"""Re-parent the node of the object moved, with its subtree.
+
+    :returns: The node, or None if there is none at ``old_path`` (e.g it
+              has already been relocated).
+    """
+    try:
+        node = root.traverse(old_path)
+    except LookupError:
+        return None
+    node.relocate(root.ensure_ancestry_to(event.newParent), event.newName)
+    node.update_security_info(event.object)
+    # The tokens of the subtree depend upon those of its new ancestors.
+    for _ in node.retoken():
+        pass
+    return node
+
+
+def on_object_will_be_moved(obj, event):
+    u"""Re-index queued object security before ``obj`` is moved or removed.
+
+    :param obj: The content object.
+    :param event: The event.
+    """
+    if event.oldParent is not None:
+        coalescing.flush()
+
+
+def on_object_added(obj, event):
+    u"""Create the ``shadow tree`` node of ``obj`` as it is added.
+
+    The event is dispatched to every item within the object added (e.g
+    a pasted copy of a folder), each of which gets a node, such that the
+    shadow tree need not be synchronised with the catalog.
+
+    :param obj: The content object.
+    :param event: The event.
+    """
+    if isFactoryContained(obj):  # pragma: no cover
+        return
+    if bulk.touch(event.object.getPhysicalPath()):
+        return
+    node = _shadowtree_root().ensure_ancestry_to(obj)
+    node.inherit_security_info(obj)
 
 
 def on_object_moved(obj, event):
@@ -19,26 +66,49 @@ def on_object_moved(obj, event):
     is fired upon object creation and deletion in addition
     to when an object is moved or renamed.
 
-    This handler handles creation, moving and renaming.
+    This handler handles moving and renaming (see `on_object_added` and
+    `on_object_removed` for creation and deletion). The node of the object
+    moved is re-parented with its subtree, whose paths are derived, such
+    that the events dispatched to each item within the object moved
+    find their node relocated already.
 
     :param obj: The content object.
     :param event: The event.
     """
-    if event.oldParent and event.newParent:
-        old = _shadowtree_node_for_content(event.oldParent)
-        del old[event.oldName]
-        node = _shadowtree_node_for_content(event.object)
+    if event.oldParent is None or event.newParent is None:
+        return
+    old_path = event.oldParent.getPhysicalPath() + (event.oldName,)
+    if bulk.touch(old_path):
+        bulk.touch(event.object.getPhysicalPath())
+        return
+    root = _shadowtree_root()
+    _relocate(root, old_path, event)
+    try:
+        root.traverse(obj.getPhysicalPath())
+    except LookupError:
+        # The shadow tree lacked the node at the old path.
+        node = root.ensure_ancestry_to(obj)
         node.update_security_info(obj)
 
 
 def on_object_removed(obj, event):
-    u"""Synchronise current security info of ``obj`` to a
-    corresponding``shadow tree` node.
+    u"""Remove the ``shadow tree`` node of ``obj``, with its subtree.
+
+    The event is dispatched to every item within the object removed,
+    whose nodes are dropped along with that of the object removed, hence
+    the events of those items are ignored.
 
     :param obj: The content object.
     :param event: The event.
     """
-    node = _shadowtree_node_for_content(obj)
-    parent = node.__parent__
-    if parent is not None and obj.getId() in parent:
-        del parent[obj.getId()]
+    if obj is not event.object:
+        return
+    old_parent_path = event.oldParent.getPhysicalPath()
+    if bulk.touch(old_parent_path + (event.oldName,)):
+        return
+    try:
+        parent = _shadowtree_root().traverse(old_parent_path)
+    except LookupError:
+        return
+    if event.oldName in parent:
+        del parent[event.oldName]
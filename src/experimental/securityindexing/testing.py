@@ -5,6 +5,7 @@ from zope import component
 import plone.api as api
 import plone.app.testing as pa_testing
 
+from . import coalescing
 from .interfaces import IShadowTreeTool
 
 
@@ -70,6 +71,8 @@ class TestCaseMixin(object):
         if block is not _marker:
             folder.__ac_local_roles_block__ = block
         folder.reindexObject()
+        # As upon committing the transaction which created the folder.
+        coalescing.flush()
         self.folders_by_path[path] = folder
 
     def _get_shadowtree_root(self):
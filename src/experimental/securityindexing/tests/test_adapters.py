@@ -1,12 +1,15 @@
 import unittest
 
+from Acquisition import aq_base
 from plone import api
+from zope import component
 from zope.interface.verify import verifyObject, verifyClass
 import plone.app.testing as pa_testing
+import transaction
 
 from . import dx
-from .. import testing
-from ..interfaces import IObjectSecurity
+from .. import coalescing, testing
+from ..interfaces import IObjectSecurity, IShadowTreeTool
 
 
 class ObjectSecurityTestsMixin(testing.TestCaseMixin):
@@ -42,6 +45,25 @@ class ObjectSecurityTestsMixin(testing.TestCaseMixin):
                     for brain in brains)
         self._check_paths_equal(paths, expected_paths)
 
+    def _indexed_values(self):
+        index = self.catalog._catalog.getIndex(b'allowedRolesAndUsers')
+        return {
+            path: set(index.getEntryForObject(
+                self.catalog.getrid(b'/'.join(folder.getPhysicalPath()))
+            ))
+            for (path, folder) in self.folders_by_path.items()
+        }
+
+    def _check_index_matches_rebuild(self):
+        indexed = self._indexed_values()
+        self.catalog.clearFindAndRebuild()
+        self.assertEqual(indexed, self._indexed_values())
+
+    def _disable_calculation(self):
+        tool = aq_base(component.getUtility(IShadowTreeTool))
+        tool.calculate_aru = False
+        self.addCleanup(delattr, tool, b'calculate_aru')
+
     def _populate(self):
         self.folders_by_path.clear()
         st_root = self._get_shadowtree_root()
@@ -116,6 +138,167 @@ class ObjectSecurityTestsMixin(testing.TestCaseMixin):
             for b in self.catalog.unrestrictedSearchResults(path=b'/plone/a')
         })
 
+    def test_reindex_fetches_one_object_per_token(self):
+        self._populate()
+        self._disable_calculation()
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        node = self._get_shadowtree_root().ensure_ancestry_to(obj)
+        nodes = [node] + list(node.descendants(ignore_block=False))
+        other_tokens = {n.token for n in nodes} - {node.token}
+        self.assertEqual(adapter.stats[b'n_nodes'], len(nodes))
+        self.assertEqual(adapter.stats[b'n_fetched'], len(other_tokens))
+
+    def test_reindex_calculates_aru_from_shadowtree(self):
+        self._private_content_with_default_workflow()
+        pa_testing.login(self.portal, pa_testing.TEST_USER_NAME)
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_fetched'], 0)
+        self.assertTrue(adapter.stats[b'n_calculated'])
+        self._check_index_matches_rebuild()
+
+    def test_reindex_uses_aru_cache(self):
+        from ..aru import cache
+        self._populate()
+        self._disable_calculation()
+        cache.clear()
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        self._make_one(obj, self.catalog).reindex()
+        api.user.revoke_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        self._make_one(obj, self.catalog).reindex()
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_fetched'], 0)
+        self.assertTrue(adapter.stats[b'n_cache_hits'])
+        self.assertEqual(adapter.stats[b'n_cache_misses'], 0)
+        self.assertTrue(cache.hits)
+
+    def test_reindex_many_walks_descendants_once(self):
+        self._populate()
+        objs = [self.folders_by_path[path]
+                for path in (b'/a/b/c', b'/a', b'/a/b/c/e', b'/a')]
+        for obj in objs:
+            api.user.grant_roles(username=b'guido', obj=obj,
+                                 roles=[b'Reader'])
+        adapter = self._make_one(objs[0], self.catalog)
+        adapter.reindex_many(objs)
+        self.assertEqual(adapter.stats[b'n_subtree_reindexes'], 1)
+        self.assertEqual(adapter.stats[b'n_nodes'], len(self.folders_by_path))
+        self._check_index_matches_rebuild()
+
+    def test_reindex_heals_missing_nodes(self):
+        from ..shadowtree import Node
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        b_node = st_root.traverse(b'/plone/a/b')
+        del b_node[b'c']
+        stale = b_node[b'gone'] = Node(id=b'gone', parent=b_node)
+        stale.physical_path = b_node.physical_path + (b'gone',)
+        obj = self.folders_by_path[b'/a/b']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_healed'], 6)
+        self.assertEqual(adapter.stats[b'n_pruned'], 1)
+        self.assertNotIn(b'gone', b_node)
+        self._check_shadowtree_integrity()
+        self._check_shadowtree_nodes_have_security_info()
+        self._check_index_matches_rebuild()
+
+    def test_reindex_prunes_nodes_of_removed_content(self):
+        from ..shadowtree import Node
+        self._populate()
+        self._disable_calculation()
+        a_node = self._get_shadowtree_root().traverse(b'/plone/a')
+        ghost = a_node[b'ghost'] = Node(id=b'ghost', parent=a_node)
+        ghost.physical_path = a_node.physical_path + (b'ghost',)
+        # A distinct digest puts the ghost in a group of its own.
+        ghost.local_roles_digest = b'ghost'
+        ghost._set_tokens(ghost._derive_tokens())
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_pruned'], 1)
+        self.assertNotIn(b'ghost', a_node)
+        self._check_index_matches_rebuild()
+
+    def test_reindex_does_not_heal_when_disabled(self):
+        tool = aq_base(component.getUtility(IShadowTreeTool))
+        tool.self_heal = False
+        self.addCleanup(delattr, tool, b'self_heal')
+        self._populate()
+        b_node = self._get_shadowtree_root().traverse(b'/plone/a/b')
+        del b_node[b'c']
+        obj = self.folders_by_path[b'/a/b']
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_healed'], 0)
+        self.assertNotIn(b'c', b_node)
+
+    def test_reindex_does_not_heal_for_non_cataloged_items(self):
+        from OFS.Folder import Folder
+        self._populate()
+        obj = self.folders_by_path[b'/a/b']
+        obj._setObject(b'item', Folder(b'item'))
+        path = b'/'.join(obj.getPhysicalPath()) + b'/item'
+        self.assertNotIn(path, self.catalog._catalog.uids)
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_healed'], 0)
+        node = self._get_shadowtree_root().traverse(obj.getPhysicalPath())
+        self.assertEqual(node.n_unshadowed, 1)
+        # The non-cataloged item is remembered, hence the ids are not
+        # compared again.
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_reconciled'], 0)
+        self.assertEqual(adapter.stats[b'n_healed'], 0)
+        self._check_shadowtree_integrity()
+
+    def test_reindex_deferred_above_threshold(self):
+        from ..deferred import Worker
+        self._populate()
+        tool = aq_base(component.getUtility(IShadowTreeTool))
+        tool.defer_threshold = 2
+        self.addCleanup(delattr, tool, b'defer_threshold')
+        obj = self.folders_by_path[b'/a']
+        indexed = self._indexed_values()
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        n_descendants = len(self.folders_by_path) - 1
+        self.assertEqual(adapter.stats[b'n_deferred'], n_descendants)
+        self.assertIn(b'user:guido', self._indexed_values()[b'/a'])
+        self.assertEqual(self._indexed_values()[b'/a/b'], indexed[b'/a/b'])
+        (key, job) = tool.jobs.first()
+        self.assertEqual(len(job.paths), n_descendants)
+        reindex_paths = Worker(None, ())._reindexer(self.portal, job)
+        reindex_paths(job.paths)
+        self._check_index_matches_rebuild()
+
+    def test_reindex_groups_by_view_roles(self):
+        self._private_content_with_default_workflow()
+        pa_testing.login(self.portal, pa_testing.TEST_USER_NAME)
+        api.content.transition(obj=self.folders_by_path[b'/a/b/c/a'],
+                               transition=b'show')
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        self._call_mut(obj)
+        st_root = self._get_shadowtree_root()
+        shown = st_root.ensure_ancestry_to(self.folders_by_path[b'/a/b/c/a'])
+        hidden = st_root.ensure_ancestry_to(self.folders_by_path[b'/a/b/c/d'])
+        self.assertEqual(shown.local_roles_token, hidden.local_roles_token)
+        self.assertNotEqual(shown.token, hidden.token)
+        self._check_index_matches_rebuild()
+
     def _private_content_with_default_workflow(self):
         self._set_default_workflow_chain(b'plone_workflow')
         self._populate()
@@ -127,6 +310,57 @@ class ObjectSecurityTestsMixin(testing.TestCaseMixin):
         brains = self.catalog.searchResults()
         self.assertEqual(len(brains), 0)
 
+    def test_reindex_loads_by_oid(self):
+        self._populate()
+        self._disable_calculation()
+        transaction.savepoint()
+        obj = self.folders_by_path[b'/a']
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Reader'])
+        self._make_one(obj, self.catalog).reindex()
+        # OIDs are only assigned when first saved,
+        # but are recorded upon traversal to the object.
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Editor'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertTrue(adapter.stats[b'n_fetched'])
+        self.assertEqual(adapter.stats[b'n_traversed'], 0)
+
+    def test_reindex_skips_groups_with_unchanged_aru(self):
+        self._private_content_with_default_workflow()
+        pa_testing.login(self.portal, pa_testing.TEST_USER_NAME)
+        obj = self.folders_by_path[b'/a']
+        # Member does not have the View permission.
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Member'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertEqual(adapter.stats[b'n_subtree_reindexes'], 1)
+        self.assertTrue(adapter.stats[b'n_groups_skipped'])
+        pa_testing.logout()
+        pa_testing.login(self.portal, b'guido')
+        self.assertEqual(len(self.catalog.searchResults()), 0)
+
+    def test_reindex_writes_stale_members_of_unchanged_groups(self):
+        from ..writers import BulkKeywordIndexWriter
+        self._private_content_with_default_workflow()
+        pa_testing.login(self.portal, pa_testing.TEST_USER_NAME)
+        st_root = self._get_shadowtree_root()
+        (first, second) = [
+            st_root.ensure_ancestry_to(self.folders_by_path[path])
+            for path in (b'/a/b/c/a', b'/a/b/c/d')
+        ]
+        self.assertEqual(first.token, second.token)
+        # The second member of the group has a stale (leaky) value.
+        index = self.catalog._catalog.getIndex(b'allowedRolesAndUsers')
+        rid = self.catalog.getrid(b'/'.join(second.physical_path))
+        BulkKeywordIndexWriter(index).write([b'Anonymous'], [rid])
+        obj = self.folders_by_path[b'/a']
+        # Member does not have the View permission.
+        api.user.grant_roles(username=b'guido', obj=obj, roles=[b'Member'])
+        adapter = self._make_one(obj, self.catalog)
+        adapter.reindex()
+        self.assertNotIn(b'Anonymous', index._unindex[rid])
+        self._check_index_matches_rebuild()
+
     def test_reindex_on_workflow_transistion(self):
         # transition an object to published
         # check that children of object do not show up in
@@ -236,6 +470,8 @@ class PatchedMixin(object):
 
     def _call_mut(self, obj, **kw):
         obj.reindexObjectSecurity(**kw)
+        # As upon committing the transaction.
+        coalescing.flush()
 
 
 class TestObjectSecurityPatched(PatchedMixin, TestObjectSecurity):
@@ -0,0 +1,237 @@
+import unittest
+
+import mock
+from plone import api
+from zope import component, interface
+
+from .. import testing
+
+
+def _make_node(id, parent=None, view_roles=(), view_acquired=True,
+               local_roles=(), block=False):
+    from ..shadowtree import Node
+    node = Node(id=id, parent=parent)
+    if parent is not None:
+        parent[id] = node
+    node.view_roles = view_roles
+    node.view_acquired = view_acquired
+    node.local_roles = local_roles
+    node.block_inherit_roles = block
+    return node
+
+
+class TestShadowCalculator(unittest.TestCase):
+
+    def _get_target_class(self):
+        from ..aru import ShadowCalculator
+        return ShadowCalculator
+
+    def _make_one(self, *args, **kw):
+        cls = self._get_target_class()
+        return cls(*args, **kw)
+
+    def _make_tree(self):
+        root = _make_node(b'', view_roles=(b'Manager',), view_acquired=False)
+        a = _make_node(b'a', parent=root,
+                       view_roles=(b'Owner', b'Reader'),
+                       view_acquired=False,
+                       local_roles=((b'matt', (b'Owner',)),
+                                    (b'liz', (b'Reader',))))
+        _make_node(b'b', parent=a,
+                   view_roles=(b'Editor',),
+                   local_roles=((b'guido', (b'Editor',)),))
+        _make_node(b'c', parent=a,
+                   view_roles=(b'Reader',),
+                   view_acquired=False,
+                   local_roles=((b'guido', (b'Reader',)),),
+                   block=True)
+        return root
+
+    def test_view_roles_acquired(self):
+        root = self._make_tree()
+        calculator = self._make_one()
+        self.assertEqual(calculator.view_roles(root[b'a'][b'b']),
+                         {b'Editor', b'Owner', b'Reader'})
+        self.assertEqual(calculator.view_roles(root[b'a'][b'c']),
+                         {b'Reader'})
+
+    def test_view_roles_unknown(self):
+        root = self._make_tree()
+        root[b'a'].view_roles = None
+        calculator = self._make_one()
+        self.assertIsNone(calculator.view_roles(root[b'a'][b'b']))
+
+    def test_local_roles(self):
+        root = self._make_tree()
+        calculator = self._make_one()
+        self.assertEqual(calculator.local_roles(root[b'a'][b'b']), {
+            b'matt': {b'Owner'},
+            b'liz': {b'Reader'},
+            b'guido': {b'Editor'},
+        })
+        self.assertEqual(calculator.local_roles(root[b'a'][b'c']), {
+            b'guido': {b'Reader'},
+        })
+
+    def test_allowed_roles_and_users(self):
+        root = self._make_tree()
+        calculator = self._make_one()
+        self.assertEqual(
+            calculator.allowed_roles_and_users(root[b'a']),
+            [b'Reader', b'user:liz', b'user:matt']
+        )
+        self.assertEqual(
+            calculator.allowed_roles_and_users(root[b'a'][b'b']),
+            [b'Editor', b'Reader', b'user:guido', b'user:liz', b'user:matt']
+        )
+        self.assertEqual(
+            calculator.allowed_roles_and_users(root[b'a'][b'c']),
+            [b'Reader', b'user:guido']
+        )
+
+    def test_allowed_roles_and_users_shortcuts(self):
+        root = self._make_tree()
+        root[b'a'][b'b'].view_roles = (b'Authenticated',)
+        root[b'a'][b'c'].view_roles = (b'Anonymous', b'Reader')
+        calculator = self._make_one()
+        self.assertEqual(
+            calculator.allowed_roles_and_users(root[b'a'][b'b']),
+            [b'Authenticated']
+        )
+        self.assertEqual(
+            calculator.allowed_roles_and_users(root[b'a'][b'c']),
+            [b'Anonymous']
+        )
+
+    def test_allowed_roles_and_users_unknown_local_roles(self):
+        root = self._make_tree()
+        root[b'a'].local_roles = None
+        calculator = self._make_one()
+        self.assertIsNone(
+            calculator.allowed_roles_and_users(root[b'a'][b'b'])
+        )
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def _get_target_class(self):
+        from ..aru import LRUCache
+        return LRUCache
+
+    def _make_one(self, *args, **kw):
+        cls = self._get_target_class()
+        return cls(*args, **kw)
+
+    def test_get_and_set(self):
+        cache = self._make_one(2)
+        self.assertIsNone(cache.get(b'a'))
+        cache.set(b'a', 1)
+        self.assertEqual(cache.get(b'a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = self._make_one(2)
+        cache.set(b'a', 1)
+        cache.set(b'b', 2)
+        cache.get(b'a')
+        cache.set(b'c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), 1)
+        self.assertEqual(cache.get(b'c'), 3)
+
+    def test_resize(self):
+        cache = self._make_one(3)
+        for (key, value) in enumerate(b'abc'):
+            cache.set(key, value)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(2), b'c')
+        cache.resize(0)
+        cache.set(3, b'd')
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = self._make_one(1)
+        cache.set(b'a', 1)
+        cache.get(b'a')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+class TestGeneration(testing.TestCaseMixin, unittest.TestCase):
+
+    layer = testing.INTEGRATION
+
+    def _call_fut(self):
+        from ..aru import generation
+        acl_users = api.portal.get_tool(name=b'acl_users')
+        return generation(self.portal, acl_users)
+
+    def test_stable(self):
+        self.assertEqual(self._call_fut(), self._call_fut())
+
+    def test_changes_with_role_definitions(self):
+        before = self._call_fut()
+        self.portal._addRole(b'Auditor')
+        self.assertNotEqual(self._call_fut(), before)
+
+
+class TestCanCalculate(testing.TestCaseMixin, unittest.TestCase):
+
+    layer = testing.INTEGRATION
+
+    def _call_fut(self):
+        from ..aru import can_calculate
+        return can_calculate(api.portal.get_tool(name=b'acl_users'))
+
+    def test_stock_site(self):
+        self.assertTrue(self._call_fut())
+
+    def test_custom_local_role_provider(self):
+        from borg.localrole.interfaces import ILocalRoleProvider
+
+        @interface.implementer(ILocalRoleProvider)
+        class _Provider(object):
+
+            def __init__(self, context):
+                self.context = context
+
+        site_manager = component.getSiteManager()
+        site_manager.registerAdapter(_Provider,
+                                     required=(interface.Interface,),
+                                     provided=ILocalRoleProvider,
+                                     name=u'custom')
+        try:
+            self.assertFalse(self._call_fut())
+        finally:
+            site_manager.unregisterAdapter(_Provider,
+                                           required=(interface.Interface,),
+                                           provided=ILocalRoleProvider,
+                                           name=u'custom')
+        self.assertTrue(self._call_fut())
+
+
+class TestUsesStockFactories(unittest.TestCase):
+
+    def _call_fut(self, registry):
+        from ..aru import _uses_stock_factories
+        return _uses_stock_factories(registry)
+
+    def test_cached_until_registrations_change(self):
+        from borg.localrole.interfaces import ILocalRoleProvider
+        from zope.component.registry import Components
+        registry = Components()
+        with mock.patch.object(registry, b'registeredAdapters',
+                               wraps=registry.registeredAdapters) as walk:
+            self.assertTrue(self._call_fut(registry))
+            n_walks = walk.call_count
+            self.assertTrue(self._call_fut(registry))
+            self.assertEqual(walk.call_count, n_walks)
+            registry.registerAdapter(lambda context: context,
+                                     required=(interface.Interface,),
+                                     provided=ILocalRoleProvider,
+                                     name=u'custom')
+            self.assertFalse(self._call_fut(registry))
+            self.assertGreater(walk.call_count, n_walks)
@@ -0,0 +1,59 @@
+import unittest
+
+from plone import api
+import mock
+
+from .. import bulk, testing
+
+
+class TestBulk(testing.TestCaseMixin, unittest.TestCase):
+
+    layer = testing.INTEGRATION
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self._create_folder(b'/a', [b'Reader'])
+        self._create_folder(b'/a/b', [b'Reader'])
+
+    def test_outermost(self):
+        paths = [(b'', b'a', b'b'), (b'', b'a-1'), (b'', b'a'),
+                 (b'', b'a', b'b', b'c'), (b'', b'ab')]
+        self.assertEqual(bulk.outermost(paths),
+                         [(b'', b'a'), (b'', b'a-1'), (b'', b'ab')])
+
+    def test_touch(self):
+        self.assertFalse(bulk.touch((b'', b'plone', b'a')))
+        with mock.patch.object(bulk, b'synchronise') as synchronise:
+            with bulk.suspended():
+                self.assertTrue(bulk.touch((b'', b'plone', b'a')))
+                with bulk.suspended():
+                    bulk.touch((b'', b'plone', b'b'))
+                self.assertFalse(synchronise.called)
+        synchronise.assert_called_once_with({(b'', b'plone', b'a'),
+                                             (b'', b'plone', b'b')})
+
+    def test_suspended(self):
+        st_root = self._get_shadowtree_root()
+        a = self.folders_by_path[b'/a']
+        a_node = st_root.ensure_ancestry_to(a)
+        with bulk.suspended():
+            self.assertTrue(bulk.active())
+            c = api.content.create(container=a, type=b'Folder', id=b'c')
+            api.content.create(container=c, type=b'Folder', id=b'd')
+            api.content.delete(obj=self.folders_by_path[b'/a/b'])
+            self.assertNotIn(b'c', a_node)
+            self.assertIn(b'b', a_node)
+        self.assertFalse(bulk.active())
+        self.assertIn(b'd', a_node[b'c'])
+        self.assertNotIn(b'b', a_node)
+        self._check_shadowtree_integrity()
+        self._check_shadowtree_nodes_have_security_info()
+
+    def test_not_synchronised_upon_error(self):
+        with mock.patch.object(bulk, b'synchronise') as synchronise:
+            with self.assertRaises(ValueError):
+                with bulk.suspended():
+                    bulk.touch((b'', b'plone', b'a'))
+                    raise ValueError
+        self.assertFalse(synchronise.called)
+        self.assertFalse(bulk.active())
@@ -0,0 +1,82 @@
+import unittest
+
+from Acquisition import aq_base
+from plone import api
+import mock
+import transaction
+
+from .. import coalescing, testing
+
+
+class TestCoalescing(testing.TestCaseMixin, unittest.TestCase):
+
+    layer = testing.INTEGRATION
+
+    def setUp(self):
+        super(TestCoalescing, self).setUp()
+        self._create_members([b'guido'])
+        self._create_folder(b'/a', [b'Reader'])
+        self._create_folder(b'/a/b', [b'Reader'])
+
+    def _grant(self, path, roles=(b'Reader',)):
+        obj = self.folders_by_path[path]
+        api.user.grant_roles(username=b'guido', obj=obj, roles=list(roles))
+        return obj
+
+    def test_reindexObjectSecurity_is_queued(self):
+        a = self._grant(b'/a')
+        a.reindexObjectSecurity()
+        self._grant(b'/a/b')
+        self.assertEqual(coalescing.pending(), 2)
+
+    def test_flushed_before_commit(self):
+        self._grant(b'/a')
+        hooks = [hook for (hook, args, kws)
+                 in transaction.get().getBeforeCommitHooks()]
+        self.assertIn(coalescing.flush, hooks)
+
+    def test_flush_reindexes_many(self):
+        from ..adapters import ObjectSecurity
+        a = self._grant(b'/a')
+        b = self._grant(b'/a/b')
+        self._grant(b'/a', roles=[b'Editor'])
+        with mock.patch.object(ObjectSecurity, b'reindex_many',
+                               autospec=True) as reindex_many:
+            coalescing.flush()
+        self.assertEqual(reindex_many.call_count, 1)
+        objs = reindex_many.call_args[0][1]
+        self.assertEqual([aq_base(obj) for obj in objs],
+                         [aq_base(a), aq_base(b)])
+        self.assertEqual(coalescing.pending(), 0)
+
+    def test_search_flushes(self):
+        self._grant(b'/a')
+        brains = self.catalog.unrestrictedSearchResults(
+            allowedRolesAndUsers=b'user:guido'
+        )
+        self.assertEqual(coalescing.pending(), 0)
+        self.assertEqual({brain.getPath() for brain in brains},
+                         {b'/plone/a', b'/plone/a/b'})
+
+    def test_move_flushes(self):
+        self._grant(b'/a/b')
+        transaction.savepoint()
+        api.content.move(source=self.folders_by_path[b'/a/b'],
+                         target=self.portal)
+        self.assertEqual(coalescing.pending(), 0)
+        brains = self.catalog.unrestrictedSearchResults(
+            allowedRolesAndUsers=b'user:guido'
+        )
+        self.assertEqual([brain.getPath() for brain in brains],
+                         [b'/plone/b'])
+
+    def test_flush_skips_removed(self):
+        from ..adapters import ObjectSecurity
+        self._grant(b'/a/b')
+        # Bypasses the events which would otherwise flush the queue.
+        self.folders_by_path[b'/a']._delOb(b'b')
+        with mock.patch.object(ObjectSecurity, b'reindex_many',
+                               autospec=True) as reindex_many:
+            coalescing.flush()
+        self.assertFalse(reindex_many.called)
+        self.assertEqual(coalescing.pending(), 0)
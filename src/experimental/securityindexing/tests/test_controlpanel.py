@@ -2,6 +2,7 @@ import collections
 import unittest
 
 from zExceptions import Unauthorized
+import mock
 import plone.app.testing as pa_testing
 import plone.api as api
 import plone.testing.z2 as z2
@@ -22,7 +23,7 @@ class ControlPanelTestsMixin(testing.TestCaseMixin):
         assert self.layer[b'request'].method == 'POST', (
             b'Request method was %r' % self.layer[b'request'].method
         )
-        view.handle_sync()
+        view.handle_sync(commit=False)
 
     def _populate(self):
         self.folders_by_path.clear()
@@ -83,6 +84,126 @@ class ControlPanelTestsMixin(testing.TestCaseMixin):
         self._call_vut()
         check_in_sync()
 
+    def test_sync_resumes_after_cursor(self):
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        st_root.clear()
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        savepoint = transaction.savepoint
+        interrupt = mock.Mock(side_effect=[savepoint(), RuntimeError])
+        with mock.patch.object(transaction, b'savepoint', interrupt):
+            self.assertRaises(RuntimeError, tool.sync, self.catalog,
+                              batch_size=2, commit=False)
+        uids = list(self.catalog._catalog.uids.keys())
+        self.assertEqual(tool.sync_cursor, uids[3])
+        n_synced = tool.sync(self.catalog, batch_size=2, commit=False)
+        self.assertEqual(n_synced, len(uids) - 4)
+        self.assertIsNone(tool.sync_cursor)
+        self.assertTrue(tool.integrity_info().is_integral())
+
+    def test_sync_shadow_only(self):
+        from ..adapters import ObjectSecurity
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        st_root.clear()
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        with mock.patch.object(ObjectSecurity, b'reindex_object') as reindex:
+            tool.sync(self.catalog, shadow_only=True, commit=False)
+        self.assertFalse(reindex.called)
+        self.assertTrue(tool.integrity_info().is_integral())
+        self._check_shadowtree_nodes_have_security_info()
+
+    def test_verify(self):
+        from ..verification import DRIFT_TOKEN
+        self._populate()
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        uids = list(self.catalog._catalog.uids.keys())
+        report = tool.verify(self.catalog, batch_size=2, limit=3,
+                             commit=False)
+        self.assertFalse(report.is_complete())
+        self.assertEqual(tool.verify_cursor, uids[2])
+        report = tool.verify(self.catalog, batch_size=2, commit=False)
+        self.assertTrue(report.is_complete())
+        self.assertIsNone(tool.verify_cursor)
+        self.assertEqual(report.stats[b'n_checked'], len(uids))
+        self.assertEqual(report.drift_rate(), 0.0)
+        node = self._get_shadowtree_root()[b'a']
+        node.token = 0
+        report = tool.verify(self.catalog, sample_size=len(uids))
+        self.assertEqual(report.stats[b'n_checked'], len(uids))
+        self.assertEqual(report.drifted,
+                         [(b'/'.join(node.physical_path), (DRIFT_TOKEN,))])
+        self.assertEqual(report.drift_rate(DRIFT_TOKEN), 1.0 / len(uids))
+
+    def test_repair(self):
+        from ..shadowtree import Node
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        a = st_root[b'a']
+        del a[b'b'][b'c'][b'd']
+        ghost = st_root[b'ghost'] = Node(id=b'ghost', parent=st_root)
+        ghost.physical_path = (b'', pa_testing.PLONE_SITE_ID, b'ghost')
+        a[b'b'].token = None
+        # Along the path of the missing node.
+        c = a[b'b'][b'c']
+        expected_token = c.token
+        c.token = 0
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        self.assertFalse(tool.integrity_info().is_integral())
+        stats = tool.repair(self.catalog, shadow_only=True)
+        self.assertEqual(stats[b'n_created'], 1)
+        self.assertEqual(stats[b'n_updated'], 1)
+        self.assertEqual(stats[b'n_pruned'], 1)
+        self.assertTrue(stats[b'n_retokened'])
+        self.assertTrue(tool.integrity_info().is_integral())
+        self._check_shadowtree_nodes_have_security_info()
+        self.assertEqual(c.token, expected_token)
+        for node in st_root.descendants(ignore_block=True):
+            self.assertEqual(node.token, node._derive_tokens()[-1])
+
+    def test_repair_reindexes_retokened_nodes(self):
+        from ..adapters import ObjectSecurity
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        c = st_root[b'a'][b'b'][b'c']
+        del c[b'd']
+        expected_token = c.token
+        c.token = 0
+        # Neither along nor beneath the path of the missing node.
+        e = c[b'e']
+        e.token = 0
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        with mock.patch.object(ObjectSecurity, b'reindex_nodes') as reindex:
+            stats = tool.repair(self.catalog)
+        self.assertEqual(stats[b'n_created'], 1)
+        self.assertEqual(stats[b'n_retokened'], 1)
+        self.assertEqual(c.token, expected_token)
+        self.assertEqual(e.token, 0)
+        reindex.assert_called_once_with({c})
+
+    def test_requeue_and_discard_parked_jobs(self):
+        from ..deferred import Job
+        tool = api.portal.get_tool(name=b'portal_shadowtree')
+        jobs = tool.jobs
+        catalog_path = self.catalog.getPhysicalPath()
+        keys = [jobs.add(Job(catalog_path, [self.portal.getPhysicalPath()]))
+                for _ in range(2)]
+        for key in keys:
+            jobs.park(key)
+        request = self.layer[b'request']
+        view = api.content.get_view(context=tool,
+                                    request=request,
+                                    name=b'shadowtree-sync')
+        self.assertEqual([job[b'key'] for job in view.parked_jobs()], keys)
+        request.form.update({b'job': str(keys[0]), b'requeue': b'1'})
+        view.handle_parked_job()
+        self.assertEqual(jobs.first()[0], keys[0])
+        request.form.clear()
+        request.form.update({b'job': str(keys[1]), b'discard': b'1'})
+        view.handle_parked_job()
+        self.assertEqual(jobs.parked(), [])
+        self.assertEqual(len(jobs), 1)
+
 
 class TestControlPanel(ControlPanelTestsMixin, unittest.TestCase):
 
@@ -161,6 +282,18 @@ class TestControlPanelFunctional(ControlPanelTestsMixin, unittest.TestCase):
         self.assertRaises(LookupError, self.browser.getControl, name=b'sync')
         self.assertIn(b'shadow tree is synchronised',
                       self.browser.contents.lower())
+        self.browser.getLink(id=b'verify').click()
+        self.assertRaises(LookupError, self.browser.getLink, id=b'verify')
+        self.assertIn(b'shadow tree is synchronised',
+                      self.browser.contents.lower())
+
+    def test_form_shows_aru_cache_info(self):
+        self._populate()
+        transaction.commit()
+        self._set_credentials(pa_testing.SITE_OWNER_NAME,
+                              pa_testing.SITE_OWNER_PASSWORD)
+        self.browser.open(self._get_uut())
+        self.assertIn(b'allowedRolesAndUsers cache', self.browser.contents)
 
     def test_form_shadowtree_unsynchronised(self):
         form = self._get_form_after_populate_and_reinstall()
@@ -168,6 +301,13 @@ class TestControlPanelFunctional(ControlPanelTestsMixin, unittest.TestCase):
         button = form.getControl(name=b'sync')
         self.assertTrue(button)
 
+    def test_repair_form(self):
+        form = self._get_form_after_populate_and_reinstall()
+        form.getControl(name=b'repair').click()
+        self.assertIn(b'Repair complete', self.browser.contents)
+        self.assertIn(b'shadow tree is synchronised',
+                      self.browser.contents.lower())
+
     def test_sync(self):
         form = self._get_form_after_populate_and_reinstall()
         form.submit()
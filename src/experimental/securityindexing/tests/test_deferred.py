@@ -0,0 +1,254 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from persistent.list import PersistentList
+import transaction
+
+
+def _paths(n):
+    return [(b'', b'plone', b'f%d' % (i,)) for i in range(n)]
+
+
+class _Clock(object):
+
+    def __init__(self, tick):
+        self.now = 0.0
+        self.tick = tick
+
+    def __call__(self):
+        self.now += self.tick
+        return self.now
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def _make_one(self):
+        from ..deferred import JobQueue
+        return JobQueue()
+
+    def _make_job(self, n):
+        from ..deferred import Job
+        return Job((b'', b'plone', b'portal_catalog'), _paths(n))
+
+    def test_first_in_first_out(self):
+        queue = self._make_one()
+        self.assertIsNone(queue.first())
+        first = self._make_job(1)
+        second = self._make_job(2)
+        second.created = first.created
+        first_key = queue.add(first)
+        queue.add(second)
+        self.assertEqual(queue.first(), (first_key, first))
+        queue.remove(first_key)
+        self.assertIs(queue.first()[1], second)
+        self.assertEqual(len(queue), 1)
+
+    def test_requeue_and_discard_parked(self):
+        queue = self._make_one()
+        first = self._make_job(1)
+        second = self._make_job(2)
+        second.created = first.created
+        first_key = queue.add(first)
+        second_key = queue.add(second)
+        first.failures = 3
+        queue.park(first_key)
+        queue.park(second_key)
+        self.assertEqual(queue.parked(),
+                         [(first_key, first), (second_key, second)])
+        self.assertIsNone(queue.first())
+        queue.requeue(first_key)
+        self.assertEqual(queue.first(), (first_key, first))
+        self.assertEqual(first.failures, 0)
+        queue.discard(second_key)
+        self.assertEqual(queue.parked(), [])
+        self.assertEqual(len(queue), 1)
+        self.assertRaises(KeyError, queue.requeue, second_key)
+        self.assertRaises(KeyError, queue.discard, first_key)
+        self.assertRaises(KeyError, self._make_one().requeue, first_key)
+
+    def test_progress(self):
+        queue = self._make_one()
+        job = self._make_job(10)
+        job.position = 4
+        queue.add(job)
+        queue.add(self._make_job(5))
+        self.assertEqual(queue.progress(), (4, 15))
+
+
+class TestRunChunk(unittest.TestCase):
+
+    def _call_fut(self, *args, **kw):
+        from ..deferred import run_chunk
+        return run_chunk(*args, **kw)
+
+    def _make_job(self, n):
+        from ..deferred import Job
+        return Job((b'', b'plone', b'portal_catalog'), _paths(n))
+
+    def test_chunk_size(self):
+        job = self._make_job(250)
+        reindexed = []
+        n_done = self._call_fut(job, reindexed.extend, 120, 60.0)
+        self.assertEqual(n_done, 120)
+        self.assertEqual(job.position, 120)
+        self.assertEqual(reindexed, list(job.paths[:120]))
+        self._call_fut(job, reindexed.extend, 1000, 60.0)
+        self.assertTrue(job.done)
+        self.assertEqual(reindexed, list(job.paths))
+
+    def test_chunks_do_not_rewrite_paths(self):
+        job = self._make_job(250)
+        conn = DB(None).open()
+        self.addCleanup(conn.db().close)
+        self.addCleanup(transaction.abort)
+        conn.root()[b'job'] = job
+        transaction.commit()
+        self._call_fut(job, lambda paths: None, 100, 60.0)
+        self.assertTrue(job._p_changed)
+        self.assertFalse(job._paths._p_changed)
+
+    def test_time_budget(self):
+        job = self._make_job(1000)
+        n_done = self._call_fut(job, lambda paths: None, 1000, 2.0,
+                                clock=_Clock(1.0))
+        self.assertEqual(n_done, 200)
+        self.assertEqual(job.position, 200)
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        from ..deferred import JobQueue
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        storage = FileStorage(os.path.join(self.tmpdir, b'Data.fs'))
+        self.db = DB(storage)
+        self.addCleanup(self.db.close)
+        conn = self.db.open()
+        root = conn.root()
+        root[b'jobs'] = JobQueue()
+        root[b'reindexed'] = PersistentList()
+        transaction.commit()
+        conn.close()
+
+    def _make_one(self, reindex_paths=None, **kw):
+        from ..deferred import Worker
+
+        class _Worker(Worker):
+
+            def _open_site(self, conn):
+                return conn.root()
+
+            def _close_site(self, site):
+                pass
+
+            def _get_queue(self, site):
+                return site[b'jobs']
+
+            def _reindexer(self, site, job):
+                if reindex_paths is not None:
+                    return lambda paths: reindex_paths(self, site, paths)
+                return site[b'reindexed'].extend
+
+        kw.setdefault(b'chunk_size', 100)
+        kw.setdefault(b'time_budget', 60.0)
+        return _Worker(self.db, (b'', b'plone'), **kw)
+
+    def _queue(self, n):
+        from ..deferred import Job
+        conn = self.db.open()
+        job = Job((b'', b'plone', b'portal_catalog'), _paths(n))
+        conn.root()[b'jobs'].add(job)
+        transaction.commit()
+        conn.close()
+        return job.paths
+
+    def _committed(self):
+        conn = self.db.open()
+        try:
+            root = conn.root()
+            return (list(root[b'reindexed']),
+                    [job.position for job in root[b'jobs']])
+        finally:
+            conn.close()
+
+    def test_thread_drains_queue_in_chunks(self):
+        paths = self._queue(250)
+        n_transactions = len(self.db.undoLog(0, 1000))
+        worker = self._make_one(interval=0.01)
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(worker.stop)
+        deadline = time.time() + 10
+        while worker.stats[b'n_nodes'] < 250 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(worker.stats[b'n_chunks'], 3)
+        self.assertEqual(self._committed(), (list(paths), []))
+        self.assertEqual(len(self.db.undoLog(0, 1000)), n_transactions + 3)
+
+    def test_resumes_from_position(self):
+        paths = self._queue(250)
+
+        def reindex_then_stop(worker, site, paths):
+            site[b'reindexed'].extend(paths)
+            worker.stop()
+
+        worker = self._make_one(reindex_paths=reindex_then_stop)
+        self.assertEqual(worker.process(), 100)
+        self.assertEqual(self._committed(), (list(paths[:100]), [100]))
+        self.assertEqual(self._make_one().process(), 150)
+        self.assertEqual(self._committed(), (list(paths), []))
+
+    def test_retries_on_conflict(self):
+        paths = self._queue(50)
+        attempts = []
+
+        def conflict_once(worker, site, paths):
+            attempts.append(paths)
+            site[b'reindexed'].extend(paths)
+            if len(attempts) == 1:
+                raise ConflictError()
+
+        worker = self._make_one(reindex_paths=conflict_once)
+        self.assertEqual(worker.process(), 50)
+        self.assertEqual(worker.stats[b'n_conflicts'], 1)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self._committed(), (list(paths), []))
+
+    def test_gives_up_after_max_retries(self):
+        self._queue(50)
+
+        def conflict(worker, site, paths):
+            raise ConflictError()
+
+        worker = self._make_one(reindex_paths=conflict, max_retries=2)
+        self.assertEqual(worker.process(), 0)
+        self.assertEqual(worker.stats[b'n_conflicts'], 3)
+        self.assertEqual(self._committed(), ([], [0]))
+
+    def test_parks_failing_job(self):
+        self._queue(50)
+        paths = self._queue(20)
+
+        def fail_first_job(worker, site, paths):
+            if len(paths) == 50:
+                raise ValueError()
+            site[b'reindexed'].extend(paths)
+
+        worker = self._make_one(reindex_paths=fail_first_job,
+                                max_failures=2)
+        self.assertEqual(worker.process(), 20)
+        self.assertEqual(worker.stats[b'n_failures'], 2)
+        self.assertEqual(self._committed(), (list(paths), []))
+        conn = self.db.open()
+        try:
+            ((_, parked),) = conn.root()[b'jobs'].parked()
+            self.assertEqual((parked.failures, parked.position), (2, 0))
+        finally:
+            conn.close()
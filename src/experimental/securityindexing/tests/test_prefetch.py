@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+
+class _Storage(object):
+
+    def __init__(self):
+        self.loaded = []
+        self.lock = threading.Lock()
+
+    def load(self, oid, version):
+        with self.lock:
+            self.loaded.append(oid)
+
+
+class _Jar(object):
+
+    def __init__(self):
+        self._storage = _Storage()
+
+
+class _PrefetchingJar(_Jar):
+
+    def __init__(self):
+        super(_PrefetchingJar, self).__init__()
+        self.prefetched = []
+
+    def prefetch(self, oids):
+        self.prefetched.append(list(oids))
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def _get_target_class(self):
+        from ..prefetch import Prefetcher
+        return Prefetcher
+
+    def _make_one(self, *args, **kw):
+        cls = self._get_target_class()
+        return cls(*args, **kw)
+
+    def test_advance_with_connection_prefetch(self):
+        jar = _PrefetchingJar()
+        prefetcher = self._make_one(jar, [b'1', b'2', None, b'4', b'5'], 2)
+        prefetcher.advance(0)
+        self.assertEqual(jar.prefetched, [[b'2']])
+        prefetcher.advance(1)
+        self.assertEqual(jar.prefetched[-1], [b'4'])
+        prefetcher.advance(2)
+        self.assertEqual(jar.prefetched[-1], [b'5'])
+        prefetcher.advance(3)
+        prefetcher.advance(4)
+        self.assertEqual(len(jar.prefetched), 3)
+        self.assertEqual(prefetcher.stats[b'n_prefetched'], 3)
+        prefetcher.close()
+
+    def test_advance_with_background_loader(self):
+        jar = _Jar()
+        oids = [b'1', b'2', b'3', b'4']
+        prefetcher = self._make_one(jar, oids, 8)
+        prefetcher.advance(0)
+        loader = prefetcher._loader
+        self.assertIsNotNone(loader)
+        prefetcher.close()
+        loader.join(5)
+        self.assertFalse(loader.is_alive())
+        self.assertEqual(jar._storage.loaded, oids[1:])
+
+    def test_advance_disabled(self):
+        jar = _PrefetchingJar()
+        prefetcher = self._make_one(jar, [b'1', b'2'], 0)
+        prefetcher.advance(0)
+        self.assertEqual(jar.prefetched, [])
+        prefetcher = self._make_one(None, [b'1', b'2'], 1)
+        prefetcher.advance(0)
+        self.assertEqual(prefetcher.stats[b'n_prefetched'], 0)
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ZODB.DB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+import mock
+import transaction
+
+from .utils import (
+    DummyContent,
+    FakePlonePortal,
+    build_dummy_site,
+    start_zeo_server,
+)
+
+
+_ATTRS = (b'token', b'local_roles_token', b'view_token', b'local_roles',
+          b'view_roles', b'view_acquired', b'block_inherit_roles', b'oid')
+
+
+class RebuildTestsMixin(object):
+
+    plone_api_patcher = mock.patch(
+        b'experimental.securityindexing.shadowtree.api',
+        **{b'portal.get.return_value': FakePlonePortal()}
+    )
+
+    def setUp(self):
+        from ..shadowtree import Node
+        self.plone_api_patcher.start()
+        self.addCleanup(self.plone_api_patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, b'Data.fs')
+        self.db = self._open_db()
+        self.addCleanup(self.db.close)
+        self.conn = self.db.open()
+        self.addCleanup(self.conn.close)
+        self.addCleanup(transaction.abort)
+        root = self.conn.root()
+        app = root[b'Application'] = DummyContent()
+        (self.site, self.catalog) = build_dummy_site(app, 3, 3, 2)
+        self.st_root = root[b'shadowtree'] = Node()
+        transaction.commit()
+
+    def _call_fut(self, **kw):
+        from ..rebuild import rebuild
+        return rebuild(self.st_root, self.site, self.catalog, **kw)
+
+    def _expected(self):
+        from ..shadowtree import Node
+        expected = Node()
+        expected.update_security_info(self.site)
+        app = self.site.getPhysicalRoot()
+        for path in self.catalog._catalog.uids.keys():
+            obj = app.unrestrictedTraverse(path)
+            expected.ensure_ancestry_to(obj).update_security_info(obj)
+        return expected
+
+    def _check_matches(self, root, expected):
+        nodes = {node.physical_path: node
+                 for node in root.descendants(ignore_block=True)}
+        self.assertEqual(root.n_nodes, len(set(nodes) - {None}))
+        expected_nodes = {node.physical_path: node
+                          for node in expected.descendants(ignore_block=True)}
+        self.assertEqual(set(nodes), set(expected_nodes))
+        for (path, node) in expected_nodes.items():
+            for attr in _ATTRS:
+                self.assertEqual(getattr(nodes[path], attr),
+                                 getattr(node, attr),
+                                 msg=b'%s of %r' % (attr, path))
+
+
+class TestRebuild(RebuildTestsMixin, unittest.TestCase):
+
+    def _open_db(self):
+        return DB(FileStorage(self.path))
+
+    def test_rebuild_in_process(self):
+        self._call_fut(processes=0, commit=False)
+        self._check_matches(self.st_root, self._expected())
+
+    def test_storage_not_shared_rebuilt_in_process(self):
+        with mock.patch(b'subprocess.Popen') as popen:
+            n_nodes = self._call_fut(processes=2)
+        self.assertFalse(popen.called)
+        self.assertEqual(n_nodes, len(self.catalog._catalog.uids))
+        self._check_matches(self.st_root, self._expected())
+
+    def test_rebuild_subtree(self):
+        from ..rebuild import rebuild_subtree
+        from ..shadowtree import Node
+        self._call_fut(processes=0, commit=False)
+        p0 = self.st_root[b'p0']
+        del p0[b'f1']
+        p0[b'f0'][b'gone'] = Node(id=b'gone', parent=p0[b'f0'])
+        p0[b'gone'] = Node(id=b'gone', parent=p0)
+        site_path = self.site.getPhysicalPath()
+        for item_id in (b'f0', b'f1'):
+            rebuild_subtree(self.st_root, self.site, self.catalog,
+                            site_path + (b'p0', item_id))
+        self.assertEqual(rebuild_subtree(self.st_root, self.site,
+                                         self.catalog,
+                                         site_path + (b'p0', b'gone')),
+                         0)
+        self._check_matches(self.st_root, self._expected())
+
+    def test_rebuild_subtree_merges_in_batches(self):
+        from ..rebuild import _records, rebuild_subtree
+        self._call_fut(processes=0, commit=False)
+        site_path = self.site.getPhysicalPath()
+        p0 = self.st_root[b'p0']
+        merged = []
+
+        def records(app, partition):
+            for record in _records(app, partition):
+                # Records are merged as they are computed.
+                if merged:
+                    self.assertIsNotNone(
+                        self.st_root.traverse(merged[-1]).token)
+                merged.append(record.physical_path)
+                yield record
+
+        with mock.patch(b'experimental.securityindexing.rebuild._records',
+                        side_effect=records), \
+                mock.patch(b'transaction.savepoint') as savepoint:
+            n_nodes = rebuild_subtree(self.st_root, self.site, self.catalog,
+                                      site_path + (b'p0',),
+                                      savepoint_interval=2)
+        self.assertEqual(n_nodes, len(merged))
+        self.assertEqual(savepoint.call_count, n_nodes // 2)
+        self.assertIsNot(self.st_root[b'p0'], p0)
+        self._check_matches(self.st_root, self._expected())
+
+    def test_storage_spec(self):
+        from ..rebuild import storage_spec
+        self.assertIsNone(storage_spec(self.db))
+        db = DB(DemoStorage())
+        self.addCleanup(db.close)
+        self.assertIsNone(storage_spec(db))
+
+
+class TestRebuildWithWorkers(RebuildTestsMixin, unittest.TestCase):
+
+    def _open_db(self):
+        from ZEO.ClientStorage import ClientStorage
+        (addr, stop) = start_zeo_server(self.path)
+        self.addCleanup(stop)
+        return DB(ClientStorage(addr, wait=True))
+
+    def test_rebuild_with_worker_processes(self):
+        from .. import rebuild
+        # The coordinator only links the partitions the workers built.
+        with mock.patch.object(rebuild, b'_merge',
+                               side_effect=AssertionError), \
+                mock.patch.object(rebuild, b'_run_worker',
+                                  wraps=rebuild._run_worker) as run_worker:
+            n_nodes = self._call_fut(processes=2)
+        # Nothing is cataloged within portal_catalog.
+        self.assertEqual(run_worker.call_count, 3)
+        self.assertEqual(n_nodes, len(self.catalog._catalog.uids))
+        self._check_matches(self.st_root, self._expected())
+        # Each partition was committed (by its worker).
+        conn = self.db.open()
+        try:
+            committed = conn.root()[b'shadowtree']
+            self._check_matches(committed, self._expected())
+        finally:
+            conn.close()
+
+    def test_worker_failure(self):
+        from .. import rebuild
+        from ..shadowtree import Node
+        p0 = self.st_root[b'p0'] = Node(id=b'p0', parent=self.st_root)
+        transaction.commit()
+        with mock.patch.object(rebuild, b'_WORKER_SCRIPT',
+                               b'import sys; sys.exit(3)'):
+            self.assertRaises(RuntimeError, self._call_fut, processes=2)
+        transaction.abort()
+        self.assertIs(self.st_root[b'p0'], p0)
+
+    def test_rebuild_replaces_stale_nodes(self):
+        from ..shadowtree import Node
+        self.st_root[b'gone'] = Node(id=b'gone', parent=self.st_root)
+        stale = self.st_root[b'p0'] = Node(id=b'p0', parent=self.st_root)
+        stale[b'gone'] = Node(id=b'gone', parent=stale)
+        self._call_fut(processes=2)
+        self.assertNotIn(b'gone', self.st_root)
+        self.assertNotIn(b'gone', self.st_root[b'p0'])
+        self.assertNotIn(b'portal_catalog', self.st_root)
+
+    def test_storage_spec(self):
+        from ..rebuild import ZEO_STORAGE, storage_spec
+        (kind, addr) = storage_spec(self.db)
+        self.assertEqual(kind, ZEO_STORAGE)
@@ -13,12 +13,10 @@ class _Dummy(object):
     def __init__(self, vpath, local_roles, local_roles_block=False):
         self.path = b'/%s%s' % (_PORTAL_ID, vpath)
         self.aru = local_roles
+        self.__ac_local_roles__ = {b'test-user': list(local_roles)}
         self.__ac_local_roles_block__ = local_roles_block
         self.id = self.path.split(b'/')[-1]
 
-    # TODO: This class should probably define __ac_local_roles__
-    #       to more closely simulate real plone objects.
-
     def __repr__(self):  # pragma: no cover
         return b'_Dummy(%s)' % self.id
 
@@ -50,11 +48,11 @@ class TestShadowTreeNode(unittest.TestCase):
         node = cls(*args, **kw)
         return node
 
-    def _create_security_token(self, obj, expected_type=int):
+    def _create_local_roles_digest(self, obj, expected_type=int):
         Node = self._get_target_class()
-        stoken = Node.create_security_token(obj)
-        self.assertIsInstance(stoken, expected_type)
-        return stoken
+        digest = Node.create_local_roles_digest(obj)
+        self.assertIsInstance(digest, expected_type)
+        return digest
 
     def setUp(self):
         self.plone_api_patcher.start()
@@ -136,39 +134,261 @@ class TestShadowTreeNode(unittest.TestCase):
         with self.assertRaises(Invalid):
             IShadowTreeRoot.validateInvariants(node)
 
-    def test_create_security_token_on_attributeerror(self):
-        local_roles = {b'Role1', b'Role2'}
-        obj1 = _Dummy(b'/a/b/c', local_roles, local_roles_block=False)
-        obj2 = _Dummy(b'/a/b/c', local_roles, local_roles_block=True)
-        dotted_name = 'experimental.securityindexing.shadowtree.api'
-        with mock.patch(dotted_name) as patch:
-            acl_users = patch.portal.get_tool.return_value
-            acl_users._getAllLocalRoles.return_value = {
-                b'some_user_name_1_': local_roles
-            }
-
-            st1, st2 = map(self._create_security_token, (obj1, obj1))
-            self.assertEqual(st1, st2)
-
-            st1, st2 = map(self._create_security_token, (obj1, obj2))
-            self.assertEqual(st1, st2)
-
-        local_roles = {b'Role1'}
-        obj3 = _Dummy(b'/a/b/c', local_roles, local_roles_block=True)
-        with mock.patch(dotted_name) as patch:
-            acl_users = patch.portal.get_tool.return_value
-
-            acl_users._getAllLocalRoles.return_value = {
-                b'some_user_name': {b'Role1', b'Role2'}
-            }
-            st1 = self._create_security_token(obj2)
-
-            acl_users._getAllLocalRoles.return_value = {
-                b'some_user_name': {b'Role1'}
-            }
-            st2 = self._create_security_token(obj3)
-
-            self.assertNotEqual(st1, st2)
+    def test_create_local_roles_digest(self):
+        obj1 = _Dummy(b'/a/b/c', [b'Role1', b'Role2'])
+        obj2 = _Dummy(b'/a/b/d', [b'Role2', b'Role1'],
+                      local_roles_block=True)
+        obj3 = _Dummy(b'/a/b/e', [b'Role1'])
+        (d1, d2, d3) = map(self._create_local_roles_digest,
+                           (obj1, obj2, obj3))
+        self.assertEqual(d1, d2)
+        self.assertNotEqual(d1, d3)
+
+        # principals without roles are not significant.
+        obj3.__ac_local_roles__[b'another-user'] = []
+        self.assertEqual(self._create_local_roles_digest(obj3), d3)
+
+        obj4 = _Dummy(b'/a/b/f', [])
+        self._create_local_roles_digest(obj4, expected_type=type(None))
+        del obj4.__ac_local_roles__
+        self._create_local_roles_digest(obj4, expected_type=type(None))
+
+    def test_create_local_roles_digest_is_order_independent(self):
+        obj1 = _Dummy(b'/a', [b'Reader'])
+        obj1.__ac_local_roles__[b'another-user'] = [b'Editor', b'Reader']
+        obj2 = _Dummy(b'/b', [])
+        obj2.__ac_local_roles__ = {}
+        obj2.__ac_local_roles__[b'another-user'] = [b'Reader', b'Editor']
+        obj2.__ac_local_roles__[b'test-user'] = [b'Reader']
+        self.assertEqual(self._create_local_roles_digest(obj1),
+                         self._create_local_roles_digest(obj2))
+
+    def test_digest(self):
+        from ..shadowtree import digest
+        value = digest(b'a', 1, None)
+        self.assertIsInstance(value, int)
+        self.assertTrue(-2 ** 63 <= value < 2 ** 63)
+        self.assertEqual(value, digest(b'a', 1, None))
+        self.assertEqual(digest(u'a\xe9'), digest(u'a\xe9'.encode('utf-8')))
+        self.assertNotEqual(digest(b'a', 1), digest(b'a1'))
+        self.assertNotEqual(digest(b'a', None), digest(None, b'a'))
+
+    def test_derive_security_token(self):
+        derive = self._get_target_class().derive_security_token
+        parent_token = derive(None, 1234, False)
+        self.assertIsInstance(parent_token, int)
+
+        # Without local roles of its own, a node shares its parent's token.
+        self.assertEqual(derive(parent_token, None, False), parent_token)
+        self.assertNotEqual(derive(parent_token, 5678, False), parent_token)
+
+        # Blocking disregards the parent token.
+        self.assertEqual(derive(parent_token, 5678, True),
+                         derive(None, 5678, True))
+        self.assertNotEqual(derive(parent_token, None, True), parent_token)
+
+    def test_update_security_info_derives_token_from_parent(self):
+        root = self._make_one()
+        parent_obj = _Dummy(b'/a', [b'Editor'])
+        child_obj = _Dummy(b'/a/b', [])
+        parent = root.ensure_ancestry_to(parent_obj)
+        parent.update_security_info(parent_obj)
+        child = root.ensure_ancestry_to(child_obj)
+        child.update_security_info(child_obj)
+        self.assertEqual(child.token, parent.token)
+
+        child_obj.__ac_local_roles__[b'test-user'].append(b'Reader')
+        child.update_security_info(child_obj)
+        self.assertNotEqual(child.token, parent.token)
+
+    def test_inherit_security_info_copies_parent_tokens(self):
+        root = self._make_one()
+        parent_obj = _Dummy(b'/a', [b'Editor'])
+        parent = root.ensure_ancestry_to(parent_obj)
+        parent.update_security_info(parent_obj)
+        child_obj = _Dummy(b'/a/b', [])
+        child = root.ensure_ancestry_to(child_obj)
+        child.inherit_security_info(child_obj)
+        self.assertEqual(child.token, parent.token)
+        self.assertEqual(child._derive_tokens(),
+                         (child.local_roles_token, child.view_token,
+                          child.token))
+        self.assertEqual(child.physical_path, child_obj.getPhysicalPath())
+        self.assertEqual(child.local_roles, ())
+        self.assertTrue(child.view_acquired)
+        # Objects with security settings of their own derive tokens.
+        blocked_obj = _Dummy(b'/a/c', [], local_roles_block=True)
+        blocked = root.ensure_ancestry_to(blocked_obj)
+        blocked.inherit_security_info(blocked_obj)
+        self.assertTrue(blocked.block_inherit_roles)
+        self.assertNotEqual(blocked.token, parent.token)
+
+    def test_retoken(self):
+        root = self._make_one()
+        dummies = [
+            _Dummy(b'/a', [b'Editor']),
+            _Dummy(b'/a/b', []),
+            _Dummy(b'/a/b/c', [b'Reader']),
+            _Dummy(b'/a/d', [b'Reader'], local_roles_block=True),
+            _Dummy(b'/a/d/e', []),
+        ]
+        for dummy in dummies:
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        self.assertEqual(list(root[b'a'].retoken()), [])
+
+        a = root[b'a']
+        a.local_roles_digest = None
+        a._set_tokens(a._derive_tokens())
+        changed_ids = [node.id for node in a.retoken()]
+        self.assertEqual(changed_ids, [b'b', b'c'])
+        self.assertEqual(a[b'b'].token, a.token)
+        self.assertEqual(list(a.retoken()), [])
+
+    def test_retoken_forced(self):
+        root = self._make_one()
+        dummies = [
+            _Dummy(b'/a', [b'Editor']),
+            _Dummy(b'/a/b', [b'Reader']),
+            _Dummy(b'/a/b/c', []),
+        ]
+        for dummy in dummies:
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        a = root[b'a']
+        b = a[b'b']
+        # As if /a/b was re-indexed before /a, which is unchanged.
+        b.local_roles_digest = None
+        b._set_tokens(b._derive_tokens())
+        self.assertEqual(list(a.retoken()), [])
+        b.local_roles_digest = None
+        b._set_tokens(b._derive_tokens())
+        changed_ids = [node.id for node in a.retoken(force={b})]
+        self.assertEqual(changed_ids, [b'b', b'c'])
+        self.assertEqual(b[b'c'].token, b.token)
+
+    def test_counters(self):
+        root = self._make_one()
+        self.assertEqual(root.generation, (0, 0, 0))
+        for path in (b'/a', b'/a/b', b'/a/b/c', b'/d'):
+            dummy = _Dummy(path, [b'Reader'])
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        # Locating each node, and recording its security info.
+        self.assertEqual(root.generation, (4, 0, 8))
+        b = root[b'a'][b'b']
+        self.assertEqual(b.generation, root.generation)
+        b.local_roles_digest = None
+        b._set_tokens(b._derive_tokens())
+        self.assertEqual(len(list(b.retoken())), 1)
+        self.assertEqual(root.generation, (4, 0, 9))
+        del root[b'a']
+        self.assertEqual(root.generation, (4, 1, 9))
+        # Replacing a node deletes its subtree.
+        root[b'd'][b'e'] = self._make_one(id=b'e', parent=root[b'd'])
+        root[b'd'] = self._make_one(id=b'd', parent=root)
+        self.assertEqual(root.generation, (6, 2, 9))
+        root.clear()
+        self.assertEqual(root.generation, (6, 3, 9))
+
+    def test_reset_counters(self):
+        root = self._make_one()
+        root.ensure_ancestry_to(_Dummy(b'/a/b', [b'Reader']))
+        del root._counters
+        self.assertIsNone(root.generation)
+        self.assertIsNone(root.n_nodes)
+        root[b'c'] = self._make_one(id=b'c', parent=root)
+        root.reset_counters()
+        self.assertEqual(root.generation, (3, 0, 0))
+
+    def test_n_nodes(self):
+        from .. import shadowtree
+        root = self._make_one()
+        for path in (b'/a/b/c', b'/a/b/d', b'/e/f'):
+            root.ensure_ancestry_to(_Dummy(path, [b'Reader']))
+        # Intermediate nodes have no path, as their items are not cataloged.
+        self.assertEqual(root.n_nodes, 3)
+        with mock.patch.object(shadowtree, b'_count_located',
+                               wraps=shadowtree._count_located) as count:
+            self.assertEqual(root.n_nodes, 3)
+            self.assertFalse(count.called)
+            root[b'a'][b'b'].relocate(root[b'e'], b'f')
+            self.assertEqual(root.n_nodes, 2)
+            root[b'e'][b'f'][b'c'].physical_path = None
+            self.assertEqual(root.n_nodes, 1)
+            self.assertEqual(count.call_count, 2)
+
+    def test_subtrees_removed_without_visiting_them(self):
+        root = self._make_one()
+        for path in (b'/a/b/c', b'/a/b/d', b'/e/f', b'/g/h'):
+            root.ensure_ancestry_to(_Dummy(path, [b'Reader']))
+        with mock.patch(b'experimental.securityindexing.shadowtree.'
+                        b'_pre_order', side_effect=AssertionError):
+            del root[b'a']
+            root[b'e'] = self._make_one(id=b'e', parent=root)
+            root[b'g'][b'h'].relocate(root, b'e')
+        self.assertEqual(root.n_nodes, 1)
+        self.assertEqual(root.generation[1], 3)
+
+    def test_token_includes_view_roles(self):
+        root = self._make_one()
+        private = _Dummy(b'/a', [b'Reader'])
+        private._View_Permission = (b'Manager', b'Owner')
+        published = _Dummy(b'/b', [b'Reader'])
+        published._View_Permission = (b'Anonymous',)
+        a = root.ensure_ancestry_to(private)
+        a.update_security_info(private)
+        b = root.ensure_ancestry_to(published)
+        b.update_security_info(published)
+        self.assertEqual(a.local_roles_token, b.local_roles_token)
+        self.assertNotEqual(a.view_token, b.view_token)
+        self.assertNotEqual(a.token, b.token)
+
+    def test_retoken_on_view_roles_change(self):
+        root = self._make_one()
+        dummies = [
+            _Dummy(b'/a', [b'Editor']),
+            _Dummy(b'/a/b', []),
+            _Dummy(b'/a/c', []),
+        ]
+        dummies[0]._View_Permission = (b'Reader',)
+        dummies[2]._View_Permission = (b'Reader',)
+        for dummy in dummies:
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        a = root[b'a']
+        self.assertEqual(a[b'b'].token, a.token)
+        self.assertEqual(a[b'c'].token, a.token)
+
+        dummies[0]._View_Permission = (b'Reader', b'Editor')
+        a.update_security_info(dummies[0])
+        # Only the node acquiring the View permission is changed.
+        self.assertEqual([node.id for node in a.retoken()], [b'b'])
+        self.assertEqual(a[b'b'].token, a.token)
+        self.assertNotEqual(a[b'c'].token, a.token)
+
+    def test_get_view_roles(self):
+        Node = self._get_target_class()
+        dummy = _Dummy(b'/a', [])
+        self.assertEqual(Node.get_view_roles(dummy), ((), True))
+        dummy._View_Permission = [b'Reader', b'Owner']
+        self.assertEqual(Node.get_view_roles(dummy),
+                         ((b'Owner', b'Reader'), True))
+        dummy._View_Permission = (b'Reader', b'Owner')
+        self.assertEqual(Node.get_view_roles(dummy),
+                         ((b'Owner', b'Reader'), False))
+        dummy._View_Permission = b'Access contents information'
+        self.assertEqual(Node.get_view_roles(dummy), (None, False))
+        self.assertEqual(Node.get_view_roles(_Dummy(b'/b', []),
+                                             effective=True),
+                         ((b'Manager',), False))
+
+    def test_update_security_info_records_view_and_local_roles(self):
+        root = self._make_one()
+        dummy = _Dummy(b'/a', [b'Reader', b'Editor'])
+        dummy._View_Permission = (b'Reader',)
+        node = root.ensure_ancestry_to(dummy)
+        node.update_security_info(dummy)
+        self.assertEqual(node.local_roles,
+                         ((b'test-user', (b'Editor', b'Reader')),))
+        self.assertEqual(node.view_roles, (b'Reader',))
+        self.assertFalse(node.view_acquired)
 
     def test_update_security_info(self):
         root = self._make_one()
@@ -237,6 +457,96 @@ class TestShadowTreeNode(unittest.TestCase):
         self.assertIs(leaf1, leaf2)
         self.assertTrue(root[b'a'][b'b'].block_inherit_roles)
 
+    def test_child_container_created_lazily(self):
+        root = self._make_one()
+        leaf = root.ensure_ancestry_to(_Dummy(b'/a/b', [b'Reader']))
+        self.assertIsNone(leaf._data)
+        self.assertIsNotNone(root[b'a']._data)
+        self.assertEqual((len(leaf), list(leaf.keys()), leaf.get(b'x')),
+                         (0, [], None))
+        self.assertNotIn(b'x', leaf)
+        leaf.clear()
+        self.assertIsNone(leaf._data)
+        with self.assertRaises(KeyError):
+            del leaf[b'x']
+        child = self._make_one(id=b'c', parent=leaf)
+        self.assertIs(leaf.setdefault(b'c', child), child)
+        self.assertEqual(list(leaf.values()), [child])
+
+    def test_adders_count_inserts(self):
+        from ..shadowtree import INSERTS
+        root = self._make_one()
+        (a, b, c) = (self._make_one(id=id, parent=root)
+                     for id in (b'a', b'b', b'c'))
+        self.assertEqual(root.insert(b'a', a), 1)
+        self.assertEqual(root.insert(b'a', b), 0)
+        self.assertIs(root.setdefault(b'b', b), b)
+        self.assertIs(root.setdefault(b'b', c), b)
+        root.update({b'c': c})
+        root.update([(b'd', self._make_one(id=b'd', parent=root))])
+        self.assertEqual(list(root.keys()), [b'a', b'b', b'c', b'd'])
+        self.assertEqual(root._counters[INSERTS](), 4)
+
+    def test_physical_path_derived_from_ancestors(self):
+        root = self._make_one()
+        leaf = root.ensure_ancestry_to(_Dummy(b'/a/b/c', [b'Reader']))
+        self.assertNotIn(b'physical_path', leaf.__dict__)
+        root[b'a'].id = b'x'
+        self.assertEqual(leaf.physical_path, (b'', b'plone', b'x', b'b', b'c'))
+        leaf.physical_path = None
+        self.assertIsNone(leaf.physical_path)
+
+    def test_relocate(self):
+        root = self._make_one()
+        for path in (b'/a/b/c', b'/d', b'/d/e'):
+            dummy = _Dummy(path, [b'Reader'])
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        b = root[b'a'][b'b']
+        n_nodes = root.n_nodes
+        generation = root.generation
+        b.relocate(root[b'd'], b'f')
+        self.assertNotIn(b'b', root[b'a'])
+        self.assertIs(root[b'd'][b'f'], b)
+        self.assertIs(b.__parent__, root[b'd'])
+        self.assertEqual(b[b'c'].physical_path,
+                         (b'', b'plone', b'd', b'f', b'c'))
+        self.assertEqual(root.n_nodes, n_nodes)
+        self.assertNotEqual(root.generation, generation)
+        # Relocating onto an existing node replaces its subtree.
+        a = root[b'a']
+        a.relocate(root[b'd'], b'e')
+        self.assertEqual(root.n_nodes, n_nodes - 1)
+        self.assertIs(root[b'd'][b'e'], a)
+        self.assertEqual(a.id, b'e')
+
+    def test_physical_path_does_not_change_root_path(self):
+        root = self._make_one()
+        leaf = root.ensure_ancestry_to(_Dummy(b'/a/b', [b'Reader']))
+        leaf.physical_path = (b'', b'other', b'a', b'b')
+        self.assertEqual(root._root_path, (b'', b'plone'))
+        self.assertEqual(root[b'a'].physical_path, None)
+        self.assertEqual(leaf.physical_path, (b'', b'other', b'a', b'b'))
+        root.physical_path = (b'', b'other')
+        self.assertEqual(root._root_path, (b'', b'other'))
+
+    def test_relocate_rewrites_recorded_paths(self):
+        root = self._make_one()
+        for path in (b'/a', b'/a/b', b'/a/b/c', b'/d'):
+            dummy = _Dummy(path, [b'Reader'])
+            root.ensure_ancestry_to(dummy).update_security_info(dummy)
+        nodes = list(root.descendants(ignore_block=True))
+        for node in nodes:
+            # Simulate nodes created by a previous version.
+            node.__dict__[b'physical_path'] = node.physical_path
+            node.__dict__.pop(b'_located', None)
+        del root._paths_derived
+        root[b'a'][b'b'].relocate(root[b'd'], b'f')
+        self.assertEqual(root[b'd'][b'f'][b'c'].physical_path,
+                         (b'', b'plone', b'd', b'f', b'c'))
+        self.assertEqual(root[b'd'][b'f'].physical_path,
+                         (b'', b'plone', b'd', b'f'))
+        self.assertEqual(root[b'a'].physical_path, (b'', b'plone', b'a'))
+
     def test_descendants_empty(self):
         node = self._make_one(b'foo')
         self.assertEqual(list(node.descendants()), [])
@@ -271,6 +581,57 @@ class TestShadowTreeNode(unittest.TestCase):
                           b'c2', b'd2', b'e2', b'f2']
         self.assertEqual(descendant_ids, expected_order)
 
+    def test_descendants_block_prunes_only_blocked_subtree(self):
+        root = self._make_one()
+        root.ensure_ancestry_to(_Dummy(b'/a/b1/c1', [b'Reader']))
+        root.ensure_ancestry_to(_Dummy(b'/a/b2/c2', [b'Reader']))
+        root.ensure_ancestry_to(_Dummy(b'/a/b3/c3', [b'Reader']))
+        root[b'a'][b'b1'].block_inherit_roles = True
+        descendant_ids = list(node.id for node in root.descendants())
+        self.assertEqual(descendant_ids, [b'a', b'b2', b'c2', b'b3', b'c3'])
+
+    def test_descendants_breadth_first(self):
+        from ..shadowtree import BREADTH_FIRST
+        root = self._make_one()
+        root.ensure_ancestry_to(_Dummy(b'/a/b1/c1', [b'Reader']))
+        root.ensure_ancestry_to(_Dummy(b'/a/b2/c2', [b'Reader']))
+        root[b'a'][b'b1'].block_inherit_roles = True
+        descendants = root.descendants(ignore_block=True, order=BREADTH_FIRST)
+        descendant_ids = list(node.id for node in descendants)
+        self.assertEqual(descendant_ids, [b'a', b'b1', b'b2', b'c1', b'c2'])
+        descendants = root.descendants(order=BREADTH_FIRST)
+        descendant_ids = list(node.id for node in descendants)
+        self.assertEqual(descendant_ids, [b'a', b'b2', b'c2'])
+
+    def test_descendants_path_order(self):
+        from ..shadowtree import PATH_ORDER
+        root = self._make_one()
+        for path in (b'/a', b'/a/b', b'/a/b/c', b'/a-1', b'/a-1/d', b'/a0',
+                     b'/a.b', b'/a.b/e', b'/a/b-1'):
+            root.ensure_ancestry_to(_Dummy(path, [b'Reader']))
+        root[b'a-1'].block_inherit_roles = True
+        paths = [b'/'.join(node.physical_path) for node in
+                 root.descendants(ignore_block=True, order=PATH_ORDER)]
+        self.assertEqual(paths, sorted(paths))
+        self.assertEqual(len(paths), 9)
+        paths = [b'/'.join(node.physical_path) for node in
+                 root.descendants(order=PATH_ORDER)]
+        self.assertEqual(paths, sorted(paths))
+        self.assertNotIn(b'/a-1/d', paths)
+
+    def test_descendants_batched(self):
+        root = self._make_one()
+        root.ensure_ancestry_to(_Dummy(b'/a/b1/c1', [b'Reader']))
+        root.ensure_ancestry_to(_Dummy(b'/a/b2/c2', [b'Reader']))
+        batches = list(root.descendants(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([node.id for batch in batches for node in batch],
+                         [b'a', b'b1', b'c1', b'b2', b'c2'])
+
+    def test_descendants_unknown_order(self):
+        root = self._make_one()
+        self.assertRaises(ValueError, root.descendants, order=b'post-order')
+
     def test_delete_node(self):
         root = self._make_one()
         dummy1 = _Dummy(b'/a/b/c/d', [b'Reader'])
@@ -72,11 +72,66 @@ class SubscriberTestsMixin(testing.TestCaseMixin):
         self._populate()
         self._check_shadowtree_integrity()
 
+    def test_on_object_added(self):
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        obj = api.content.create(container=self.folders_by_path[b'/x/y'],
+                                 type=b'Folder',
+                                 id=b'new')
+        node = st_root.traverse(obj.getPhysicalPath())
+        self.assertEqual(node.physical_path, obj.getPhysicalPath())
+        self.assertEqual(node.token, node._derive_tokens()[-1])
+        copied = api.content.copy(source=self.folders_by_path[b'/x/y'],
+                                  target=self.folders_by_path[b'/x/b'])
+        self.assertIn(b'new', st_root.traverse(copied.getPhysicalPath()))
+        self._check_shadowtree_integrity()
+        self._check_shadowtree_nodes_have_security_info()
+
+    def test_on_object_moved_relocates_subtree(self):
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        node = st_root.ensure_ancestry_to(self.folders_by_path[b'/x/y'])
+        leaf = node[b'z'][b'a']
+        n_nodes = st_root.n_nodes
+        moved = api.content.move(source=self.folders_by_path[b'/x/y'],
+                                 target=self.folders_by_path[b'/x/b'])
+        self.assertIs(st_root.ensure_ancestry_to(moved), node)
+        self.assertEqual(leaf.physical_path,
+                         moved.getPhysicalPath() + (b'z', b'a'))
+        self.assertEqual(st_root.n_nodes, n_nodes)
+        self._check_shadowtree_integrity()
+
+    def test_on_object_moved_renames_subtree(self):
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        node = st_root.ensure_ancestry_to(self.folders_by_path[b'/x/b'])
+        transaction.savepoint()
+        renamed = api.content.rename(obj=self.folders_by_path[b'/x/b'],
+                                     new_id=b'renamed')
+        self.assertIs(st_root.ensure_ancestry_to(renamed), node)
+        self.assertEqual(node[b'c'][b'd'].physical_path,
+                         renamed.getPhysicalPath() + (b'c', b'd'))
+        self._check_shadowtree_integrity()
+
     def test_on_object_removed(self):
         self._populate()
         self._check_shadowtree_integrity()
         api.content.delete(obj=self.folders_by_path[b'/x/y/z/a'])
 
+    def test_on_object_removed_drops_subtree_once(self):
+        from ..shadowtree import INSERTS
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        x_node = st_root.ensure_ancestry_to(self.folders_by_path[b'/x'])
+        n_nodes = st_root.n_nodes
+        n_inserts = st_root._counters[INSERTS]()
+        api.content.delete(obj=self.folders_by_path[b'/x/y'])
+        self.assertNotIn(b'y', x_node)
+        # Descendant events neither re-create nor delete nodes.
+        self.assertEqual(st_root._counters[INSERTS](), n_inserts)
+        self.assertEqual(st_root.n_nodes, n_nodes - 3)
+        self._check_shadowtree_integrity()
+
     def test_on_object_removed_is_at_content_root(self):
         self._populate()
         self._check_shadowtree_integrity()
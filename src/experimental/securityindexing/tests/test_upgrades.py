@@ -0,0 +1,107 @@
+import unittest
+
+from .. import testing
+
+
+class TestUpgrades(testing.TestCaseMixin, unittest.TestCase):
+
+    layer = testing.INTEGRATION
+
+    def _populate(self):
+        self.folders_by_path.clear()
+        create_folder = self._create_folder
+        create_folder(b'/a', [b'Reader'])
+        create_folder(b'/a/b', [b'Editor'])
+        create_folder(b'/a/b/c', [b'Reader'], block=True)
+
+    def test_retoken_shadowtree(self):
+        from ..upgrades import retoken_shadowtree
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        nodes = list(st_root.descendants(ignore_block=True))
+        expected = [(node.local_roles_digest, node.token) for node in nodes]
+        for node in nodes:
+            # Simulate tokens created by a previous version.
+            node.local_roles_digest = node.token = 0
+        retoken_shadowtree(None)
+        self.assertEqual(
+            [(node.local_roles_digest, node.token) for node in nodes],
+            expected
+        )
+        self._check_shadowtree_nodes_have_security_info()
+
+    def test_retoken_shadowtree_records_view_roles(self):
+        from ..upgrades import retoken_shadowtree
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        nodes = list(st_root.descendants(ignore_block=True))
+        expected = [(node.local_roles, node.view_roles, node.view_acquired)
+                    for node in nodes]
+        for node in nodes:
+            # Simulate nodes created by a previous version.
+            del node.local_roles, node.view_roles, node.view_acquired
+        retoken_shadowtree(None)
+        self.assertEqual(
+            [(node.local_roles, node.view_roles, node.view_acquired)
+             for node in nodes],
+            expected
+        )
+
+    def test_count_shadowtree_nodes(self):
+        from ..upgrades import count_shadowtree_nodes
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        nodes = list(st_root.descendants(ignore_block=True))
+        n_nodes = len(nodes)
+        # Simulate a shadow tree created by a previous version.
+        del st_root._counters
+        self.assertIsNone(st_root.n_nodes)
+        count_shadowtree_nodes(None)
+        self.assertEqual(st_root.n_nodes,
+                         len([node for node in nodes
+                              if node.physical_path is not None]))
+        self.assertEqual(st_root.generation, (n_nodes, 0, 0))
+
+    def test_derive_shadowtree_paths(self):
+        from ..upgrades import derive_shadowtree_paths
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        nodes = [st_root] + list(st_root.descendants(ignore_block=True))
+        expected = [node.physical_path for node in nodes]
+        for (node, path) in zip(nodes, expected):
+            # Simulate nodes created by a previous version.
+            node.__dict__.pop(b'_located', None)
+            node.__dict__[b'physical_path'] = path
+        for name in (b'_root_path', b'_paths_derived'):
+            st_root.__dict__.pop(name, None)
+        self.assertEqual([node.physical_path for node in nodes], expected)
+        # A node renamed by a previous version, without its descendants'
+        # paths having been rewritten.
+        stale = nodes[1]
+        stale.__parent__[b'renamed'] = stale
+        del stale.__parent__[stale.id]
+        stale.id = b'renamed'
+        expected = [node.physical_path and node._derived_path()
+                    for node in nodes]
+        derive_shadowtree_paths(None)
+        self.assertEqual([node.physical_path for node in nodes], expected)
+        for node in nodes:
+            self.assertNotIn(b'physical_path', node.__dict__)
+        self.assertTrue(st_root._paths_derived)
+
+    def test_drop_empty_child_containers(self):
+        from BTrees.OOBTree import OOBTree
+        from ..upgrades import drop_empty_child_containers
+        self._populate()
+        st_root = self._get_shadowtree_root()
+        nodes = list(st_root.descendants(ignore_block=True))
+        leaves = [node for node in nodes if not len(node)]
+        self.assertTrue(leaves)
+        for node in leaves:
+            # Simulate nodes created by a previous version.
+            node._data = OOBTree()
+        drop_empty_child_containers(None)
+        for node in leaves:
+            self.assertIsNone(node._data)
+        self.assertTrue(all(node._data is not None for node in nodes
+                            if node not in leaves))
@@ -2,7 +2,44 @@ import unittest
 
 import mock
 
-from .utils import FakePlonePortal
+from .utils import DummyCatalog, FakePlonePortal
+
+
+class _CountingCatalog(DummyCatalog):
+
+    _counter = 0
+
+    def __len__(self):
+        return len(self._catalog.uids)
+
+    def getCounter(self):
+        return self._counter
+
+    def catalog_path(self, path):
+        site_path = FakePlonePortal().getPhysicalPath()
+        self._catalog.uids[b'/'.join(site_path + (path,))] = 0
+        self._counter += 1
+
+
+class TestMergeJoin(unittest.TestCase):
+
+    def _call_fut(self, *args):
+        from ..utilities import merge_join
+        return list(merge_join(*args))
+
+    def test_merge_join(self):
+        entries = self._call_fut([b'/a', b'/a-1', b'/a/c', b'/b'],
+                                 iter([b'/a', b'/a/b', b'/a/c']))
+        self.assertEqual(entries, [(b'/a', True, True),
+                                   (b'/a-1', True, False),
+                                   (b'/a/b', False, True),
+                                   (b'/a/c', True, True),
+                                   (b'/b', True, False)])
+
+    def test_merge_join_empty(self):
+        self.assertEqual(self._call_fut([], []), [])
+        self.assertEqual(self._call_fut([], [b'/a']),
+                         [(b'/a', False, True)])
 
 
 class TestShadowTreeTool(unittest.TestCase):
@@ -50,10 +87,100 @@ class TestShadowTreeTool(unittest.TestCase):
         tool_cls = self._get_target_class()
         storage = tool_cls._get_storage(portal=self._fake_portal)
 
-        # ensure the root node is stored.
-        self._make_one().root
+        # ensure the root node and job queue are stored.
+        util = self._make_one()
+        util.root
+        util.jobs
         self.assertIn(self._package, storage)
+        self.assertIn(tool_cls._jobs_key, storage)
 
-        # check it's gone when it's supposed to be.
+        # check they're gone when they're supposed to be.
         tool_cls.delete_from_storage(self._fake_portal)
         self.assertNotIn(self._package, storage)
+        self.assertNotIn(tool_cls._jobs_key, storage)
+
+    def _make_catalog(self, paths):
+        catalog = _CountingCatalog()
+        for path in paths:
+            catalog.catalog_path(path)
+        return catalog
+
+    def _shadow(self, util, paths):
+        from ..shadowtree import Node
+        site_path = self._fake_portal.getPhysicalPath()
+        for path in paths:
+            node = util.root
+            for comp in path.split(b'/'):
+                if comp not in node:
+                    node[comp] = Node(id=comp, parent=node)
+                node = node[comp]
+            node.physical_path = site_path + tuple(path.split(b'/'))
+
+    def test_discrepancies(self):
+        catalog = self._make_catalog((b'a', b'a-1', b'a/b', b'a/b/c'))
+        # Outside of the portal.
+        catalog._catalog.uids[b'/other/a'] = 0
+        util = self._make_one()
+        self.addCleanup(self._get_target_class().delete_from_storage,
+                        self._fake_portal)
+        self._shadow(util, (b'a', b'a/b', b'a/b/d'))
+        prefix = b'/%s/' % (self._fake_portal.getId(),)
+        self.assertEqual(list(util.discrepancies(catalog=catalog)),
+                         [(prefix + b'a-1', True, False),
+                          (prefix + b'a/b/c', True, False),
+                          (prefix + b'a/b/d', False, True)])
+        info = util.integrity_info(catalog=catalog)
+        self.assertFalse(info.is_integral())
+        self.assertEqual(info, (4, 3, 2, 1))
+
+    def test_nodes_near(self):
+        util = self._make_one()
+        self.addCleanup(self._get_target_class().delete_from_storage,
+                        self._fake_portal)
+        self._shadow(util, (b'a/b/c', b'a/b-1', b'a/d/e', b'f/g'))
+        prefix = b'/%s/' % (self._fake_portal.getId(),)
+        paths = [prefix + path for path in (b'a/b-1', b'a/b', b'a/b/c/x',
+                                            b'a/d/x', b'h')]
+        nodes = list(util._nodes_near(paths))
+        self.assertEqual(len(nodes), len(set(nodes)))
+        # Neither the nodes of b'f/g' nor of b'a/d/e' are visited.
+        self.assertEqual([node.id for node in nodes],
+                         [b'a', b'b', b'c', b'b-1', b'd'])
+
+    def test_integrity_info_only_stored_upon_request(self):
+        catalog = self._make_catalog((b'a', b'a/b'))
+        util = self._make_one()
+        self.addCleanup(self._get_target_class().delete_from_storage,
+                        self._fake_portal)
+        self._shadow(util, (b'a',))
+        storage = util._get_storage(self._fake_portal)
+        info = util.integrity_info(catalog=catalog, store=False)
+        self.assertNotIn(util._integrity_key, storage)
+        self.assertFalse(util.probably_integral(catalog=catalog))
+        self.assertIs(util.integrity_info(catalog=catalog, cached=True),
+                      info)
+        util.integrity_info(catalog=catalog)
+        self.assertIn(util._integrity_key, storage)
+
+    def test_probably_integral(self):
+        catalog = self._make_catalog((b'a', b'a/b'))
+        util = self._make_one()
+        self.addCleanup(self._get_target_class().delete_from_storage,
+                        self._fake_portal)
+        self._shadow(util, (b'a', b'a/c'))
+        # The numbers of nodes and cataloged items are equal.
+        self.assertTrue(util.probably_integral(catalog=catalog))
+        info = util.integrity_info(catalog=catalog)
+        self.assertEqual(info, (2, 2, 1, 1))
+        self.assertFalse(util.probably_integral(catalog=catalog))
+        self.assertIs(util.integrity_info(catalog=catalog, cached=True),
+                      info)
+        # A change of either the catalog or the shadow tree invalidates
+        # the result.
+        self._shadow(util, (b'a/b',))
+        self.assertFalse(util.probably_integral(catalog=catalog))
+        catalog.catalog_path(b'a/c')
+        self.assertTrue(util.probably_integral(catalog=catalog))
+        info = util.integrity_info(catalog=catalog, cached=True)
+        self.assertEqual(info, (3, 3, 0, 0))
+        self.assertTrue(util.probably_integral(catalog=catalog))
@@ -0,0 +1,111 @@
+import random
+import unittest
+
+import mock
+
+from .utils import DummyContent, FakePlonePortal, build_dummy_site
+
+
+class TestVerifier(unittest.TestCase):
+
+    plone_api_patcher = mock.patch(
+        b'experimental.securityindexing.shadowtree.api',
+        **{b'portal.get.return_value': FakePlonePortal()}
+    )
+
+    def setUp(self):
+        from ..shadowtree import Node
+        self.plone_api_patcher.start()
+        self.addCleanup(self.plone_api_patcher.stop)
+        app = DummyContent()
+        (self.site, self.catalog) = build_dummy_site(app, 2, 2, 2)
+        self.root = Node()
+        self.root.update_security_info(self.site)
+        self.paths = list(self.catalog._catalog.uids.keys())
+        for path in self.paths:
+            obj = app.unrestrictedTraverse(path)
+            self.root.ensure_ancestry_to(obj).update_security_info(obj)
+
+    def _make_one(self, indexed=None, **kw):
+        from ..verification import Verifier
+
+        class _Verifier(Verifier):
+
+            def _get_unindex(self):
+                return indexed
+
+            def _indexer_value(self, obj):
+                return [b'/'.join(obj.getPhysicalPath())]
+
+        return _Verifier(self.site, self.root, self.catalog, **kw)
+
+    def _node(self, path):
+        return self.root.traverse(path)
+
+    def test_no_drift(self):
+        verifier = self._make_one()
+        for path in self.paths:
+            self.assertEqual(verifier.verify(path), [])
+        report = verifier.report()
+        self.assertEqual(report.stats[b'n_checked'], len(self.paths))
+        self.assertEqual(report.drift_rate(), 0.0)
+        self.assertTrue(report.is_complete())
+
+    def test_drift(self):
+        from ..verification import (
+            DRIFT_ARU,
+            DRIFT_BLOCK,
+            DRIFT_MISSING,
+            DRIFT_TOKEN,
+        )
+        (missing, blocked, stale, unindexed) = self.paths[-4:]
+        node = self._node(missing)
+        del node.__parent__[node.id]
+        node = self._node(blocked)
+        node.block_inherit_roles = not node.block_inherit_roles
+        self._node(stale).token = 0
+        indexed = {rid: [path] for (path, rid) in
+                   self.catalog._catalog.uids.items()
+                   if path != unindexed}
+        verifier = self._make_one(indexed=indexed, max_drifted=3)
+        for path in self.paths:
+            verifier.verify(path)
+        report = verifier.report()
+        self.assertEqual(report.drifted, [(missing, (DRIFT_MISSING,)),
+                                          (blocked, (DRIFT_BLOCK,)),
+                                          (stale, (DRIFT_TOKEN,))])
+        self.assertEqual(report.stats[b'n_drifted'], 4)
+        self.assertEqual(report.stats[b'n_aru'], 1)
+        self.assertEqual(report.drift_rate(DRIFT_ARU),
+                         1.0 / len(self.paths))
+
+    def test_untraversable(self):
+        verifier = self._make_one()
+        self.assertEqual(verifier.verify(b'/plone/gone'), [])
+        self.assertEqual(verifier.stats[b'n_untraversable'], 1)
+        self.assertEqual(verifier.report().drift_rate(), 0.0)
+
+    def test_verify_catalog_resumes(self):
+        from ..verification import verify_catalog
+        uids = self.catalog._catalog.uids
+        cursors = []
+        verifier = self._make_one()
+        cursor = verify_catalog(verifier, uids, batch_size=2, limit=3,
+                                on_batch=cursors.append)
+        self.assertEqual(cursor, self.paths[2])
+        self.assertEqual(cursors, [self.paths[1], self.paths[2]])
+        self.assertEqual(verifier.stats[b'n_checked'], 3)
+        cursor = verify_catalog(verifier, uids, cursor=cursor, batch_size=2)
+        self.assertIsNone(cursor)
+        self.assertEqual(verifier.stats[b'n_checked'], len(self.paths))
+
+    def test_sample_paths(self):
+        from ..verification import sample_paths
+        uids = self.catalog._catalog.uids
+        sample = list(sample_paths(uids, len(uids), 4,
+                                   rng=random.Random(0)))
+        self.assertEqual(len(set(sample)), 4)
+        self.assertEqual(sample, sorted(sample))
+        self.assertTrue(set(sample) <= set(self.paths))
+        sample = list(sample_paths(uids, len(uids), 1000))
+        self.assertEqual(sample, self.paths)
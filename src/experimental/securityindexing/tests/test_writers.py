@@ -0,0 +1,102 @@
+import unittest
+
+
+class _Doc(object):
+
+    def __init__(self, keywords):
+        self.allowedRolesAndUsers = keywords
+
+
+class TestBulkKeywordIndexWriter(unittest.TestCase):
+
+    def _get_target_class(self):
+        from ..writers import BulkKeywordIndexWriter
+        return BulkKeywordIndexWriter
+
+    def _make_one(self, *args, **kw):
+        cls = self._get_target_class()
+        return cls(*args, **kw)
+
+    def _make_index(self, keywords_by_rid):
+        from Products.PluginIndexes.KeywordIndex.KeywordIndex import (
+            KeywordIndex,
+        )
+        index = KeywordIndex(b'allowedRolesAndUsers')
+        for (rid, keywords) in sorted(keywords_by_rid.items()):
+            index.index_object(rid, _Doc(keywords))
+        return index
+
+    def _forward_index(self, index):
+        return {
+            keyword: {row} if isinstance(row, int) else set(row)
+            for (keyword, row) in index._index.items()
+        }
+
+    def _reverse_index(self, index):
+        return {
+            rid: set(keywords)
+            for (rid, keywords) in index._unindex.items()
+        }
+
+    def _check_index(self, index, expected_keywords_by_rid):
+        expected = self._make_index(expected_keywords_by_rid)
+        self.assertEqual(self._forward_index(index),
+                         self._forward_index(expected))
+        self.assertEqual(self._reverse_index(index),
+                         self._reverse_index(expected))
+        self.assertEqual(index._length(), expected._length())
+
+    def test_supports(self):
+        cls = self._get_target_class()
+        self.assertTrue(cls.supports(self._make_index({})))
+        self.assertFalse(cls.supports(object()))
+
+    def test_write(self):
+        index = self._make_index({
+            1: [b'Reader', b'user:bob'],
+            2: [b'Reader', b'user:bob'],
+            3: [b'Reader'],
+            4: [b'Editor'],
+        })
+        writer = self._make_one(index)
+        n_changed = writer.write([b'Reader', b'user:jane'], [1, 2, 3])
+        self.assertEqual(n_changed, 3)
+        self._check_index(index, {
+            1: [b'Reader', b'user:jane'],
+            2: [b'Reader', b'user:jane'],
+            3: [b'Reader', b'user:jane'],
+            4: [b'Editor'],
+        })
+        self.assertEqual(writer.stats[b'n_rids_written'], 3)
+
+    def test_write_unchanged(self):
+        keywords_by_rid = {
+            1: [b'Reader', b'user:bob'],
+            2: [b'user:bob', b'Reader'],
+        }
+        index = self._make_index(keywords_by_rid)
+        writer = self._make_one(index)
+        n_changed = writer.write([b'user:bob', b'Reader'], [1, 2])
+        self.assertEqual(n_changed, 0)
+        self.assertEqual(writer.stats[b'n_rids_unchanged'], 2)
+        self._check_index(index, keywords_by_rid)
+
+    def test_write_removes_keywords(self):
+        index = self._make_index({
+            1: [b'Reader', b'user:bob'],
+            2: [b'Editor'],
+        })
+        writer = self._make_one(index)
+        writer.write([], [1])
+        writer.write([b'Reader'], [2])
+        self._check_index(index, {1: [], 2: [b'Reader']})
+
+    def test_write_new_document(self):
+        index = self._make_index({1: [b'Reader']})
+        writer = self._make_one(index)
+        writer.write([b'Reader', b'Editor'], [2, 3])
+        self._check_index(index, {
+            1: [b'Reader'],
+            2: [b'Reader', b'Editor'],
+            3: [b'Reader', b'Editor'],
+        })
@@ -1,11 +1,171 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from zope import interface
 from zope.annotation.interfaces import IAnnotations
 import plone.app.testing as pa_testing
 
 
+_marker = object()
+
+
 @interface.implementer(IAnnotations)
 class FakePlonePortal(dict):
     """A fake Plone portal object for testing purposes."""
 
     def getId(self):
         return pa_testing.PLONE_SITE_ID
+
+    def getPhysicalPath(self):
+        return (b'', pa_testing.PLONE_SITE_ID)
+
+
+class DummyContent(Persistent):
+    u"""A persistent stand-in for a content item, or the application root.
+
+    :param id: The id of the item, or the empty string for the root.
+    :param parent: The parent item, or None for the root.
+    """
+
+    def __init__(self, id=b'', parent=None, local_roles=None, block=False,
+                 view_roles=None):
+        self.id = id
+        self._items = OOBTree()
+        if parent is None:
+            self._physical_path = (id,)
+            self._root = self
+        else:
+            self._physical_path = parent.getPhysicalPath() + (id,)
+            self._root = parent.getPhysicalRoot()
+        if local_roles:
+            self.__ac_local_roles__ = local_roles
+        if block:
+            self.__ac_local_roles_block__ = True
+        if view_roles is not None:
+            self._View_Permission = view_roles
+
+    def __repr__(self):  # pragma: no cover
+        return b'DummyContent(%r)' % (b'/'.join(self._physical_path),)
+
+    def getId(self):
+        return self.id
+
+    def getPhysicalPath(self):
+        return self._physical_path
+
+    def getPhysicalRoot(self):
+        return self._root
+
+    def objectIds(self):
+        return list(self._items.keys())
+
+    def add(self, id, **kw):
+        child = self._items[id] = type(self)(id, parent=self, **kw)
+        return child
+
+    def unrestrictedTraverse(self, path, default=_marker):
+        if isinstance(path, basestring):
+            path = path.split(b'/')
+        obj = self
+        if path and path[0] == b'':
+            obj = self._root
+            path = path[1:]
+        for comp in path:
+            if comp not in obj._items:
+                if default is _marker:
+                    raise KeyError(comp)
+                return default
+            obj = obj._items[comp]
+        return obj
+
+
+class DummyCatalog(DummyContent):
+    u"""A stand-in for a catalog tool, recording the paths cataloged."""
+
+    def __init__(self, id=b'', parent=None, **kw):
+        super(DummyCatalog, self).__init__(id=id, parent=parent, **kw)
+        self._catalog = PersistentMapping()
+        self._catalog.uids = OOBTree()
+
+    def catalog_object(self, obj):
+        uids = self._catalog.uids
+        uids[b'/'.join(obj.getPhysicalPath())] = len(uids)
+
+
+def build_dummy_site(app, n_partitions, n_siblings, n_levels):
+    u"""Build a site of cataloged dummy content in ``app``.
+
+    The site has ``n_partitions`` top-level folders, each the root of a
+    tree of ``n_levels`` levels of ``n_siblings`` folders. The local roles
+    and View roles of folders vary with their position.
+
+    :returns: The site and its catalog.
+    """
+    site = app.add(pa_testing.PLONE_SITE_ID,
+                   view_roles=(b'Manager', b'Member'))
+    catalog = site._items[b'portal_catalog'] = DummyCatalog(
+        b'portal_catalog', parent=site
+    )
+
+    def populate(parent, level):
+        for i in range(n_siblings):
+            child = parent.add(
+                b'f%d' % (i,),
+                local_roles={b'user-%d' % (i % 3,): [b'Reader']},
+                block=(i == 1 and level == 1),
+                view_roles=(b'Owner', b'Reader') if i % 2 else None
+            )
+            catalog.catalog_object(child)
+            if level < n_levels:
+                populate(child, level + 1)
+
+    for i in range(n_partitions):
+        top = site.add(b'p%d' % (i,))
+        catalog.catalog_object(top)
+        populate(top, 1)
+    return (site, catalog)
+
+
+def start_zeo_server(path, timeout=30.0):
+    u"""Start a ZEO server (in another process) for a FileStorage.
+
+    :param path: The path of the FileStorage.
+    :returns: A pair of the address of the server, and a callable which
+              stops it.
+    :rtype: tuple
+    """
+    sock = socket.socket()
+    sock.bind((b'127.0.0.1', 0))
+    addr = sock.getsockname()
+    sock.close()
+    env = dict(os.environ)
+    env[b'PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    with open(os.devnull, b'w') as devnull:
+        process = subprocess.Popen([sys.executable, b'-m', b'ZEO.runzeo',
+                                    b'-a', b'%s:%d' % addr, b'-f', path],
+                                   stdout=devnull,
+                                   stderr=devnull,
+                                   env=env)
+
+    def stop():
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(addr).close()
+        except socket.error:
+            if process.poll() is not None or time.time() > deadline:
+                stop()
+                raise RuntimeError(b'The ZEO server did not start.')
+            time.sleep(0.1)
+        else:
+            return (addr, stop)
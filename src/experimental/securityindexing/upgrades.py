@@ -0,0 +1,118 @@
+u"""GenericSetup upgrade steps."""
+from itertools import chain
+import logging
+
+from plone import api
+from zope import component
+import transaction
+
+from .interfaces import IShadowTreeTool
+
+
+logger = logging.getLogger(__package__)
+
+
+def retoken_shadowtree(context, savepoint_interval=1000):
+    u"""Re-create the security information of every shadow tree node.
+
+    Tokens used to be created with the builtin ``hash``, whose value
+    depends upon dict ordering and the process, such that equal security
+    could yield different tokens. Each node is visited once, parents before
+    children, so that tokens are derived from migrated parent tokens.
+    Security information recorded by later versions (e.g View roles) is
+    recorded for existing nodes in the same way.
+
+    :param context: The GenericSetup context (unused).
+    :param savepoint_interval: The number of nodes to update between
+                               transaction savepoints.
+    """
+    portal = api.portal.get()
+    root = component.getUtility(IShadowTreeTool).root
+    n_updated = n_missing = 0
+    for node in chain([root], root.descendants(ignore_block=True)):
+        if node.physical_path is None:
+            continue
+        obj = portal.unrestrictedTraverse(node.physical_path, None)
+        if obj is None:
+            n_missing += 1
+            continue
+        node.update_security_info(obj)
+        n_updated += 1
+        if n_updated % savepoint_interval == 0:
+            transaction.savepoint(optimistic=True)
+    logger.info(b'Re-created the security tokens of %d shadow tree nodes, '
+                b'%d nodes had no corresponding content.',
+                n_updated, n_missing)
+
+
+def count_shadowtree_nodes(context):
+    u"""Create the counters of inserted, deleted and modified nodes.
+
+    Shadow trees created by previous versions have no counters, hence
+    their integrity cannot be estimated without visiting every node.
+
+    :param context: The GenericSetup context (unused).
+    """
+    root = component.getUtility(IShadowTreeTool).root
+    root.reset_counters()
+    logger.info(b'Counted %d shadow tree nodes.', root.n_nodes)
+
+
+def derive_shadowtree_paths(context, savepoint_interval=1000):
+    u"""Discard the physical paths recorded on shadow tree nodes.
+
+    Previous versions recorded the path of every node, such that moving
+    content re-created every node within it. Paths are now derived from the
+    ids of ancestor nodes, and only the root node records one (that of the
+    site). Paths recorded on nodes which have been relocated since are
+    stale, hence every path is re-derived rather than taken as recorded.
+
+    :param context: The GenericSetup context (unused).
+    :param savepoint_interval: The number of nodes to update between
+                               transaction savepoints.
+    """
+    root = component.getUtility(IShadowTreeTool).root
+    recorded = root.physical_path
+    if recorded is not None:
+        root.physical_path = recorded
+    elif root._root_path is None:
+        root._root_path = tuple(api.portal.get().getPhysicalPath())
+    n_nodes = n_stale = 0
+    for node in root.descendants(ignore_block=True):
+        recorded = node.physical_path
+        physical_path = None
+        if recorded is not None:
+            physical_path = node._derived_path()
+            if tuple(recorded) != physical_path:
+                n_stale += 1
+        # Assigning the path discards that recorded.
+        node.physical_path = physical_path
+        n_nodes += 1
+        if n_nodes % savepoint_interval == 0:
+            transaction.savepoint(optimistic=True)
+    root._paths_derived = True
+    logger.info(b'Derived the paths of %d shadow tree nodes, %d of which '
+                b'were stale.', n_nodes, n_stale)
+
+
+def drop_empty_child_containers(context, savepoint_interval=1000):
+    u"""Drop the empty containers of child nodes of shadow tree nodes.
+
+    Previous versions created a container (a BTree) for every node, though
+    most nodes are leaves. Containers are now created upon adding the
+    first child.
+
+    :param context: The GenericSetup context (unused).
+    :param savepoint_interval: The number of containers to drop between
+                               transaction savepoints.
+    """
+    root = component.getUtility(IShadowTreeTool).root
+    n_dropped = 0
+    for node in root.descendants(ignore_block=True):
+        if node._data is not None and not len(node._data):
+            del node._data
+            n_dropped += 1
+            if n_dropped % savepoint_interval == 0:
+                transaction.savepoint(optimistic=True)
+    logger.info(b'Dropped %d empty containers of shadow tree nodes.',
+                n_dropped)
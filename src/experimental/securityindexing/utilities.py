@@ -1,44 +1,164 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
+from itertools import islice
+import logging
+import random
 
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from Products.CMFCore.permissions import ManagePortal
 from plone import api
 from zope import component, interface
 from zope.annotation.interfaces import IAnnotations
+import transaction
 
 from . import shadowtree
+from .aru import DEFAULT_CACHE_SIZE
+from .deferred import DEFAULT_CHUNK_SIZE, DEFAULT_TIME_BUDGET, JobQueue
 from .interfaces import IObjectSecurity, IShadowTreeRoot, IShadowTreeTool
+from .rebuild import rebuild as rebuild_shadowtree
+from .verification import (
+    DRIFTS,
+    VERIFY_BATCH_SIZE,
+    Verifier,
+    sample_paths,
+    verify_catalog,
+)
+
+
+logger = logging.getLogger(__package__)
+
+SYNC_BATCH_SIZE = 1000
+u"The default number of items synchronised per transaction by `sync`."
 
 
 _IntegityInfo = namedtuple(b'IntegrityInfo', (
-    b'catalog_paths',
     b'n_cataloged',
-    b'shadowtree_paths',
-    b'n_shadowed'
+    b'n_shadowed',
+    b'n_missing',
+    b'n_orphaned'
 ))
 
 
 class IntegrityInfo(_IntegityInfo):
 
     def is_integral(self):
-        return self.n_cataloged == self.n_shadowed
+        return not (self.n_missing or self.n_orphaned)
+
+
+PathStatus = namedtuple(b'PathStatus', (
+    b'path',
+    b'in_catalog',
+    b'in_shadowtree'
+))
+
+
+def merge_join(catalog_paths, shadowtree_paths):
+    u"""Join two sorted streams of paths.
+
+    Only the current path of each stream is held in memory.
+
+    :param catalog_paths: The paths of cataloged items, in order.
+    :param shadowtree_paths: The paths of shadow tree nodes, in order.
+    :returns: A generator of a `PathStatus` for each path of either
+              stream, stating in which stream(s) the path occurs.
+    """
+    catalog_paths = iter(catalog_paths)
+    shadowtree_paths = iter(shadowtree_paths)
+    cataloged = next(catalog_paths, None)
+    shadowed = next(shadowtree_paths, None)
+    while cataloged is not None or shadowed is not None:
+        if shadowed is None or (cataloged is not None and
+                                cataloged < shadowed):
+            yield PathStatus(cataloged, True, False)
+            cataloged = next(catalog_paths, None)
+        elif cataloged is None or shadowed < cataloged:
+            yield PathStatus(shadowed, False, True)
+            shadowed = next(shadowtree_paths, None)
+        else:
+            yield PathStatus(cataloged, True, True)
+            cataloged = next(catalog_paths, None)
+            shadowed = next(shadowtree_paths, None)
 
 
 @interface.implementer(IShadowTreeTool)
-class ShadowTreeTool(SimpleItem):
+class ShadowTreeTool(PropertyManager, SimpleItem):
     b"""Maintains a shadowtree of hints for controlling
     object security indexing operations.
     """
 
     _pkey = __package__
+    _jobs_key = __package__ + b'.jobs'
+    _sync_key = __package__ + b'.sync-cursor'
+    _integrity_key = __package__ + b'.integrity'
+    _verify_key = __package__ + b'.verify-state'
     _synchronised = False
+    _v_integrity_info = None
     title = __doc__.strip().rstrip(b'.')
+    prefetch_depth = 8
+    calculate_aru = True
+    aru_cache_size = DEFAULT_CACHE_SIZE
+    coalesce = True
+    self_heal = True
+    defer_threshold = 0
+    deferred_chunk_size = DEFAULT_CHUNK_SIZE
+    deferred_time_budget = DEFAULT_TIME_BUDGET
+
+    _properties = PropertyManager._properties + (
+        {b'id': b'prefetch_depth',
+         b'type': b'int',
+         b'mode': b'w',
+         b'label': b'Number of objects to prefetch ahead when re-indexing'},
+        {b'id': b'calculate_aru',
+         b'type': b'boolean',
+         b'mode': b'w',
+         b'label': b'Calculate allowedRolesAndUsers from the shadow tree '
+                   b'where provably equivalent'},
+        {b'id': b'aru_cache_size',
+         b'type': b'int',
+         b'mode': b'w',
+         b'label': b'Maximum number of cached allowedRolesAndUsers values '
+                   b'(per process)'},
+        {b'id': b'coalesce',
+         b'type': b'boolean',
+         b'mode': b'w',
+         b'label': b'Re-index object security once per transaction'},
+        {b'id': b'self_heal',
+         b'type': b'boolean',
+         b'mode': b'w',
+         b'label': b'Create missing nodes of content loaded whilst '
+                   b're-indexing'},
+        {b'id': b'defer_threshold',
+         b'type': b'int',
+         b'mode': b'w',
+         b'label': b'Re-index descendants in the background above this '
+                   b'number of nodes (zero disables)'},
+        {b'id': b'deferred_chunk_size',
+         b'type': b'int',
+         b'mode': b'w',
+         b'label': b'Maximum number of nodes re-indexed in the background '
+                   b'per transaction'},
+        {b'id': b'deferred_time_budget',
+         b'type': b'float',
+         b'mode': b'w',
+         b'label': b'Seconds to spend re-indexing in the background '
+                   b'per transaction'},
+    )
+
+    manage_options = (PropertyManager.manage_options +
+                      SimpleItem.manage_options)
 
     security = ClassSecurityInfo()
     security.declarePrivate(ManagePortal, b'delete_from_storage')
+    security.declarePrivate(ManagePortal, b'discrepancies')
+    security.declarePrivate(ManagePortal, b'generation')
     security.declarePrivate(ManagePortal, b'integrity_info')
+    security.declarePrivate(ManagePortal, b'probably_integral')
+    security.declarePrivate(ManagePortal, b'rebuild')
+    security.declarePrivate(ManagePortal, b'repair')
     security.declarePrivate(ManagePortal, b'sync')
+    security.declarePrivate(ManagePortal, b'verify')
 
     @staticmethod
     def _get_storage(portal=None):
@@ -53,48 +173,426 @@ class ShadowTreeTool(SimpleItem):
         :param portal: The Plone site portal object.
         """
         storage = cls._get_storage(portal=portal)
-        if cls._pkey in storage:
-            del storage[cls._pkey]
+        keys = (cls._pkey, cls._jobs_key, cls._sync_key, cls._integrity_key,
+                cls._verify_key)
+        for key in keys:
+            if key in storage:
+                del storage[key]
 
-    def integrity_info(self):
-        root = self.root
-        descendants = list(root.descendants(ignore_block=True))
-        path = api.portal.get().getPhysicalPath()
-        catalog = api.portal.get_tool(name=b'portal_catalog')
-        brains = catalog.unrestrictedSearchResults(path=path)
-        catalog_paths = {brain.getPath() for brain in brains}
-        shadowtree_paths = {
+    @staticmethod
+    def _get_catalog(catalog=None):
+        if catalog is None:
+            catalog = api.portal.get_tool(name=b'portal_catalog')
+        return catalog
+
+    def generation(self, catalog=None):
+        u"""Get the generation of the catalog and the shadow tree.
+
+        The generation changes whenever either changes.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :returns: The catalog's change counter, followed by the counts of
+                  nodes inserted, deleted and modified; or None if either
+                  lacks counters.
+        :rtype: tuple
+        """
+        get_counter = getattr(aq_base(self._get_catalog(catalog)),
+                              b'getCounter', None)
+        st_generation = self.root.generation
+        if get_counter is None or st_generation is None:
+            return None
+        return (get_counter(),) + st_generation
+
+    def _cached_integrity_info(self, generation):
+        if generation is None:
+            return None
+        for cached in (self._v_integrity_info,
+                       self._get_storage().get(self._integrity_key)):
+            if cached is not None:
+                (cached_generation, info) = cached
+                if cached_generation == generation:
+                    return info
+        return None
+
+    def probably_integral(self, catalog=None):
+        u"""Tell whether the shadow tree is probably integral.
+
+        The result of a previous `integrity_info` is used, unless the
+        generation has changed since. Otherwise the number of nodes with
+        a path (see `Node.n_nodes`) is compared with the number of
+        cataloged items. Nothing is stored in the database.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :rtype: bool
+        """
+        catalog = self._get_catalog(catalog)
+        info = self._cached_integrity_info(self.generation(catalog))
+        if info is not None:
+            return info.is_integral()
+        n_nodes = self.root.n_nodes
+        if n_nodes is None:
+            return self.integrity_info(catalog=catalog,
+                                       store=False).is_integral()
+        return n_nodes == len(catalog)
+
+    def _paths(self, catalog=None):
+        portal = api.portal.get()
+        catalog = self._get_catalog(catalog)
+        prefix = b'/'.join(portal.getPhysicalPath()) + b'/'
+        # Every path within the portal sorts before the prefix with its
+        # final '/' replaced by the following character ('0').
+        catalog_paths = catalog._catalog.uids.keys(min=prefix,
+                                                   max=prefix[:-1] + b'0',
+                                                   excludemax=True)
+        shadowtree_paths = (
             b'/'.join(node.physical_path)
-            for node in descendants
+            for node in self.root.descendants(ignore_block=True,
+                                              order=shadowtree.PATH_ORDER)
             if node.physical_path is not None
-        }
-        info = IntegrityInfo(catalog_paths=catalog_paths,
-                             n_cataloged=len(brains),
-                             shadowtree_paths=shadowtree_paths,
-                             n_shadowed=len(shadowtree_paths))
+        )
+        return merge_join(catalog_paths, shadowtree_paths)
+
+    def discrepancies(self, catalog=None):
+        u"""Generate the paths which are either cataloged or shadowed.
+
+        The catalog's paths and the shadow tree are streamed in order,
+        hence memory use depends only upon the depth of the shadow tree.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :returns: A generator of a `PathStatus` for each path which is
+                  cataloged but not shadowed, or vice versa, in order.
+        """
+        for entry in self._paths(catalog=catalog):
+            if entry.in_catalog != entry.in_shadowtree:
+                yield entry
+
+    def integrity_info(self, catalog=None, cached=False, store=True):
+        u"""Count the cataloged and shadowed paths, and those which differ.
+
+        The result is kept (in this process) with the generation it was
+        obtained at, and optionally stored in the database.
+
+        :param catalog: The catalog, or None for the portal catalog.
+        :param cached: If True, return the result kept or stored if the
+                       generation has not changed since.
+        :param store: If False, the result is not stored in the database,
+                      e.g whilst handling a request which only reads.
+        :rtype: IntegrityInfo
+        """
+        catalog = self._get_catalog(catalog)
+        generation = self.generation(catalog)
+        if cached:
+            info = self._cached_integrity_info(generation)
+            if info is not None:
+                return info
+        counts = Counter()
+        for entry in self._paths(catalog=catalog):
+            counts[entry.in_catalog, entry.in_shadowtree] += 1
+        n_missing = counts[True, False]
+        n_orphaned = counts[False, True]
+        n_both = counts[True, True]
+        info = IntegrityInfo(n_cataloged=n_both + n_missing,
+                             n_shadowed=n_both + n_orphaned,
+                             n_missing=n_missing,
+                             n_orphaned=n_orphaned)
+        if generation is not None:
+            self._v_integrity_info = (generation, info)
+            if store:
+                self._get_storage()[self._integrity_key] = (generation, info)
         return info
 
     @property
     def root(self):
         u"""Lazily return the root node if it's not yet been created."""
         storage = self._get_storage()
-        root_node = storage.setdefault(self._pkey, shadowtree.Node())
+        root_node = storage.get(self._pkey)
+        if root_node is None:
+            root_node = storage[self._pkey] = shadowtree.Node()
         interface.alsoProvides(root_node, IShadowTreeRoot)
         return root_node
 
-    def sync(self, catalog):  # pragma: no cover
-        u"""Synchronise security info of site content into the shadow tree.
+    @property
+    def jobs(self):
+        u"""Lazily return the queue of deferred re-indexing jobs."""
+        storage = self._get_storage()
+        return storage.setdefault(self._jobs_key, JobQueue())
+
+    def repair(self, catalog, shadow_only=False):
+        u"""Repair the differences between the shadow tree and the catalog.
 
-        This method may be expensive dependant upon the site of the site.
+        Unlike `sync`, only content which is cataloged but not shadowed,
+        or whose node lacks security info, is loaded. Nodes of paths which
+        are no longer cataloged are pruned. Only the nodes along, and
+        beneath, the paths which differ are inspected; of those, tokens
+        which differ from those derived from shadow data are re-derived,
+        as are the tokens of the subtrees of the nodes repaired.
 
         :param catalog: The catalog to obtain content from.
+        :param shadow_only: If True, only the shadow tree is updated;
+                            catalog entries are not re-indexed.
+        :returns: The number of nodes created, updated, pruned and
+                  re-tokened.
+        :rtype: collections.Counter
         """
+        portal = api.portal.get()
         root = self.root
-        brains = catalog.unrestrictedSearchResults(path=b'/')
-        for brain in brains:
-            obj = brain.getObject()
+        stats = Counter()
+        missing = set()
+        orphans = []
+        for entry in self.discrepancies(catalog=catalog):
+            if entry.in_catalog:
+                missing.add(entry.path)
+            else:
+                orphans.append(entry.path)
+        # Children follow their parents, hence are pruned first.
+        for path in reversed(orphans):
+            try:
+                node = root.traverse(path)
+            except LookupError:
+                continue
+            if len(node):
+                # Shadows cataloged descendants.
+                continue
+            del node.__parent__[node.id]
+            stats[b'n_pruned'] += 1
+        suspects = set()
+        retokened = set()
+        for node in self._nodes_near(missing.union(orphans)):
+            if node.physical_path is None:
+                continue
+            if node.token is None or node.view_acquired is None:
+                suspects.add(b'/'.join(node.physical_path))
+                continue
+            tokens = node._derive_tokens()
+            if tokens[-1] != node.token:
+                # Parents are visited first, hence are already repaired.
+                node._set_tokens(tokens)
+                node._count(shadowtree.MODIFIES)
+                retokened.add(node)
+        repaired = []
+        obj_sec = None
+        for path in sorted(missing | suspects, key=len):
+            obj = portal.unrestrictedTraverse(path, None)
+            if obj is None:
+                continue
             node = root.ensure_ancestry_to(obj)
-            obj_sec = component.getMultiAdapter((obj, catalog),
-                                                IObjectSecurity)
-            obj_sec.reindex_object(obj)
+            if not shadow_only:
+                if obj_sec is None:
+                    obj_sec = component.getMultiAdapter((obj, catalog),
+                                                        IObjectSecurity)
+                obj_sec.reindex_object(obj)
             node.update_security_info(obj)
+            repaired.append(node)
+            stats[b'n_created' if path in missing else b'n_updated'] += 1
+        force = set(repaired)
+        for node in repaired:
+            if node not in retokened:
+                retokened.update(node.retoken(force=force))
+        retokened -= force
+        stats[b'n_retokened'] += len(retokened)
+        if retokened and not shadow_only:
+            # The catalog values of re-tokened nodes are stale as well.
+            obj_sec = component.getMultiAdapter((portal, catalog),
+                                                IObjectSecurity)
+            obj_sec.reindex_nodes(retokened)
+        return stats
+
+    def _nodes_near(self, paths):
+        u"""Generate the nodes along, and beneath, each of ``paths``.
+
+        Ancestors are generated before their descendants, and each node
+        only once.
+
+        :param paths: Physical paths within the portal, as strings.
+        """
+        root = self.root
+        site_depth = len(api.portal.get().getPhysicalPath())
+        seen = set()
+        walked = set()
+        for path in sorted(paths):
+            node = root
+            for comp in path.split(b'/')[site_depth:]:
+                node = node[comp] if comp in node else None
+                if node is None or node in walked:
+                    # Missing, or within a subtree already generated.
+                    break
+                if node not in seen:
+                    seen.add(node)
+                    yield node
+            else:
+                walked.add(node)
+                for descendant in node.descendants(ignore_block=True):
+                    yield descendant
+
+    @property
+    def sync_cursor(self):
+        u"""The path of the last item synchronised by an incomplete `sync`."""
+        return self._get_storage().get(self._sync_key)
+
+    def _set_sync_cursor(self, path):
+        storage = self._get_storage()
+        if path is None:
+            storage.pop(self._sync_key, None)
+        else:
+            storage[self._sync_key] = path
+
+    def rebuild(self, catalog, processes=None, commit=True):
+        u"""Rebuild the shadow tree, with a pool of worker processes.
+
+        The site is partitioned by its top-level items, and the nodes of
+        each partition are built and committed by a worker process, where
+        the database is served by ZEO (see `.rebuild`). Unlike `sync`,
+        catalog entries are not re-indexed.
+
+        :param catalog: The catalog to obtain content from.
+        :param processes: The number of worker processes, or None for the
+                          number of CPUs.
+        :param commit: If True, commit the transaction after each partition.
+        :returns: The number of nodes recorded.
+        :rtype: int
+        """
+        return rebuild_shadowtree(self.root, api.portal.get(), catalog,
+                                  processes=processes, commit=commit)
+
+    def sync(self, catalog, batch_size=SYNC_BATCH_SIZE, shadow_only=False,
+             resume=True, commit=True):
+        u"""Synchronise security info of site content into the shadow tree.
+
+        The catalog is streamed over, in order of path, in batches of
+        ``batch_size`` items. After each batch, the path of its last item
+        is recorded as the sync cursor, the transaction is committed and
+        the connection cache is garbage collected, bounding both memory
+        and the work lost should the sync be interrupted.
+
+        :param catalog: The catalog to obtain content from.
+        :param batch_size: The number of items to synchronise per batch.
+        :param shadow_only: If True, only the shadow tree is updated;
+                            catalog entries are not re-indexed.
+        :param resume: If True, resume after the cursor recorded by an
+                       incomplete sync, rather than starting afresh.
+        :param commit: If True, commit the transaction after each batch,
+                       otherwise create a savepoint.
+        :returns: The number of items synchronised.
+        :rtype: int
+        """
+        portal = api.portal.get()
+        root = self.root
+        uids = catalog._catalog.uids
+        cursor = self.sync_cursor if resume else None
+        jar = aq_base(portal)._p_jar
+        obj_sec = None
+        n_synced = n_missing = 0
+        while True:
+            paths = list(islice(uids.keys(min=cursor,
+                                          excludemin=cursor is not None),
+                                batch_size))
+            if not paths:
+                break
+            for path in paths:
+                obj = portal.unrestrictedTraverse(path, None)
+                if obj is None:
+                    n_missing += 1
+                    continue
+                node = root.ensure_ancestry_to(obj)
+                if not shadow_only:
+                    if obj_sec is None:
+                        obj_sec = component.getMultiAdapter((obj, catalog),
+                                                            IObjectSecurity)
+                    obj_sec.reindex_object(obj)
+                node.update_security_info(obj)
+                n_synced += 1
+            cursor = paths[-1]
+            self._set_sync_cursor(cursor)
+            if commit:
+                transaction.commit()
+            else:
+                transaction.savepoint(optimistic=True)
+            if jar is not None:
+                jar.cacheGC()
+            logger.info(b'Synchronised %d items into the shadow tree, '
+                        b'up to %s.', n_synced, cursor)
+        self._set_sync_cursor(None)
+        if n_missing:
+            logger.warning(b'%d cataloged paths could not be traversed to.',
+                           n_missing)
+        return n_synced
+
+    @property
+    def verify_cursor(self):
+        u"""The path of the last item verified by an incomplete `verify`."""
+        state = self._get_storage().get(self._verify_key)
+        return state[0] if state is not None else None
+
+    def verify(self, catalog, sample_size=None, batch_size=VERIFY_BATCH_SIZE,
+               limit=None, resume=True, commit=True, rng=None):
+        u"""Verify shadow tree nodes and indexed security against content.
+
+        Either every cataloged path is verified, in order, or a random
+        sample of ``sample_size`` paths. Every path is verified in batches
+        of ``batch_size``; after each batch, the last path verified and
+        the results so far are recorded, and the transaction committed,
+        such that a verification stopped after ``limit`` paths (or
+        interrupted) resumes where it left off. See `.verification`.
+
+        :param catalog: The catalog to obtain content from.
+        :param sample_size: The number of paths to sample, or None to
+                            verify every path.
+        :param batch_size: The number of paths verified per batch.
+        :param limit: The maximum number of paths to verify, or None.
+        :param resume: If True, resume an incomplete verification of every
+                       path, rather than starting afresh.
+        :param commit: If True, commit the transaction after each batch,
+                       otherwise create a savepoint.
+        :param rng: The source of randomness for sampling, or None.
+        :returns: The report of the verification.
+        :rtype: verification.VerificationReport
+        """
+        portal = api.portal.get()
+        jar = getattr(aq_base(portal), b'_p_jar', None)
+        storage = self._get_storage()
+        verifier = Verifier(portal, self.root, catalog)
+        uids = catalog._catalog.uids
+        if sample_size is not None:
+            paths = sample_paths(uids, len(catalog), sample_size,
+                                 rng=rng or random)
+            while True:
+                batch = list(islice(paths, batch_size))
+                if not batch:
+                    break
+                for path in batch:
+                    verifier.verify(path)
+                if jar is not None:
+                    jar.cacheGC()
+            report = verifier.report()
+        else:
+            state = storage.get(self._verify_key) if resume else None
+            cursor = None
+            if state is not None:
+                (cursor, stats, drifted) = state
+                verifier.stats.update(stats)
+                verifier.drifted.extend(drifted)
+
+            def on_batch(cursor):
+                storage[self._verify_key] = (cursor,
+                                             dict(verifier.stats),
+                                             list(verifier.drifted))
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.savepoint(optimistic=True)
+                if jar is not None:
+                    jar.cacheGC()
+
+            cursor = verify_catalog(verifier, uids, cursor=cursor,
+                                    batch_size=batch_size, limit=limit,
+                                    on_batch=on_batch)
+            if cursor is None:
+                storage.pop(self._verify_key, None)
+            report = verifier.report(cursor)
+        logger.info(b'Verified %d items: %.2f%% drifted (missing %.2f%%, '
+                    b'block %.2f%%, token %.2f%%, allowedRolesAndUsers '
+                    b'%.2f%%).',
+                    report.stats[b'n_checked'],
+                    *(100 * report.drift_rate(kind) for kind in
+                      (None,) + DRIFTS))
+        return report
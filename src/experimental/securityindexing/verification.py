@@ -0,0 +1,236 @@
+u"""Verify the shadow tree and the indexed security of content.
+
+An integrity check only compares the paths cataloged with those shadowed.
+Verification loads the content of each path checked, and compares:
+
+* the local roles block and security token recorded on its shadow tree
+  node with those derived from the content (and the tokens recorded on
+  the parent node);
+
+* the `allowedRolesAndUsers` value indexed for it with that obtained from
+  the indexer.
+
+Either every cataloged path is verified, in order and in batches (such
+that verification can be resumed after the last path verified), or a
+random sample of them, from which drift rates can be estimated.
+"""
+from collections import Counter, namedtuple
+from itertools import islice
+import random
+
+from Products.CMFCore.interfaces import IIndexableObject
+from zope import component
+
+from .shadowtree import Node
+
+
+VERIFY_BATCH_SIZE = 1000
+u"The default number of paths verified per batch."
+
+MAX_DRIFTED = 100
+u"The maximum number of drifted paths recorded by a verification."
+
+DRIFT_MISSING = b'missing'
+u"A cataloged path has no shadow tree node."
+
+DRIFT_BLOCK = b'block'
+u"The local roles block recorded on a node differs from that of content."
+
+DRIFT_TOKEN = b'token'
+u"The security token recorded on a node differs from that of content."
+
+DRIFT_ARU = b'aru'
+u"The indexed `allowedRolesAndUsers` value differs from the indexer's."
+
+DRIFTS = (DRIFT_MISSING, DRIFT_BLOCK, DRIFT_TOKEN, DRIFT_ARU)
+
+
+_VerificationReport = namedtuple(b'VerificationReport', (
+    b'stats',
+    b'drifted',
+    b'cursor'
+))
+
+
+class VerificationReport(_VerificationReport):
+    u"""The result of a verification.
+
+    ``stats`` counts the paths checked (``n_checked``), those which could
+    not be traversed to (``n_untraversable``), those with any drift
+    (``n_drifted``), and those with each kind of drift (e.g ``n_token``).
+    ``drifted`` pairs the first `MAX_DRIFTED` drifted paths with their
+    kinds of drift. ``cursor`` is the last path verified by an incomplete
+    verification, otherwise None.
+    """
+
+    def is_complete(self):
+        return self.cursor is None
+
+    def drift_rate(self, kind=None):
+        u"""Get the proportion of the paths checked which drifted.
+
+        :param kind: The kind of drift, or None for any.
+        :rtype: float
+        """
+        n_checked = self.stats[b'n_checked']
+        if not n_checked:
+            return 0.0
+        if kind is None:
+            n_drifted = self.stats[b'n_drifted']
+        else:
+            n_drifted = self.stats[b'n_' + kind]
+        return float(n_drifted) / n_checked
+
+
+class Verifier(object):
+    u"""Verifies cataloged paths against content.
+
+    :param portal: The Plone site.
+    :param root: The root node of the shadow tree.
+    :param catalog: The catalog tool.
+    :param max_drifted: The maximum number of drifted paths recorded.
+    """
+
+    _index_id = b'allowedRolesAndUsers'
+
+    def __init__(self, portal, root, catalog, max_drifted=MAX_DRIFTED):
+        self.portal = portal
+        self.root = root
+        self.catalog = catalog
+        self.max_drifted = max_drifted
+        self.stats = Counter()
+        self.drifted = []
+        self._unindex = self._get_unindex()
+
+    def _get_unindex(self):
+        try:
+            index = self.catalog._catalog.getIndex(self._index_id)
+        except (AttributeError, KeyError):
+            return None
+        return getattr(index, b'_unindex', None)
+
+    def _indexer_value(self, obj):
+        indexable = component.getMultiAdapter((obj, self.catalog),
+                                              IIndexableObject)
+        return indexable.allowedRolesAndUsers
+
+    def _check_node(self, node, obj):
+        drifts = []
+        block = Node.get_local_roles_block(obj)
+        if bool(block) != bool(node.block_inherit_roles):
+            drifts.append(DRIFT_BLOCK)
+        physical_path = obj.getPhysicalPath()
+        parent = node.__parent__
+        (view_roles, view_acquired) = Node.get_view_roles(
+            obj,
+            effective=parent is None
+        )
+        if parent is None:
+            parent_tokens = (None, None)
+        else:
+            parent_tokens = (parent.local_roles_token, parent.view_token)
+        tokens = Node.derive_tokens(
+            parent_tokens,
+            Node.create_local_roles_digest(obj),
+            block,
+            Node.create_view_digest(view_roles, physical_path),
+            view_acquired
+        )
+        if tokens[-1] != node.token:
+            drifts.append(DRIFT_TOKEN)
+        return drifts
+
+    def _check_aru(self, path, obj):
+        if self._unindex is None:
+            return []
+        rid = self.catalog._catalog.uids.get(path)
+        indexed = self._unindex.get(rid) if rid is not None else None
+        if set(indexed or ()) != set(self._indexer_value(obj)):
+            return [DRIFT_ARU]
+        return []
+
+    def verify(self, path):
+        u"""Verify a cataloged path.
+
+        :param path: The path.
+        :returns: The kinds of drift found.
+        :rtype: list
+        """
+        stats = self.stats
+        obj = self.portal.unrestrictedTraverse(path, None)
+        if obj is None:
+            stats[b'n_untraversable'] += 1
+            return []
+        stats[b'n_checked'] += 1
+        try:
+            node = self.root.traverse(path)
+        except LookupError:
+            drifts = [DRIFT_MISSING]
+        else:
+            drifts = self._check_node(node, obj)
+        drifts.extend(self._check_aru(path, obj))
+        if drifts:
+            stats[b'n_drifted'] += 1
+            for kind in drifts:
+                stats[b'n_' + kind] += 1
+            if len(self.drifted) < self.max_drifted:
+                self.drifted.append((path, tuple(drifts)))
+        return drifts
+
+    def report(self, cursor=None):
+        u"""Report the verification so far.
+
+        :param cursor: The last path verified, if incomplete.
+        :rtype: VerificationReport
+        """
+        return VerificationReport(Counter(self.stats),
+                                  list(self.drifted),
+                                  cursor)
+
+
+def verify_catalog(verifier, uids, cursor=None,
+                   batch_size=VERIFY_BATCH_SIZE, limit=None, on_batch=None):
+    u"""Verify the cataloged paths after ``cursor``, in order and in batches.
+
+    :param verifier: The verifier.
+    :param uids: The catalog's mapping of paths to record ids.
+    :param cursor: The path to resume after, or None to start afresh.
+    :param batch_size: The number of paths verified per batch.
+    :param limit: The maximum number of paths verified, or None for all.
+    :param on_batch: Called with the last path of each batch verified.
+    :returns: The last path verified, or None if every path after
+              ``cursor`` has been.
+    """
+    n_verified = 0
+    while limit is None or n_verified < limit:
+        size = batch_size
+        if limit is not None:
+            size = min(size, limit - n_verified)
+        paths = list(islice(uids.keys(min=cursor,
+                                      excludemin=cursor is not None),
+                            size))
+        if not paths:
+            return None
+        for path in paths:
+            verifier.verify(path)
+        n_verified += len(paths)
+        cursor = paths[-1]
+        if on_batch is not None:
+            on_batch(cursor)
+    return cursor
+
+
+def sample_paths(uids, n_paths, sample_size, rng=random):
+    u"""Generate a uniformly random sample of cataloged paths, in order.
+
+    :param uids: The catalog's mapping of paths to record ids.
+    :param n_paths: The number of cataloged paths (e.g ``len(catalog)``).
+    :param sample_size: The number of paths to sample.
+    :param rng: The source of randomness (e.g a `random.Random`).
+    """
+    positions = sorted(rng.sample(xrange(n_paths), min(sample_size,
+                                                       n_paths)))
+    # Positions are ascending, so the keys are visited in a single sweep.
+    keys = uids.keys()
+    for position in positions:
+        yield keys[position]
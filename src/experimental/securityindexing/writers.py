@@ -0,0 +1,106 @@
+u"""Write index values for many catalog entries at once.
+
+When re-indexing object security, groups of catalog entries share the
+same `allowedRolesAndUsers` value. Rather than re-indexing each entry
+in turn (via `catalog_object`, which looks up the rid by path and then
+un-indexes and re-indexes each keyword), the writer here applies only the
+difference between the old and new keywords of each entry, and does so for
+all entries sharing the same difference at once.
+"""
+from collections import Counter, defaultdict
+
+from BTrees.IIBTree import IITreeSet
+
+
+_marker = object()
+
+
+class BulkKeywordIndexWriter(object):
+    u"""Writes keywords directly to the data structures of a KeywordIndex.
+
+    The forward index (``_index``) maps each keyword to either a single
+    rid (an int) or an ``IITreeSet`` of rids. The reverse index
+    (``_unindex``) maps each rid to a list of its keywords.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.stats = Counter()
+
+    @staticmethod
+    def supports(index):
+        u"""Return True if ``index`` can be written by this writer."""
+        return getattr(index, b'meta_type', None) == b'KeywordIndex'
+
+    def _insert(self, keyword, rids):
+        index = self.index
+        row = index._index.get(keyword, _marker)
+        if row is _marker:
+            if len(rids) == 1:
+                index._index[keyword] = rids[0]
+            else:
+                index._index[keyword] = IITreeSet(rids)
+            index._length.change(1)
+        elif isinstance(row, int):
+            index._index[keyword] = IITreeSet([row] + rids)
+        else:
+            row.update(rids)
+
+    def _remove(self, keyword, rids):
+        index = self.index
+        row = index._index.get(keyword, _marker)
+        if row is _marker:
+            return
+        if isinstance(row, int):
+            if row in rids:
+                del index._index[keyword]
+                index._length.change(-1)
+            return
+        for rid in rids:
+            if rid in row:
+                row.remove(rid)
+        if not row:
+            del index._index[keyword]
+            index._length.change(-1)
+
+    def write(self, keywords, rids):
+        u"""Index ``keywords`` for each of the catalog entries ``rids``.
+
+        Entries whose keywords are unchanged cause no writes at all.
+        Entries sharing the same set of added and removed keywords
+        are added to (or removed from) the row of each keyword at once.
+
+        :param keywords: The new keywords, e.g an allowedRolesAndUsers value.
+        :param rids: The record ids of the catalog entries.
+        :returns: The number of entries whose keywords changed.
+        :rtype: int
+        """
+        index = self.index
+        unindex = index._unindex
+        new_keywords = frozenset(keywords)
+        stored_keywords = sorted(new_keywords)
+        rids_by_delta = defaultdict(list)
+        for rid in rids:
+            old_keywords = frozenset(unindex.get(rid, ()))
+            added = new_keywords - old_keywords
+            removed = old_keywords - new_keywords
+            if not (added or removed):
+                self.stats[b'n_rids_unchanged'] += 1
+                continue
+            rids_by_delta[(added, removed)].append(rid)
+            if stored_keywords:
+                unindex[rid] = list(stored_keywords)
+            else:
+                del unindex[rid]
+        for ((added, removed), delta_rids) in rids_by_delta.items():
+            for keyword in added:
+                self._insert(keyword, delta_rids)
+            for keyword in removed:
+                self._remove(keyword, delta_rids)
+        n_changed = sum(map(len, rids_by_delta.values()))
+        self.stats[b'n_rids_written'] += n_changed
+        if n_changed:
+            increment_counter = getattr(index, b'_increment_counter', None)
+            if increment_counter is not None:
+                increment_counter()
+        return n_changed